@@ -16,18 +16,53 @@ functions.
 
 import re
 import json
+import math
+import time
+import errno
+import random
+import socket
 import timeit
 import logging
+import threading
 import functools
 
 import pyramid.threadlocal
 from pyramid.events import ContextFound
+from pyramid.settings import asbool
 
 
 logger = logging.getLogger("mozsvc.metrics")
+summary_logger = logging.getLogger("mozsvc.metrics.summary")
 
 COMMA_SEPARATED = re.compile(r"\s*,\s*")
 
+# Registry keys for the metrics configuration of the application.
+AGGREGATOR_KEY = "mozsvc.metrics.aggregator"
+LOG_REQUESTS_KEY = "mozsvc.metrics.log_requests"
+LOG_SAMPLER_KEY = "mozsvc.metrics.log_sampler"
+
+STATSD_KEY = "mozsvc.metrics.statsd"
+
+# Default number of seconds between flushes of aggregated metrics.
+DEFAULT_FLUSH_INTERVAL = 60
+
+# Relative precision of the histogram buckets, and the smallest value they
+# distinguish from zero.  Timings are kept to within 1% down to 1 microsecond.
+HISTOGRAM_PRECISION = 0.01
+HISTOGRAM_MIN_VALUE = 0.000001
+
+# Percentiles reported in each histogram summary.
+SUMMARY_PERCENTILES = (50, 90, 99)
+
+# Defaults for StatsdEmitter.  Packets are kept small enough to avoid
+# fragmentation on any sane network, and are sent at least this often.
+DEFAULT_STATSD_PORT = 8125
+DEFAULT_STATSD_MAX_PACKET_SIZE = 512
+DEFAULT_STATSD_FLUSH_INTERVAL = 1
+
+# Characters that have special meaning in the statsd line protocol.
+STATSD_UNSAFE_CHARS = re.compile(r"[:|@#,\s]")
+
 
 def initialize_request_metrics(request, defaults={}):
     """Request callback to add a "metrics" dict.
@@ -93,6 +128,24 @@ def finalize_request_metrics(request, message=None):
         start_time = request.metrics.pop("request_start_time")
         request.metrics["request_time"] = timeit.default_timer() - start_time
         request.metrics["code"] = 999
+    # Feed the aggregated metrics, if enabled.
+    registry = request.registry
+    aggregator = registry.get(AGGREGATOR_KEY)
+    if aggregator is not None:
+        aggregator.add_request(request)
+    statsd = registry.get(STATSD_KEY)
+    if statsd is not None:
+        statsd.add_request(request)
+    if not registry.get(LOG_REQUESTS_KEY, True):
+        return
+    # Only log a sample of requests, if so configured, weighting each
+    # logged line so that downstream counts come out right.
+    sampler = registry.get(LOG_SAMPLER_KEY)
+    if sampler is not None:
+        sample_weight = sampler.get_sample_weight(request)
+        if sample_weight is None:
+            return
+        request.metrics["sample_weight"] = sample_weight
     # Emit the a summary log line.
     if message is None:
         logger.info(json.dumps(request.metrics), extra=request.metrics)
@@ -188,6 +241,335 @@ class metrics_timer(object):
         return timed_func
 
 
+class RequestLogSampler(object):
+    """Decide which requests should have their metrics logged.
+
+    Each request is logged with probability "sample_rate", or with the rate
+    given for its matched route name in the "route_sample_rates" dict.
+    Requests that fail with a 5xx response code, or take longer than
+    "slow_threshold" seconds, are always logged so that sampling never
+    hides errors or tail latency.
+    """
+
+    def __init__(self, sample_rate=1, route_sample_rates=None,
+                 slow_threshold=None, random=random.random):
+        self.sample_rate = sample_rate
+        self.route_sample_rates = route_sample_rates or {}
+        self.slow_threshold = slow_threshold
+        self.random = random
+
+    def get_sample_weight(self, request):
+        """Get the weight with which to log the given request.
+
+        This returns the number of requests that the logged line stands for,
+        i.e. the reciprocal of the probability of logging it, or None if the
+        request should not be logged at all.
+        """
+        metrics = request.metrics
+        if metrics.get("code", 0) >= 500:
+            return 1
+        if self.slow_threshold is not None:
+            if metrics.get("request_time", 0) > self.slow_threshold:
+                return 1
+        rate = self.sample_rate
+        if self.route_sample_rates:
+            route = getattr(request, "matched_route", None)
+            if route is not None:
+                rate = self.route_sample_rates.get(route.name, rate)
+        if rate >= 1:
+            return 1
+        if rate <= 0 or self.random() >= rate:
+            return None
+        return 1.0 / rate
+
+
+class Histogram(object):
+    """Log-bucketed histogram of non-negative values, such as timings.
+
+    This is a simple dependency-free take on an HDR histogram.  Values are
+    counted in buckets whose widths grow geometrically, so that any value
+    can be recovered to within the given relative "precision" using a small
+    fixed amount of memory per order of magnitude.  Values below "min_value"
+    are counted as zero.
+
+    The exact count, sum, min and max are also kept.  It is not thread-safe.
+    """
+
+    def __init__(self, precision=HISTOGRAM_PRECISION,
+                 min_value=HISTOGRAM_MIN_VALUE):
+        self.min_value = min_value
+        self._log_base = math.log(1 + 2 * precision)
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """Add a value to the histogram."""
+        if value < self.min_value:
+            bucket = -1
+        else:
+            bucket = int(math.log(value / self.min_value) / self._log_base)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def get_percentile(self, percentile):
+        """Get an estimate of the given percentile of the values."""
+        if not self.count:
+            return None
+        if percentile <= 0:
+            return self.min
+        if percentile >= 100:
+            return self.max
+        target = self.count * percentile / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                break
+        if bucket < 0:
+            return 0
+        # Report the midpoint of the bucket, clamped to the observed range.
+        value = self.min_value * math.exp((bucket + 0.5) * self._log_base)
+        return min(max(value, self.min), self.max)
+
+    def get_summary(self):
+        """Get a dict summarizing the values in the histogram."""
+        summary = {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+        }
+        for percentile in SUMMARY_PERCENTILES:
+            summary["p%d" % (percentile,)] = self.get_percentile(percentile)
+        return summary
+
+
+class MetricsAggregator(object):
+    """Aggregate request metrics in memory, and log periodic summaries.
+
+    Rather than logging every request.metrics dict, this class groups
+    requests into series by matched route name, method and response code.
+    Each series keeps a request count, a Histogram of every float-valued
+    metric (such as "request_time" and the results of metrics_timer) and
+    a running total of every integer-valued metric.  Other values are
+    ignored.
+
+    Every "flush_interval" seconds a background thread calls flush(), which
+    logs one compact summary per series to the "mozsvc.metrics.summary"
+    logger and starts afresh.  Use the "metrics.flush_interval" setting to
+    enable this in an application.
+    """
+
+    def __init__(self, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._series = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._flusher_stopped = threading.Event()
+
+    def add_request(self, request):
+        """Add the metrics from a completed request."""
+        metrics = request.metrics
+        route = getattr(request, "matched_route", None)
+        if route is not None:
+            route = route.name
+        key = (route, metrics.get("method"), metrics.get("code"))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _MetricsSeries()
+            series.add(metrics)
+
+    def get_summaries(self):
+        """Get summaries of the series collected so far, and reset them."""
+        with self._lock:
+            all_series, self._series = self._series, {}
+        summaries = []
+        for (route, method, code), series in all_series.iteritems():
+            summary = series.get_summary()
+            summary["route"] = route
+            summary["method"] = method
+            summary["code"] = code
+            summaries.append(summary)
+        return summaries
+
+    def flush(self):
+        """Log summaries of the series collected so far, and reset them."""
+        for summary in self.get_summaries():
+            summary_logger.info(json.dumps(summary), extra=summary)
+
+    def start(self):
+        """Start the background thread that periodically flushes metrics."""
+        if self._flusher is not None:
+            raise RuntimeError("flusher is already running")
+        self._flusher_stopped.clear()
+        self._flusher = threading.Thread(target=self._run_flusher)
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def stop(self):
+        """Stop the background flusher, and flush any remaining metrics."""
+        if self._flusher is not None:
+            self._flusher_stopped.set()
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def _run_flusher(self):
+        while not self._flusher_stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error while flushing metrics")
+
+
+class _MetricsSeries(object):
+    """Aggregated metrics for a single route, method and response code."""
+
+    def __init__(self):
+        self.count = 0
+        self.histograms = {}
+        self.totals = {}
+
+    def add(self, metrics):
+        self.count += 1
+        for key, value in metrics.iteritems():
+            if isinstance(value, float):
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.add(value)
+            elif isinstance(value, (int, long)) and key != "code":
+                self.totals[key] = self.totals.get(key, 0) + value
+
+    def get_summary(self):
+        summary = {"count": self.count}
+        summary.update(self.totals)
+        for key, histogram in self.histograms.iteritems():
+            summary[key] = histogram.get_summary()
+        return summary
+
+
+class StatsdEmitter(object):
+    """Send request metrics to a StatsD server over UDP.
+
+    For each completed request this class emits every float-valued metric,
+    such as "request_time" and the results of metrics_timer, as a StatsD
+    timer in milliseconds, plus a "code.<status>" counter.  If "dogstatsd"
+    is true then the matched route name, method and status are also added
+    as DogStatsD tags.
+
+    Lines are batched into datagrams of up to "max_packet_size" bytes.  A
+    datagram is sent when it is full, when a request completes more than
+    "flush_interval" seconds after the last send, or when flush() is called.
+    The socket is non-blocking, so if the kernel's send buffer is full the
+    datagram is dropped and counted in "num_dropped" rather than holding
+    up the request.
+    """
+
+    def __init__(self, host="localhost", port=DEFAULT_STATSD_PORT, prefix="",
+                 dogstatsd=False,
+                 max_packet_size=DEFAULT_STATSD_MAX_PACKET_SIZE,
+                 flush_interval=DEFAULT_STATSD_FLUSH_INTERVAL):
+        self.address = (socket.gethostbyname(host), int(port))
+        if prefix and not prefix.endswith("."):
+            prefix += "."
+        self.prefix = prefix
+        self.dogstatsd = dogstatsd
+        self.max_packet_size = max_packet_size
+        self.flush_interval = flush_interval
+        self.num_sent = 0
+        self.num_dropped = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._lines = []
+        self._size = 0
+        self._last_send_time = time.time()
+        self._lock = threading.Lock()
+
+    def add_request(self, request):
+        """Add the metrics from a completed request."""
+        metrics = request.metrics
+        code = metrics.get("code")
+        suffix = ""
+        if self.dogstatsd:
+            route = getattr(request, "matched_route", None)
+            tags = [("method", metrics.get("method")), ("code", code)]
+            if route is not None:
+                tags.insert(0, ("route", route.name))
+            suffix = "|#" + ",".join(
+                "%s:%s" % (name, STATSD_UNSAFE_CHARS.sub("_", str(value)))
+                for name, value in tags)
+        prefix = self.prefix
+        lines = ["%scode.%s:1|c%s" % (prefix, code, suffix)]
+        for key, value in metrics.iteritems():
+            if isinstance(value, float):
+                key = STATSD_UNSAFE_CHARS.sub("_", key)
+                lines.append("%s%s:%.3f|ms%s" % (prefix, key, value * 1000,
+                                                 suffix))
+        self.add_lines(lines)
+
+    def add_lines(self, lines):
+        """Add raw StatsD lines to be sent in the next datagram."""
+        packets = []
+        with self._lock:
+            for line in lines:
+                if self._lines:
+                    # Lines after the first need a joining newline.
+                    if self._size + 1 + len(line) > self.max_packet_size:
+                        packets.append(self._take_packet())
+                    else:
+                        self._size += 1
+                self._lines.append(line)
+                self._size += len(line)
+            now = time.time()
+            if now - self._last_send_time >= self.flush_interval:
+                packets.append(self._take_packet())
+            if packets:
+                self._last_send_time = now
+        for packet in packets:
+            self._send(packet)
+
+    def flush(self):
+        """Send any buffered lines straight away."""
+        with self._lock:
+            packet = self._take_packet()
+            self._last_send_time = time.time()
+        self._send(packet)
+
+    def close(self):
+        """Flush any buffered lines and close the socket."""
+        self.flush()
+        self._sock.close()
+
+    def _take_packet(self):
+        packet = "\n".join(self._lines)
+        self._lines = []
+        self._size = 0
+        return packet
+
+    def _send(self, packet):
+        if not packet:
+            return
+        try:
+            self._sock.sendto(packet, self.address)
+        except socket.error, err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.ENOBUFS, errno.ECONNREFUSED):
+                logger.exception("Error while sending metrics to statsd")
+            self.num_dropped += 1
+        else:
+            self.num_sent += 1
+
+
 def new_request_listener(event):
     """NewRequest event-listener that adds request metrics."""
     initialize_request_metrics(event.request)
@@ -199,3 +581,36 @@ def includeme(config):
     # so it's only safe to add it after pyramid has done a certain
     # amount of processing and view resolution.
     config.add_subscriber(new_request_listener, ContextFound)
+    # Optionally aggregate metrics in memory and log periodic summaries,
+    # in which case the per-request log lines can be turned off.
+    settings = config.registry.settings
+    flush_interval = settings.get("metrics.flush_interval")
+    if flush_interval and float(flush_interval) > 0:
+        aggregator = MetricsAggregator(float(flush_interval))
+        aggregator.start()
+        config.registry[AGGREGATOR_KEY] = aggregator
+    statsd_host = settings.get("metrics.statsd_host")
+    if statsd_host:
+        host, _, port = statsd_host.partition(":")
+        config.registry[STATSD_KEY] = StatsdEmitter(
+            host, port or DEFAULT_STATSD_PORT,
+            prefix=settings.get("metrics.statsd_prefix", ""),
+            dogstatsd=asbool(settings.get("metrics.statsd_dogstatsd", False)))
+    log_requests = asbool(settings.get("metrics.log_requests", True))
+    config.registry[LOG_REQUESTS_KEY] = log_requests
+    # Per-route sample rates are given as "route_name:rate" pairs.
+    sample_rate = float(settings.get("metrics.log_sample_rate", 1))
+    route_sample_rates = {}
+    items = settings.get("metrics.log_route_sample_rates", ())
+    if isinstance(items, basestring):
+        items = items.split()
+    for item in items:
+        route, _, rate = item.rpartition(":")
+        route_sample_rates[route] = float(rate)
+    slow_threshold = settings.get("metrics.log_slow_threshold")
+    if slow_threshold is not None:
+        slow_threshold = float(slow_threshold)
+    if sample_rate < 1 or route_sample_rates:
+        sampler = RequestLogSampler(sample_rate, route_sample_rates,
+                                    slow_threshold)
+        config.registry[LOG_SAMPLER_KEY] = sampler
@@ -9,9 +9,10 @@ The classes in this module can be used to obtain a hex-encoded secret key
 corresponding to a given webhead node name.  This key can be used for
 making or verifying auth-token signatures via e.g. HMAC.
 
-There are three options for managing this mapping of nodes to secrets:
+There are four options for managing this mapping of nodes to secrets:
 
   * maintain a text file with secrets for each node (Secrets class)
+  * as above, but reload the file when it changes (ReloadingSecrets class)
   * use a fixed set of secrets for all nodes (FixedSecrets class)
   * derive node-specific secrets from a master secret (DerivedSecrets class)
 
@@ -26,10 +27,23 @@ import binascii
 import os
 import time
 import hashlib
+import logging
+import threading
 from collections import defaultdict
 
 from tokenlib.utils import HKDF
 
+from mozsvc.util import LRUCache
+
+
+logger = logging.getLogger("mozsvc.secrets")
+
+# Number of seconds between checks for changes in ReloadingSecrets files.
+DEFAULT_CHECK_INTERVAL = 5
+
+# Maximum number of nodes for which DerivedSecrets remembers the secrets.
+DEFAULT_DERIVED_SECRETS_CACHE_SIZE = 1000
+
 
 class Secrets(object):
     """Load node-specific secrets from a file.
@@ -56,23 +70,27 @@ class Secrets(object):
             filename = [filename]
 
         for name in filename:
-            with open(name, 'rb') as f:
-
-                reader = csv.reader(f, delimiter=',')
-                for line, row in enumerate(reader):
-                    if len(row) < 2:
-                        continue
-                    node = row[0]
-                    if node in self._secrets:
-                        raise ValueError("Duplicate node line %d" % line)
-                    secrets = []
-                    for secret in row[1:]:
-                        secret = secret.split(':')
-                        if len(secret) != 2:
-                            raise ValueError("Invalid secret line %d" % line)
-                        secrets.append(tuple(secret))
-                    secrets.sort()
-                    self._secrets[node] = secrets
+            self._read_file(name, self._secrets)
+
+    @staticmethod
+    def _read_file(name, secrets_by_node):
+        with open(name, 'rb') as f:
+
+            reader = csv.reader(f, delimiter=',')
+            for line, row in enumerate(reader):
+                if len(row) < 2:
+                    continue
+                node = row[0]
+                if node in secrets_by_node:
+                    raise ValueError("Duplicate node line %d" % line)
+                secrets = []
+                for secret in row[1:]:
+                    secret = secret.split(':')
+                    if len(secret) != 2:
+                        raise ValueError("Invalid secret line %d" % line)
+                    secrets.append(tuple(secret))
+                secrets.sort()
+                secrets_by_node[node] = secrets
 
     def save(self, filename):
         with open(filename, 'wb') as f:
@@ -99,6 +117,89 @@ class Secrets(object):
         self._secrets[node].append((timestamp, secret))
 
 
+class ReloadingSecrets(object):
+    """Load node-specific secrets from a file, reloading it when it changes.
+
+    This class provides the same API as the Secrets class, but watches
+    its files for changes so that secrets can be rotated without restarting
+    the process.  A background thread stats the files every "check_interval"
+    seconds, and if the modification time, inode or size of any of them has
+    changed then it loads them all into a new Secrets object.
+
+    Lookups go through an immutable mapping from node names to tuples of
+    secrets, built from the loaded Secrets object and swapped in along with
+    it, so get() is a plain dict lookup and never sees a half-loaded file.
+    If the changed files fail to load then the error is logged and the old
+    secrets are kept.
+
+    Options:
+
+    - **filename**: a list of file paths, or a single path.
+    - **check_interval**: number of seconds between checks for changes.
+
+    """
+    def __init__(self, filename, check_interval=DEFAULT_CHECK_INTERVAL):
+        if not isinstance(filename, (list, tuple)):
+            filename = [filename]
+        self.filenames = list(filename)
+        self.check_interval = float(check_interval)
+        self._file_stats = None
+        self._loaded = (Secrets(), {})
+        self.check_for_changes()
+        self._stopped = threading.Event()
+        self._watcher = threading.Thread(target=self._run_watcher)
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def keys(self):
+        return self._loaded[1].keys()
+
+    def get(self, node):
+        return list(self._loaded[1].get(node, ()))
+
+    def save(self, filename):
+        self._loaded[0].save(filename)
+
+    def check_for_changes(self):
+        """Reload the files if they have changed since they were last read.
+
+        This returns True if the secrets were reloaded and False otherwise.
+        If the files can't be read then the error is raised and the current
+        secrets are left in place.
+        """
+        file_stats = self._get_file_stats()
+        if file_stats == self._file_stats:
+            return False
+        secrets = Secrets(self.filenames)
+        index = {}
+        for node in secrets.keys():
+            index[node] = tuple(secrets.get(node))
+        self._loaded = (secrets, index)
+        self._file_stats = file_stats
+        return True
+
+    def close(self):
+        """Stop watching the files for changes."""
+        self._stopped.set()
+        self._watcher.join()
+
+    def _get_file_stats(self):
+        stats = []
+        for name in self.filenames:
+            st = os.stat(name)
+            stats.append((st.st_mtime, st.st_ino, st.st_size))
+        return stats
+
+    def _run_watcher(self):
+        while not self._stopped.wait(self.check_interval):
+            try:
+                if self.check_for_changes():
+                    logger.info("Reloaded secrets from %s",
+                                ", ".join(self.filenames))
+            except Exception:
+                logger.exception("Error while reloading secrets")
+
+
 class FixedSecrets(object):
     """Use a fixed set of secrets for all nodes.
 
@@ -130,34 +231,61 @@ class DerivedSecrets(object):
     keeping a big mapping of node-names to secrets, it uses a single list of
     master secrets and HKDF-derives a unique secret for each node.
 
+    The derived secrets for each node are remembered, so that repeated
+    lookups don't need to redo the HKDF calculations.  The memo is reset
+    whenever the "master_secrets" attribute is assigned.
+
     Options:
 
     - **secrets**: a list of hex-encoded master secrets to use.
+    - **cache_size**: the maximum number of nodes whose derived secrets
+      are remembered.
 
     """
 
     # Namespace prefix for HKDF "info" parameter.
     HKDF_INFO_NODE_SECRET = b"services.mozilla.com/mozsvc/v1/node_secret/"
 
-    def __init__(self, master_secrets):
+    def __init__(self, master_secrets,
+                 cache_size=DEFAULT_DERIVED_SECRETS_CACHE_SIZE):
+        self._cache = LRUCache(int(cache_size))
+        self.master_secrets = master_secrets
+
+    @property
+    def master_secrets(self):
+        return list(self._master_secrets)
+
+    @master_secrets.setter
+    def master_secrets(self, master_secrets):
         if isinstance(master_secrets, basestring):
             master_secrets = master_secrets.split()
-        self._master_secrets = master_secrets
+        # Swap in a fresh memo along with the new secrets, so that a
+        # concurrent get() can't store secrets derived from the old ones.
+        self._master_secrets, self._cache = (
+            tuple(master_secrets), LRUCache(self._cache.max_items))
 
     def get(self, node):
+        cache = self._cache
+        node_secrets = cache.get(node)
+        if node_secrets is None:
+            node_secrets = self._derive_secrets(self._master_secrets, node)
+            cache.set(node, node_secrets)
+        return list(node_secrets)
+
+    def _derive_secrets(self, master_secrets, node):
         hkdf_params = {
             "salt": None,
             "info": self.HKDF_INFO_NODE_SECRET + node,
             "hashmod": hashlib.sha256,
         }
         node_secrets = []
-        for master_secret in self._master_secrets:
+        for master_secret in master_secrets:
             # We want each hex-encoded derived secret to be the same
             # size as its (presumably hex-encoded) master secret.
             size = len(master_secret) / 2
             node_secret = HKDF(master_secret, size=size, **hkdf_params)
             node_secrets.append(binascii.b2a_hex(node_secret))
-        return node_secrets
+        return tuple(node_secrets)
 
     def keys(self):
         return []
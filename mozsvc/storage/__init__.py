@@ -8,6 +8,8 @@ This sub-package provides helper APIs for accessing various backend storage
 services.  Currently available are:
 
     * mozsvc.storage.mcclient:  client for interacting with memcache
+    * mozsvc.storage.mcpipeline:  pipelining memcache client for gevent
+    * mozsvc.storage.serialization:  codecs for values stored in memcache
 
 More may be added in the future, e.g. an SQL database access layer.
 """
@@ -10,20 +10,29 @@ for serialization, error reporting and connection pooling.
 """
 
 import sys
+import math
 import time
+import heapq
+import bisect
+import random
+import struct
+import hashlib
 import logging
-import warnings
+import threading
 import traceback
 import contextlib
 import Queue
+
 try:
-    import simplejson as json
+    import umemcache
 except ImportError:
-    import json
-
-import umemcache
+    umemcache = None
 
-from mozsvc.exceptions import BackendError
+from mozsvc.util import LRUCache, monotonic
+from mozsvc.metrics import annotate_request
+from mozsvc.exceptions import BackendError, BackendTimeoutError
+from mozsvc.storage.serialization import (ValueCodec, FLAG_JSON,
+                                          DEFAULT_COMPRESS_THRESHOLD)
 
 
 logger = logging.getLogger("mozsvc.storage.mcclient")
@@ -31,6 +40,49 @@ logger = logging.getLogger("mozsvc.storage.mcclient")
 DEFAULT_MAX_KEY_SIZE = 250
 DEFAULT_MAX_VALUE_SIZE = 20 * 1024 * 1024
 
+# Number of md5 digests hashed onto the ring for each server.  Each digest
+# gives four points on the ring, matching the layout used by libketama.
+DEFAULT_RING_REPLICAS = 40
+
+# Maximum number of commands to pipeline before reading back the replies.
+# This keeps the unread replies well within the socket buffers, so that
+# neither side can block on a full buffer while the other is writing.
+MAX_PIPELINED_COMMANDS = 1000
+
+# Default number of seconds for which values are held in the local cache.
+# This bounds how long a process can see stale data after the value has
+# been changed in memcached by some other process.
+DEFAULT_LOCAL_CACHE_TTL = 1
+
+# Upper bounds, in seconds, of the buckets in the histogram of time spent
+# waiting to check out a connection from the pool.  There is an implicit
+# final bucket for waits longer than the last bound.
+POOL_WAIT_TIME_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1, 10)
+
+# Defaults for get_or_compute().  A recomputed value is kept in memcached for
+# this many seconds after it goes stale, so it can be served while another
+# caller refreshes it.  The lease bounds how long a crashed caller can block
+# others from recomputing, and callers with no stale copy to serve will wait
+# this long for the lease holder before computing the value themselves.
+DEFAULT_STALE_TTL = 60
+DEFAULT_LEASE_TTL = 10
+DEFAULT_LEASE_WAIT_TIME = 1
+LEASE_POLL_INTERVAL = 0.05
+
+# Defaults for the per-server circuit breakers.  A server is considered
+# down after this many consecutive errors, and requests to it then fail
+# immediately for this many seconds before it is probed again.
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_TIMEOUT = 10
+
+# Minimum number of seconds between logging full tracebacks for errors
+# from the same server.  Errors in between are counted, and the count is
+# included in the next message that is logged.
+DEFAULT_ERROR_LOG_INTERVAL = 10
+
+# Sentinel for results that have not yet been received from any server.
+_MISSING = object()
+
 
 class MemcachedClient(object):
     """Helper class for interacting with memcache.
@@ -38,39 +90,220 @@ class MemcachedClient(object):
     This class provides the basic methods of the pylibmc Client class, but
     wraps them with some extra functionality:
 
-        * all values are transparently serialized via JSON instead of pickle.
+        * all values are transparently serialized via JSON instead of pickle,
+          or optionally some other registered serializer and compressor.
         * connections are taken from an underlying pool.
         * errors are converted into BackendError instances.
         * cas() transparently falls back to add() when appropriate.
+        * keys can be sharded across multiple servers.
+        * keys can be replicated to several servers, failing over between
+          them when a server goes down.
+
+    The "server" argument may be a single server address, or a list of
+    addresses (or whitespace-separated string) to shard keys across several
+    servers.  Keys are mapped to servers using a ketama-style consistent hash
+    ring, so that adding or removing a server remaps only a small proportion
+    of the keys.  Each server gets its own connection pool.
+
+    If "num_replicas" is greater than one, each key is stored on that many
+    servers: the one it maps to on the hash ring, and the next distinct
+    servers around the ring.  Writes are sent to every replica, and reads
+    to the first replica that is available.  When a server is marked as
+    down by its circuit breaker (see below), requests skip straight to the
+    next replica rather than waiting on the dead server.  A server that
+    comes back up will not have seen the writes made while it was down, so
+    this is only suitable for data that can tolerate that, such as
+    short-lived cache entries.
+
+    If "local_cache_size" is given, values fetched from memcached will be
+    kept in an in-process LRU cache of at most that many entries, and at most
+    "local_cache_max_bytes" bytes of encoded data if specified.  Entries are
+    dropped from the local cache after "local_cache_ttl" seconds, and when
+    they are written or deleted through this client.  Writes made by other
+    processes are not seen until the local entry expires, so this should
+    only be used for data that can tolerate a little staleness.  Hit and
+    miss counts are available from the "local_cache" attribute.
 
+    The "serializer" and "compressor" arguments name the codecs from the
+    mozsvc.storage.serialization registry that are used to encode new values;
+    values are compressed only if at least "compress_threshold" bytes long.
+    Existing values are always decoded according to their stored flags.
+
+    If "pool_metrics" is true, the time each request spends waiting for a
+    pooled connection is added to its request.metrics dict.  Counters for
+    each pool can be read at any time via get_pool_stats().
+
+    If "pool_checkout_timeout" is given, requests will wait at most that
+    many seconds for a free connection from a full pool before failing with
+    BackendTimeoutError.  If "pool_prefill" is given, that many connections
+    to each server are opened up-front.  If "pool_reap_interval" is given,
+    each pool is maintained by a background reaper at that interval; see
+    MCClientPool for details.
+
+    Each server has a circuit breaker, which marks the server as down after
+    "breaker_threshold" consecutive connection errors.  Requests to it then
+    fail immediately with a BackendError whose "retry_after" attribute gives
+    the number of seconds until the server will be probed again, which is
+    "breaker_timeout" seconds after the last failure.  Set breaker_threshold
+    to zero to disable the circuit breakers.  Tracebacks for errors from the
+    same server are logged at most once every "error_log_interval" seconds.
     """
 
     def __init__(self, server=None, key_prefix="", pool_size=None,
                  pool_timeout=60, max_key_size=None, max_value_size=None,
-                 **kwds):
+                 local_cache_size=None, local_cache_max_bytes=None,
+                 local_cache_ttl=DEFAULT_LOCAL_CACHE_TTL, serializer="json",
+                 compressor=None,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 pool_metrics=False, pool_checkout_timeout=None,
+                 pool_prefill=0, pool_reap_interval=None, num_replicas=1,
+                 breaker_threshold=DEFAULT_BREAKER_THRESHOLD,
+                 breaker_timeout=DEFAULT_BREAKER_TIMEOUT,
+                 error_log_interval=DEFAULT_ERROR_LOG_INTERVAL, **kwds):
         if "servers" in kwds:
-            msg = "MemcachedClient supports only a single server; please "\
-                  "use the 'server' argument rather than 'servers'"
-            warnings.warn(msg, DeprecationWarning, stacklevel=1)
-            if server is None:
-                server = kwds.pop("servers")
-                if not isinstance(server, basestring):
-                    server = server[0]
+            if server is not None:
+                raise ValueError("can't use both 'server' and 'servers'")
+            server = kwds.pop("servers")
         if server is None:
             server = "127.0.0.1:11211"
+        if isinstance(server, basestring):
+            server = server.split()
+        if not server:
+            raise ValueError("no memcached servers specified")
+        self.servers = list(server)
         self.key_prefix = key_prefix
-        self.pool = MCClientPool(server, pool_size, pool_timeout)
+        self.pools = {}
+        for server in self.servers:
+            self.pools[server] = self._create_pool(
+                server, pool_size, pool_timeout,
+                annotate_requests=pool_metrics,
+                checkout_timeout=pool_checkout_timeout,
+                prefill=pool_prefill,
+                reap_interval=pool_reap_interval,
+            )
+        # The first server's pool is used for everything in single-server
+        # mode, and remains available as "pool" for backwards-compatibility.
+        self.pool = self.pools[self.servers[0]]
+        if len(self.servers) > 1:
+            self.ring = ConsistentHashRing(self.servers)
+        else:
+            self.ring = None
+        self.num_replicas = min(num_replicas, len(self.servers))
+        self.breakers = {}
+        if breaker_threshold:
+            for server in self.servers:
+                self.breakers[server] = CircuitBreaker(breaker_threshold,
+                                                       breaker_timeout)
+        self.error_log_interval = error_log_interval
+        # Maps servers to [last_logged_time, num_suppressed_errors].
+        self._error_log_state = {}
+        self._error_log_lock = threading.Lock()
         self.max_key_size = max_key_size or DEFAULT_MAX_KEY_SIZE
         self.max_value_size = max_value_size or DEFAULT_MAX_VALUE_SIZE
+        self.codec = ValueCodec(serializer, compressor, compress_threshold)
+        if local_cache_size:
+            self.local_cache = LRUCache(local_cache_size,
+                                        local_cache_max_bytes,
+                                        local_cache_ttl)
+        else:
+            self.local_cache = None
+
+    def _create_pool(self, server, maxsize, timeout, **kwds):
+        """Create the connection pool for a single server.
+
+        The default implementation creates an MCClientPool; subclasses may
+        override this to use a different kind of connection.
+        """
+        return MCClientPool(server, maxsize, timeout, **kwds)
+
+    def get_pool_stats(self):
+        """Get a dict mapping each server to the stats for its pool."""
+        stats = {}
+        for server, pool in self.pools.iteritems():
+            stats[server] = pool.get_stats()
+        return stats
+
+    def _get_pool(self, key=None):
+        """Get the connection pool for the server holding the given key.
+
+        The key must already have been encoded via _encode_key.  If no key
+        is given then the pool for the first server is returned.
+        """
+        if self.ring is None or key is None:
+            return self.pool
+        return self.pools[self.ring.get_node(key)]
+
+    def _get_pools(self, key):
+        """Get the connection pools for all servers holding the given key.
+
+        In replicated mode this returns the pool for each replica, in order
+        of preference; otherwise it returns just the pool from _get_pool().
+        """
+        if self.num_replicas == 1:
+            return [self._get_pool(key)]
+        nodes = self.ring.get_nodes(key, self.num_replicas)
+        return [self.pools[node] for node in nodes]
+
+    def _group_keys_by_pool(self, keys, exclude=()):
+        """Split a list of encoded keys into per-server groups.
+
+        This method returns a list of (pool, keys) pairs, one for each
+        server that is responsible for at least one of the given keys.
+        In replicated mode each key is assigned to the first of its replicas
+        that is not in "exclude"; keys with no such replica are omitted.
+        """
+        if self.num_replicas == 1:
+            if self.ring is None:
+                return [(self.pool, list(keys))]
+            groups = {}
+            for key in keys:
+                groups.setdefault(self.ring.get_node(key), []).append(key)
+            return [(self.pools[node], node_keys)
+                    for node, node_keys in groups.iteritems()]
+        groups = {}
+        for key in keys:
+            for pool in self._get_pools(key):
+                if pool not in exclude:
+                    groups.setdefault(pool, []).append(key)
+                    break
+        return groups.items()
+
+    def _group_keys_by_replica(self, keys):
+        """Split a list of encoded keys into per-server groups for writing.
+
+        This is like _group_keys_by_pool(), except that in replicated mode
+        each key is put in the group for every one of its replicas.  The
+        groups are ordered so that a key's most-preferred replica comes
+        before any of its other replicas.
+        """
+        if self.num_replicas == 1:
+            return self._group_keys_by_pool(keys)
+        groups = {}
+        for key in keys:
+            for rank, pool in enumerate(self._get_pools(key)):
+                groups.setdefault((rank, pool), []).append(key)
+        groups = sorted(groups.iteritems(), key=lambda item: item[0][0])
+        return [(pool, pool_keys) for (_, pool), pool_keys in groups]
 
     @contextlib.contextmanager
-    def _connect(self):
-        """Context mananager for getting a connection to memcached."""
+    def _connect(self, key=None, pool=None):
+        """Context mananager for getting a connection to memcached.
+
+        The connection will be to the server responsible for the given
+        encoded key.  Alternatively, a specific pool may be given.  If the
+        server's circuit breaker is open, this fails immediately.
+        """
+        if pool is None:
+            pool = self._get_pool(key)
+        breaker = self.breakers.get(pool.server)
+        if breaker is not None and not breaker.allow_request():
+            raise BackendError("server is marked as down", pool.server,
+                               retry_after=breaker.get_retry_after())
         # We could get an error while trying to create a new connection,
         # or when trying to use an existing connection.  This outer
         # try-except handles the logging for both cases.
         try:
-            with self.pool.reserve() as mc:
+            with pool.reserve() as mc:
                 # If we get an error while using the client object,
                 # disconnect so that it will be removed from the pool.
                 try:
@@ -79,10 +312,119 @@ class MemcachedClient(object):
                     if mc is not None:
                         mc.disconnect()
                     raise
+                except BackendTimeoutError:
+                    # A server that stops replying is as good as down, but
+                    # the caller still gets to see that it was a timeout.
+                    if breaker is not None:
+                        breaker.record_failure()
+                    raise
         except (EnvironmentError, RuntimeError), err:
+            if breaker is not None:
+                breaker.record_failure()
             err = traceback.format_exc()
-            logger.error(err)
+            self._log_error(pool.server, err)
             raise BackendError(str(err))
+        else:
+            if breaker is not None:
+                breaker.record_success()
+
+    def _log_error(self, server, err):
+        """Log an error traceback, unless one was logged recently.
+
+        During an outage every request would otherwise log an identical
+        traceback, flooding the logs and slowing down the workers.
+        """
+        now = monotonic()
+        with self._error_log_lock:
+            state = self._error_log_state.setdefault(server, [None, 0])
+            last_logged, num_suppressed = state
+            if last_logged is not None:
+                if now < last_logged + self.error_log_interval:
+                    state[1] += 1
+                    return
+            state[0] = now
+            state[1] = 0
+        if num_suppressed:
+            err = "%s(%d similar errors suppressed)" % (err, num_suppressed)
+        logger.error(err)
+
+    def _read(self, key, read):
+        """Call read(mc) using a connection to a server holding the key.
+
+        In replicated mode, each replica is tried in turn until one of them
+        succeeds.  Replicas that are marked as down fail immediately.
+        """
+        for pool in self._get_pools(key):
+            try:
+                with self._connect(pool=pool) as mc:
+                    return read(mc)
+            except BackendError, err:
+                error = err
+        raise error
+
+    def _write(self, key, write, replicate=None):
+        """Call write(mc) using connections to each server holding the key.
+
+        In replicated mode the write is made to every replica that is not
+        marked as down, and the result from the first one that succeeds is
+        returned.  If "replicate" is given then it is called instead of
+        "write" for the remaining replicas, but only if the first result
+        was "STORED".
+        """
+        error = None
+        result = _MISSING
+        for pool in self._get_pools(key):
+            if result is _MISSING or replicate is None:
+                op = write
+            elif result == "STORED":
+                op = replicate
+            else:
+                break
+            try:
+                with self._connect(pool=pool) as mc:
+                    res = op(mc)
+            except BackendError, err:
+                error = err
+            else:
+                if result is _MISSING:
+                    result = res
+        if result is _MISSING:
+            raise error
+        return result
+
+    def _send_multi(self, keys, make_command):
+        """Pipeline a raw command for each of the given encoded keys.
+
+        The commands for each server are sent over a single connection
+        without waiting for the individual replies, which saves a round-trip
+        per key compared to calling the single-key methods in a loop.  This
+        returns a dict mapping each key to its reply line.  In replicated
+        mode the commands are sent to every replica, and the reply from the
+        first one that succeeds is returned for each key.
+        """
+        replies = {}
+        error = None
+        for pool, pool_keys in self._group_keys_by_replica(keys):
+            commands = [make_command(key) for key in pool_keys]
+            try:
+                try:
+                    with self._connect(pool=pool) as mc:
+                        pool_replies = self._send_pipelined_commands(mc,
+                                                                     commands)
+                finally:
+                    self._invalidate_local(pool_keys)
+            except BackendError, err:
+                if self.num_replicas == 1:
+                    raise
+                error = err
+            else:
+                for key, reply in zip(pool_keys, pool_replies):
+                    replies.setdefault(key, reply)
+        if error is not None:
+            for key in keys:
+                if key not in replies:
+                    raise error
+        return replies
 
     def _encode_key(self, key):
         """Encode an app-level key into the final form used for storage.
@@ -109,40 +451,52 @@ class MemcachedClient(object):
 
         This method returns the encoded value and any flag bits that
         should be set when storing into memcache to identify the encoding.
-        The default implementation json-encodes all values; subclasses
-        are free to override or extend this functionality.
+        The default implementation uses the configured serializer and
+        compressor; subclasses are free to override or extend this
+        functionality.
         """
-        value = json.dumps(value)
+        value, flags = self.codec.encode(value)
         if len(value) > self.max_value_size:
             raise ValueError("value too long")
-        return value, 0
+        return value, flags
 
     def _decode_value(self, value, flags):
         """Decode a storage-level value into the form expected by the app.
 
         This method takes the encoded value and any flag bits that were
         set in memcache, and returns the decoded app-level value.
-        The default implementation json-decodes all values; subclasses
-        are free to override or extend this functionality.
+        The default implementation picks the codecs identified by the flags;
+        subclasses are free to override or extend this functionality.
         """
-        value = json.loads(value)
-        return value
+        return self.codec.decode(value, flags)
+
+    def _invalidate_local(self, keys):
+        """Remove the given encoded keys from the local cache, if any."""
+        if self.local_cache is not None:
+            for key in keys:
+                self.local_cache.delete(key)
 
     def get(self, key):
         """Get the value stored under the given key."""
         key = self._encode_key(key)
-        with self._connect() as mc:
-            res = mc.get(key)
+        # The local cache holds the encoded data rather than the decoded
+        # value, so that each caller gets its own copy of mutable values.
+        if self.local_cache is not None:
+            res = self.local_cache.get(key)
+            if res is not None:
+                return self._decode_value(*res)
+        res = self._read(key, lambda mc: mc.get(key))
         if res is None:
             return None
         data, flags = res
+        if self.local_cache is not None:
+            self.local_cache.set(key, (data, flags), len(data))
         return self._decode_value(data, flags)
 
     def gets(self, key):
         """Get the current value and casid for the given key."""
         key = self._encode_key(key)
-        with self._connect() as mc:
-            res = mc.gets(key)
+        res = self._read(key, lambda mc: mc.gets(key))
         if res is None:
             return None, None
         data, flags, casid = res
@@ -150,23 +504,61 @@ class MemcachedClient(object):
         return data, casid
 
     def get_multi(self, keys):
-        """Get the values stored under the given keys in a single request."""
-        with self._connect() as mc:
-            encoded_keys = [self._encode_key(key) for key in keys]
-            encoded_items = mc.get_multi(encoded_keys)
+        """Get the values stored under the given keys in a single request.
+
+        When sharding across multiple servers, this sends a single request
+        to each server that holds at least one of the keys.
+        """
+        encoded_keys = [self._encode_key(key) for key in keys]
         items = {}
-        for key, res in encoded_items.iteritems():
-            assert res is not None
-            data, flags = res
-            items[self._decode_key(key)] = self._decode_value(data, flags)
+        if self.local_cache is not None:
+            missing_keys = []
+            for key in encoded_keys:
+                res = self.local_cache.get(key)
+                if res is None:
+                    missing_keys.append(key)
+                else:
+                    items[self._decode_key(key)] = self._decode_value(*res)
+            encoded_keys = missing_keys
+            if not encoded_keys:
+                return items
+        failed_pools = set()
+        while encoded_keys:
+            retry_keys = []
+            groups = self._group_keys_by_pool(encoded_keys, failed_pools)
+            for pool, pool_keys in groups:
+                try:
+                    with self._connect(pool=pool) as mc:
+                        encoded_items = mc.get_multi(pool_keys)
+                except BackendError:
+                    if self.num_replicas == 1:
+                        raise
+                    # Retry these keys on their next replica, if any.
+                    failed_pools.add(pool)
+                    for key in pool_keys:
+                        if failed_pools.issuperset(self._get_pools(key)):
+                            raise
+                    retry_keys.extend(pool_keys)
+                    continue
+                for key, res in encoded_items.iteritems():
+                    assert res is not None
+                    data, flags = res
+                    if self.local_cache is not None:
+                        self.local_cache.set(key, (data, flags), len(data))
+                    items[self._decode_key(key)] = self._decode_value(data,
+                                                                      flags)
+            encoded_keys = retry_keys
         return items
 
     def set(self, key, value, time=0):
         """Set the value stored under the given key."""
         key = self._encode_key(key)
         data, flags = self._encode_value(value)
-        with self._connect() as mc:
-            res = mc.set(key, data, time, flags)
+        try:
+            res = self._write(key,
+                              lambda mc: mc.set(key, data, time, flags))
+        finally:
+            self._invalidate_local((key,))
         if res != "STORED":
             return False
         return True
@@ -175,8 +567,11 @@ class MemcachedClient(object):
         """Add the given key to memcached if not already present."""
         key = self._encode_key(key)
         data, flags = self._encode_value(value)
-        with self._connect() as mc:
-            res = mc.add(key, data, time, flags)
+        try:
+            res = self._write(key,
+                              lambda mc: mc.add(key, data, time, flags))
+        finally:
+            self._invalidate_local((key,))
         if res != "STORED":
             return False
         return True
@@ -185,8 +580,11 @@ class MemcachedClient(object):
         """Replace the given key in memcached if it is already present."""
         key = self._encode_key(key)
         data, flags = self._encode_value(value)
-        with self._connect() as mc:
-            res = mc.replace(key, data, time, flags)
+        try:
+            res = self._write(key,
+                              lambda mc: mc.replace(key, data, time, flags))
+        finally:
+            self._invalidate_local((key,))
         if res != "STORED":
             return False
         return True
@@ -195,13 +593,23 @@ class MemcachedClient(object):
         """Set the value stored under the given key if casid matches."""
         key = self._encode_key(key)
         data, flags = self._encode_value(value)
-        with self._connect() as mc:
+        try:
             # Memcached's CAS only works properly on existing keys.
             # Fortunately ADD has the same semantics for missing keys.
             if casid is None:
-                res = mc.add(key, data, time, flags)
+                res = self._write(key,
+                                  lambda mc: mc.add(key, data, time, flags))
             else:
-                res = mc.cas(key, data, casid, time, flags)
+                # The casid is only valid on the server that it was read
+                # from, which is the first available replica.  If the value
+                # is stored there, it is then copied to the other replicas.
+                res = self._write(
+                    key,
+                    lambda mc: mc.cas(key, data, casid, time, flags),
+                    lambda mc: mc.set(key, data, time, flags),
+                )
+        finally:
+            self._invalidate_local((key,))
         if res != "STORED":
             return False
         return True
@@ -209,16 +617,532 @@ class MemcachedClient(object):
     def delete(self, key):
         """Delete the value stored under the given key."""
         key = self._encode_key(key)
-        with self._connect() as mc:
-            res = mc.delete(key)
+        try:
+            res = self._write(key, lambda mc: mc.delete(key))
+        finally:
+            self._invalidate_local((key,))
         if res != "DELETED":
             return False
         return True
 
+    def set_multi(self, items, time=0):
+        """Set the values for multiple keys in a single request.
+
+        This method takes a dict mapping keys to values, and returns a dict
+        mapping each key to a boolean indicating whether it was stored.
+        """
+        return self._store_multi("set", items, time)
+
+    def add_multi(self, items, time=0):
+        """Add multiple keys to memcached if not already present.
+
+        This method takes a dict mapping keys to values, and returns a dict
+        mapping each key to a boolean indicating whether it was added.
+        """
+        return self._store_multi("add", items, time)
+
+    def delete_multi(self, keys):
+        """Delete the values stored under the given keys in a single request.
+
+        This method returns a dict mapping each key to a boolean indicating
+        whether it was deleted.
+        """
+        encoded_keys = [self._encode_key(key) for key in keys]
+        replies = self._send_multi(encoded_keys,
+                                   lambda key: "delete %s\r\n" % (key,))
+        results = {}
+        for key, reply in replies.iteritems():
+            results[self._decode_key(key)] = (reply == "DELETED")
+        return results
+
+    def incr(self, key, delta=1, initial=None, time=0):
+        """Atomically increment the counter stored under the given key.
+
+        This returns the new value of the counter, or None if it does not
+        exist.  If "initial" is given then a missing counter is created as
+        if it had that value beforehand, expiring after "time" seconds.
+        """
+        return self.incr_multi({key: delta}, initial, time)[key]
+
+    def decr(self, key, delta=1, initial=None, time=0):
+        """Atomically decrement the counter stored under the given key.
+
+        Memcached will not decrement a counter below zero.  The return value
+        and arguments are otherwise as for incr().
+        """
+        return self.incr_multi({key: -delta}, initial, time)[key]
+
+    def incr_multi(self, items, initial=None, time=0):
+        """Adjust multiple counters in a single request.
+
+        This method takes a dict mapping keys to the (possibly negative)
+        amount by which to adjust each counter, and returns a dict mapping
+        each key to its new value, or None if it does not exist.  Missing
+        counters are created if "initial" is given, as for incr().
+
+        Counters are stored as decimal strings, which memcached requires
+        for its incr/decr commands.  They are flagged as JSON so that they
+        are read back as integers by get(), whatever the serializer.
+        """
+        deltas = dict((self._encode_key(key), delta)
+                      for key, delta in items.iteritems())
+        results = self._incr_encoded_multi(deltas)
+        missing = [key for key in deltas if results[key] is None]
+        if missing and initial is not None:
+            encoded_items = {}
+            for key in missing:
+                value = max(initial + deltas[key], 0)
+                encoded_items[key] = (str(value), FLAG_JSON)
+            stored = self._store_encoded_multi("add", encoded_items, time)
+            for key, (data, _) in encoded_items.iteritems():
+                results[key] = int(data)
+            # Somebody else might have created some of the counters since
+            # we checked for them, in which case just adjust their values.
+            retry = dict((key, deltas[key]) for key in missing
+                         if not stored[self._decode_key(key)])
+            if retry:
+                results.update(self._incr_encoded_multi(retry))
+        return dict((self._decode_key(key), value)
+                    for key, value in results.iteritems())
+
+    def _incr_encoded_multi(self, deltas):
+        """Pipeline an incr or decr command for each of the given keys.
+
+        This returns a dict mapping the encoded keys to their new values.
+        """
+        def make_command(key):
+            delta = deltas[key]
+            if delta < 0:
+                return "decr %s %d\r\n" % (key, -delta)
+            return "incr %s %d\r\n" % (key, delta)
+
+        results = {}
+        for key, reply in self._send_multi(deltas, make_command).iteritems():
+            if reply == "NOT_FOUND":
+                results[key] = None
+            elif reply.isdigit():
+                results[key] = int(reply)
+            else:
+                # This is most likely an attempt to increment a value
+                # that isn't a counter.  Memcached reports it without
+                # closing the connection, so it's not a backend error.
+                raise ValueError("memcached error for %r: %s"
+                                 % (self._decode_key(key), reply))
+        return results
+
+    def touch(self, key, time=0):
+        """Update the expiry time of the given key without changing it.
+
+        This returns a boolean indicating whether the key was found.
+        """
+        key = self._encode_key(key)
+        # umemcache has no API for this command, so send it as a raw
+        # protocol command with a single-line reply.
+        command = "touch %s %d\r\n" % (key, time)
+        reply = self._write(
+            key, lambda mc: self._send_pipelined_commands(mc, [command])[0],
+        )
+        return (reply == "TOUCHED")
+
+    def get_or_compute(self, key, fn, ttl=0, stale_ttl=DEFAULT_STALE_TTL,
+                       lease_ttl=DEFAULT_LEASE_TTL,
+                       wait_time=DEFAULT_LEASE_WAIT_TIME, beta=1):
+        """Get the value for the given key, computing it with fn() if needed.
+
+        This protects the backing store from a stampede of callers when a
+        popular value expires.  Values are stored along with the time at
+        which they go stale, and are kept in memcached for a further
+        "stale_ttl" seconds beyond their "ttl".  When a value is missing or
+        stale, callers race to add() a lease key and only the winner calls
+        fn().  The others return the stale value if there is one, or else
+        wait up to "wait_time" seconds for the winner to store a new value.
+
+        To avoid all callers seeing the value go stale at the same moment,
+        each caller may also decide to refresh it a little early, with a
+        probability that grows as the expiry time approaches and as the
+        time taken to compute the value increases.  The "beta" argument
+        scales this behaviour; zero disables early refresh.
+
+        Keys managed by this method should not be written by other means,
+        since the values are stored in a wrapper holding the extra metadata.
+        """
+        lease_key = key + ":lease"
+        entry, casid = self.gets(key)
+        if entry is not None:
+            value, expires, delta = entry
+            if expires is None:
+                return value
+            # Probabilistic early expiration, per Vattani et al.  The log
+            # of a uniform random number is negative, so this moves "now"
+            # some random amount into the future.
+            now = time.time()
+            if beta:
+                now -= delta * beta * math.log(1 - random.random())
+            if now < expires:
+                return value
+        if not self.add(lease_key, True, time=lease_ttl):
+            # Somebody else is computing the value.
+            if entry is not None:
+                return entry[0]
+            deadline = monotonic() + wait_time
+            while monotonic() < deadline:
+                time.sleep(LEASE_POLL_INTERVAL)
+                entry = self.get(key)
+                if entry is not None:
+                    return entry[0]
+            # They are taking too long; compute it ourselves, but don't
+            # store it since they are about to.
+            return fn()
+        try:
+            start_time = time.time()
+            value = fn()
+            end_time = time.time()
+            expires = end_time + ttl if ttl else None
+            entry = (value, expires, end_time - start_time)
+            # Keep the value around past its expiry so that a stale copy
+            # can be served while it is being refreshed.  If the key has
+            # been written since we read it then the other value is at least
+            # as fresh as this one, so the failed cas() can be ignored.
+            stored_ttl = int(math.ceil(ttl + stale_ttl)) if ttl else 0
+            self.cas(key, entry, casid, time=stored_ttl)
+        finally:
+            self.delete(lease_key)
+        return value
+
+    def _store_multi(self, command, items, time=0):
+        """Pipeline a storage command for each of the given items.
+
+        See _send_multi() for details of how the commands are sent.
+        """
+        encoded_items = {}
+        for key, value in items.iteritems():
+            encoded_items[self._encode_key(key)] = self._encode_value(value)
+        return self._store_encoded_multi(command, encoded_items, time)
+
+    def _store_encoded_multi(self, command, encoded_items, time=0):
+        """Pipeline a storage command for already-encoded keys and data."""
+        def make_command(key):
+            data, flags = encoded_items[key]
+            return "%s %s %d %d %d\r\n%s\r\n" % (
+                command, key, flags, time, len(data), data,
+            )
+
+        results = {}
+        replies = self._send_multi(encoded_items, make_command)
+        for key, reply in replies.iteritems():
+            results[self._decode_key(key)] = (reply == "STORED")
+        return results
+
+    def _send_pipelined_commands(self, mc, commands):
+        """Send raw protocol commands over a connection, and read replies.
+
+        Each command must produce exactly one line of reply; the list of
+        reply lines is returned in the same order as the commands.  The
+        default implementation works with umemcache connections.
+        """
+        return _send_pipelined_commands(mc, commands)
+
+
+def _send_pipelined_commands(mc, commands):
+    """Send raw protocol commands over a umemcache connection.
+
+    umemcache has no API for pipelining requests, so this function writes
+    the commands directly to the client's underlying socket and then reads
+    back the replies.  Each command must produce exactly one line of reply;
+    the list of reply lines is returned in the same order as the commands.
+
+    This is safe to interleave with normal use of the client object, since
+    umemcache does not buffer any data between calls.  Any unexpected data
+    causes a RuntimeError, so that the connection will be discarded.
+    """
+    sock = mc.sock
+    replies = []
+    for i in xrange(0, len(commands), MAX_PIPELINED_COMMANDS):
+        batch = commands[i:i + MAX_PIPELINED_COMMANDS]
+        sock.sendall("".join(batch))
+        # Read until we have seen a line terminator for each command.
+        # Prefixing each chunk with the last char of the previous one
+        # lets us count terminators that were split across reads.
+        chunks = []
+        num_lines = 0
+        last_char = ""
+        while num_lines < len(batch):
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise RuntimeError("memcached closed the connection")
+            num_lines += (last_char + chunk).count("\r\n")
+            last_char = chunk[-1]
+            chunks.append(chunk)
+        lines = "".join(chunks).split("\r\n")
+        if len(lines) != len(batch) + 1 or lines[-1]:
+            raise RuntimeError("unexpected data in memcached reply")
+        replies.extend(lines[:-1])
+    return replies
+
+
+class CounterAccumulator(object):
+    """Local accumulator for batching updates to memcached counters.
+
+    This class collects increments and decrements in memory and merges them
+    into a single incr or decr per key, which is sent to memcached when
+    flush() is called.  It is useful for hot counters such as request
+    quotas, where the exact value need not be visible immediately but one
+    network operation per request would be too costly.
+
+    If "flush_interval" is given then a background thread flushes the
+    pending updates every that many seconds; call stop() to shut it down
+    and flush any remaining updates.  Missing counters are created with
+    the given "initial" value and "time" expiry, as for incr().
+    """
+
+    def __init__(self, client, flush_interval=None, initial=0, time=0):
+        self.client = client
+        self.initial = initial
+        self.time = time
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._flusher_stopped = threading.Event()
+        if flush_interval is not None:
+            self.start(flush_interval)
+
+    def incr(self, key, delta=1):
+        """Add the given amount to the pending update for a counter."""
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + delta
+
+    def decr(self, key, delta=1):
+        """Subtract the given amount from the pending update for a counter.
+
+        Since updates are merged before being sent, memcached will only
+        stop a counter from going below zero at the time of the flush.
+        """
+        self.incr(key, -delta)
+
+    def get_pending(self, key):
+        """Get the amount by which a counter will change on the next flush."""
+        with self._lock:
+            return self._pending.get(key, 0)
+
+    def flush(self):
+        """Send all pending updates to memcached.
+
+        This returns a dict mapping each updated key to its new value.  If
+        the updates cannot be sent then they are kept for the next flush,
+        and the BackendError is raised.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        pending = dict((key, delta) for key, delta in pending.iteritems()
+                       if delta)
+        if not pending:
+            return {}
+        try:
+            return self.client.incr_multi(pending, self.initial, self.time)
+        except BackendError:
+            # Some of the updates may have been applied, but there's no way
+            # to tell which; it's better to over-count than to lose them.
+            with self._lock:
+                for key, delta in pending.iteritems():
+                    self._pending[key] = self._pending.get(key, 0) + delta
+            raise
+
+    def start(self, interval):
+        """Start a background thread to flush updates every few seconds."""
+        if self._flusher is not None:
+            raise RuntimeError("flusher is already running")
+        self._flusher_stopped.clear()
+        self._flusher = threading.Thread(target=self._run_flusher,
+                                         args=(interval,))
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def stop(self):
+        """Stop the background flusher, if any, and flush pending updates."""
+        if self._flusher is not None:
+            self._flusher_stopped.set()
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def _run_flusher(self, interval):
+        while not self._flusher_stopped.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error while flushing counters")
+
+
+class CircuitBreaker(object):
+    """Tracker for the health of a server, to avoid sending doomed requests.
+
+    The breaker starts out "closed", letting all requests through.  After
+    "threshold" consecutive failures it "opens", and refuses all requests
+    for "timeout" seconds.  It then becomes "half-open" and lets through a
+    single probe request; if that succeeds the breaker closes again, and if
+    it fails the breaker re-opens for another timeout period.
+
+    Callers must check allow_request() before each request, and report the
+    outcome via record_success() or record_failure().
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD,
+                 timeout=DEFAULT_BREAKER_TIMEOUT, get_time=None):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.get_time = get_time or monotonic
+        self.num_failures = 0
+        self._opened_at = None
+        self._probe_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        opened_at = self._opened_at
+        if opened_at is None:
+            return self.CLOSED
+        if self.get_time() < opened_at + self.timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow_request(self):
+        """Check whether a request should be sent to the server.
+
+        While the breaker is half-open, this returns True for only the first
+        caller.  If that probe never reports its outcome, another one will
+        be allowed after a further timeout period.
+        """
+        if self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = self.get_time()
+            if now < self._opened_at + self.timeout:
+                return False
+            probe_started_at = self._probe_started_at
+            if probe_started_at is not None:
+                if now < probe_started_at + self.timeout:
+                    return False
+            self._probe_started_at = now
+            return True
+
+    def get_retry_after(self):
+        """Get the number of seconds until a request will be allowed.
+
+        This is rounded up to a whole number of seconds, for use in a
+        Retry-After header.  It is zero if requests are currently allowed.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            retry_at = self._opened_at + self.timeout
+            if self._probe_started_at is not None:
+                retry_at = max(retry_at, self._probe_started_at + self.timeout)
+        return max(int(math.ceil(retry_at - self.get_time())), 0)
+
+    def record_success(self):
+        """Record a successful request, closing the breaker."""
+        if self.num_failures or self._opened_at is not None:
+            with self._lock:
+                self.num_failures = 0
+                self._opened_at = None
+                self._probe_started_at = None
+
+    def record_failure(self):
+        """Record a failed request, opening the breaker if necessary."""
+        with self._lock:
+            self.num_failures += 1
+            self._probe_started_at = None
+            if self._opened_at is not None or \
+                    self.num_failures >= self.threshold:
+                self._opened_at = self.get_time()
+
+
+class ConsistentHashRing(object):
+    """Ketama-style consistent hash ring for mapping keys to servers.
+
+    This class places a number of points for each server onto a ring of
+    32-bit hash values, using the same layout as libketama.  A key is mapped
+    to the server owning the first point at or after the key's own hash,
+    wrapping around at the end of the ring.  Adding or removing a server
+    only changes the mapping for keys that land on its points, which is
+    roughly 1/N of all keys for a ring of N servers.
+    """
+
+    def __init__(self, nodes=(), replicas=DEFAULT_RING_REPLICAS):
+        self.replicas = replicas
+        self.nodes = []
+        self._points = []
+        self._point_nodes = []
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        """Add a node to the ring."""
+        if node in self.nodes:
+            raise ValueError("node already in ring: %r" % (node,))
+        self.nodes.append(node)
+        self._build_ring()
+
+    def remove_node(self, node):
+        """Remove a node from the ring."""
+        self.nodes.remove(node)
+        self._build_ring()
+
+    def get_node(self, key):
+        """Get the node responsible for the given key."""
+        return self._point_nodes[self._find_point(key)]
+
+    def get_nodes(self, key, count):
+        """Get up to "count" distinct nodes for the given key, in order.
+
+        The first is the node from get_node(), and the others are those
+        found by continuing around the ring from there.
+        """
+        idx = self._find_point(key)
+        num_points = len(self._points)
+        count = min(count, len(self.nodes))
+        nodes = []
+        for i in xrange(num_points):
+            node = self._point_nodes[(idx + i) % num_points]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+    def _find_point(self, key):
+        if not self._points:
+            raise ValueError("no nodes in ring")
+        idx = bisect.bisect_left(self._points, self._hash(key))
+        if idx == len(self._points):
+            idx = 0
+        return idx
+
+    def _build_ring(self):
+        ring = []
+        for node in self.nodes:
+            for i in xrange(self.replicas):
+                digest = hashlib.md5("%s-%d" % (node, i)).digest()
+                for point in struct.unpack("<4I", digest):
+                    ring.append((point, node))
+        ring.sort()
+        self._points = [point for point, node in ring]
+        self._point_nodes = [node for point, node in ring]
+
+    def _hash(self, key):
+        return struct.unpack("<I", hashlib.md5(key).digest()[:4])[0]
+
 
 # Sentinel used to mark an empty slot in the MCClientPool queue.
 # Using sys.maxint as the timestamp ensures that empty slots will always
-# sort *after* live connection objects in the queue.
+# sort *after* live connection objects in the queue, whose timestamps are
+# taken from a monotonic clock.
 EMPTY_SLOT = (sys.maxint, None)
 
 
@@ -232,7 +1156,11 @@ class MCClientPool(object):
 
     To initialise the pool you must provide the server address to access.
     You may also specify the maximum size of the pool and the time after
-    which old connections will be recycled.
+    which old connections will be recycled.  If a maximum size is given,
+    "checkout_timeout" limits the time spent waiting for a free connection
+    before raising BackendTimeoutError; by default it will wait forever.
+    The pool can be pre-filled with "prefill" connections, to avoid a storm
+    of new connections when the first requests come in.
 
     To obtain a Client object from the pool, call reserve() as a context
     manager like this::
@@ -241,12 +1169,41 @@ class MCClientPool(object):
             mc.set("hello", "world")
             assert ms.get("hello") == "world"
 
+    The pool keeps counters of connections created, recycled due to age, and
+    dropped due to errors, along with a histogram of the time spent waiting
+    for a free connection.  Call get_stats() to obtain a snapshot of these
+    for logging or monitoring.  If "annotate_requests" is true then the wait
+    time for each checkout is also added to request.metrics under the key
+    "mcclient.pool_wait".
+
+    Stale connections are normally only found when they are checked out or
+    returned, so the request that finds them pays the cost of reconnecting.
+    If "reap_interval" is given then a background reaper will run every
+    that many seconds to close connections that are stale or will become so
+    before its next run, and check that idle connections are still alive.
+    It then opens new connections to keep at least "prefill" idle ones
+    where the pool size allows.  The reaper runs in a
+    daemon thread, which will be a greenlet if gevent has monkey-patched the
+    threading module.
     """
 
-    def __init__(self, server, maxsize=None, timeout=60):
+    def __init__(self, server, maxsize=None, timeout=60,
+                 annotate_requests=False, checkout_timeout=None, prefill=0,
+                 reap_interval=None):
+        if umemcache is None:
+            raise ImportError("MCClientPool requires the umemcache package")
         self.server = server
         self.maxsize = maxsize
         self.timeout = timeout
+        self.checkout_timeout = checkout_timeout
+        self.annotate_requests = annotate_requests
+        self.num_checkouts = 0
+        self.num_created = 0
+        self.num_recycled = 0
+        self.num_dropped = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+        self.wait_time_histogram = [0] * (len(POOL_WAIT_TIME_BUCKETS) + 1)
         # Use a synchronized Queue class to hold the active client objects.
         # It will contain tuples (connection_timestamp, client).
         # Using a PriorityQueue ensures that the oldest connection is always
@@ -254,10 +1211,28 @@ class MCClientPool(object):
         # that a no-maxsize pool can grow and shink according to demand, as old
         # connections are expired and not replaced.
         self.clients = Queue.PriorityQueue(maxsize)
+        # Open any connections requested for pre-filling.
+        # Failures here are logged but not fatal; the slots will be
+        # filled on demand once the server becomes available.
+        if maxsize is not None:
+            prefill = min(prefill, maxsize)
+        self.prefill = prefill
+        for i in xrange(prefill):
+            try:
+                client = self._create_client()
+            except (EnvironmentError, RuntimeError), err:
+                logger.warn("Failed to prefill connection to %s: %s",
+                            server, err)
+                prefill = i
+                break
+            self.clients.put((monotonic(), client))
         # If there is a maxsize, prime the queue with empty slots.
         if maxsize is not None:
-            for _ in xrange(maxsize):
+            for _ in xrange(maxsize - prefill):
                 self.clients.put(EMPTY_SLOT)
+        self._reaper = None
+        if reap_interval:
+            self.start_reaper(reap_interval)
 
     @contextlib.contextmanager
     def reserve(self):
@@ -268,41 +1243,199 @@ class MCClientPool(object):
         finally:
             self._checkin_client(ts, client)
 
+    def get_stats(self):
+        """Get a dict of statistics about the usage of this pool."""
+        buckets = [str(bound) for bound in POOL_WAIT_TIME_BUCKETS] + ["inf"]
+        # Only count idle connections, not the placeholders for empty slots.
+        with self.clients.mutex:
+            size = len([e for e in self.clients.queue if e[1] is not None])
+        return {
+            "size": size,
+            "checkouts": self.num_checkouts,
+            "created": self.num_created,
+            "recycled": self.num_recycled,
+            "dropped": self.num_dropped,
+            "total_wait_time": self.total_wait_time,
+            "max_wait_time": self.max_wait_time,
+            "wait_time_histogram": dict(zip(buckets,
+                                            self.wait_time_histogram)),
+        }
+
+    def start_reaper(self, interval):
+        """Start the background reaper, running every "interval" seconds."""
+        if self._reaper is not None:
+            raise RuntimeError("reaper is already running")
+        self._reaper_stopped = threading.Event()
+        self._reaper = threading.Thread(target=self._run_reaper,
+                                        args=(interval,))
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def stop_reaper(self):
+        """Stop the background reaper, if it is running."""
+        if self._reaper is not None:
+            self._reaper_stopped.set()
+            self._reaper.join()
+            self._reaper = None
+
+    def _run_reaper(self, interval):
+        while not self._reaper_stopped.wait(interval):
+            try:
+                self.reap_connections(lookahead=interval)
+            except Exception:
+                logger.exception("Error while reaping connections to %s",
+                                 self.server)
+
+    def reap_connections(self, lookahead=0):
+        """Close stale or dead connections, and top up idle connections.
+
+        This method checks each idle connection in turn, closing it if it is
+        stale or will become stale within "lookahead" seconds, or if it fails
+        a cheap liveness check.  Only the connection being checked is taken
+        out of the pool, so requests can carry on using the others.  Closed
+        connections leave an empty slot behind, as if they had been dropped
+        on checkin.  New connections are then opened to bring the number of
+        idle connections up to the configured prefill size, each one taking
+        an empty slot only once it is connected.  It is normally called from
+        the background reaper, but may also be called directly.
+        """
+        with self.clients.mutex:
+            entries = [e for e in self.clients.queue if e[1] is not None]
+        num_live = 0
+        for entry in entries:
+            # Skip any connection that has been checked out in the meantime.
+            if not self._take_entry(entry):
+                continue
+            ts, client = entry
+            if ts + self.timeout <= monotonic() + lookahead:
+                client.disconnect()
+                self.num_recycled += 1
+            elif not self._is_alive(client):
+                client.disconnect()
+                self.num_dropped += 1
+            else:
+                self.clients.put(entry)
+                num_live += 1
+                continue
+            if self.maxsize is not None:
+                self.clients.put(EMPTY_SLOT)
+        # Top up to the prefill size.  Any other closed connections are
+        # not replaced, so that an unbounded pool can shrink when idle.
+        for _ in xrange(self.prefill - num_live):
+            try:
+                client = self._create_client()
+            except (EnvironmentError, RuntimeError), err:
+                logger.warn("Failed to refill connection to %s: %s",
+                            self.server, err)
+                break
+            entry = (monotonic(), client)
+            if self.maxsize is None:
+                self.clients.put(entry)
+            elif not self._replace_entry(EMPTY_SLOT, entry):
+                # All the slots were taken while we were connecting.
+                client.disconnect()
+                break
+
+    def _take_entry(self, entry):
+        """Remove a specific entry from the queue, if it's still there."""
+        clients = self.clients
+        with clients.mutex:
+            try:
+                clients.queue.remove(entry)
+            except ValueError:
+                return False
+            heapq.heapify(clients.queue)
+            clients.not_full.notify()
+            return True
+
+    def _replace_entry(self, old_entry, new_entry):
+        """Swap an entry in the queue for another, if it's still there."""
+        clients = self.clients
+        with clients.mutex:
+            try:
+                clients.queue.remove(old_entry)
+            except ValueError:
+                return False
+            clients.queue.append(new_entry)
+            heapq.heapify(clients.queue)
+            clients.not_empty.notify()
+            return True
+
+    def _is_alive(self, client):
+        """Check whether a Client object has a working connection."""
+        if not client.is_connected():
+            return False
+        try:
+            client.version()
+        except (EnvironmentError, RuntimeError):
+            return False
+        return True
+
     def _create_client(self):
         """Create a new Client object."""
         client = umemcache.Client(self.server)
         client.connect()
+        self.num_created += 1
         return client
 
+    def _record_wait_time(self, start_time):
+        """Record the time taken to check out a connection."""
+        wait_time = monotonic() - start_time
+        self.num_checkouts += 1
+        self.total_wait_time += wait_time
+        if wait_time > self.max_wait_time:
+            self.max_wait_time = wait_time
+        bucket = bisect.bisect_left(POOL_WAIT_TIME_BUCKETS, wait_time)
+        self.wait_time_histogram[bucket] += 1
+        if self.annotate_requests:
+            annotate_request(None, "mcclient.pool_wait", wait_time)
+
     def _checkout_client(self):
         """Checkout a Client ojbect from the pool.
 
         This method checks out a Client object from the pool, creating a new
         one if necessary.  It will block if a maxsize has been set and there
-        are no objects left in the pool
+        are no objects left in the pool, raising BackendTimeoutError if
+        none becomes available within the checkout_timeout.
         """
         # If there's no maxsize, no need to block waiting for a connection.
         blocking = (self.maxsize is not None)
+        start_time = monotonic()
+        if self.checkout_timeout is not None:
+            deadline = start_time + self.checkout_timeout
         # Loop until we get a non-stale connection, or we create a new one.
         while True:
+            timeout = None
+            if blocking and self.checkout_timeout is not None:
+                timeout = max(0, deadline - monotonic())
             try:
-                ts, client = self.clients.get(blocking)
+                ts, client = self.clients.get(blocking, timeout)
             except Queue.Empty:
+                self._record_wait_time(start_time)
+                if blocking:
+                    msg = "timed out waiting for a pooled connection"
+                    raise BackendTimeoutError(msg, server=self.server)
                 # No maxsize and no free connections, create a new one.
-                # XXX TODO: we should be using a monotonic clock here.
-                now = int(time.time())
-                return now, self._create_client()
+                return monotonic(), self._create_client()
             else:
-                now = int(time.time())
+                now = monotonic()
                 # If we got an empty slot placeholder, create a new connection.
+                # Give the slot back if that fails, so the pool doesn't shrink.
                 if client is None:
-                    return now, self._create_client()
+                    self._record_wait_time(start_time)
+                    try:
+                        return now, self._create_client()
+                    except Exception:
+                        self.clients.put(EMPTY_SLOT)
+                        raise
                 # If the connection is not stale, go ahead and use it.
                 if ts + self.timeout > now:
+                    self._record_wait_time(start_time)
                     return ts, client
                 # Otherwise, the connection is stale.
                 # Close it, push an empty slot onto the queue, and retry.
                 client.disconnect()
+                self.num_recycled += 1
                 self.clients.put(EMPTY_SLOT)
                 continue
 
@@ -311,9 +1444,17 @@ class MCClientPool(object):
         # If the connection is now stale, don't return it to the pool.
         # Push an empty slot instead so that it will be refreshed when needed.
         if client.is_connected():
-            now = int(time.time())
+            now = monotonic()
             if ts + self.timeout > now:
                 self.clients.put((ts, client))
             else:
+                client.disconnect()
+                self.num_recycled += 1
                 if self.maxsize is not None:
                     self.clients.put(EMPTY_SLOT)
+        else:
+            # The connection was dropped due to an error.  We still need
+            # to replace its slot, or the pool would gradually shrink away.
+            self.num_dropped += 1
+            if self.maxsize is not None:
+                self.clients.put(EMPTY_SLOT)
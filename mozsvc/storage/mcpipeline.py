@@ -0,0 +1,438 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Pipelining memcached client for cooperative (e.g. gevent) servers.
+
+This module provides a drop-in alternative to MemcachedClient that speaks
+the memcached text protocol directly over ordinary python sockets, rather
+than going through umemcache.  Instead of giving each request exclusive use
+of a pooled connection, it lets many concurrent requests share a small
+number of connections to each server:
+
+    * each request writes its command to the connection as soon as it is
+      issued, without waiting for earlier requests to complete.
+    * a background reader for each connection parses the replies as they
+      arrive and hands them back to the waiting requests, in order.
+
+Under gevent with monkey-patching, the sockets are non-blocking and the
+readers are greenlets, so thousands of in-flight requests can be served
+over a handful of connections.  Without gevent it works the same way using
+ordinary threads.
+"""
+
+import socket
+import logging
+import threading
+import contextlib
+import collections
+
+from mozsvc.util import monotonic
+from mozsvc.exceptions import BackendTimeoutError
+from mozsvc.storage.mcclient import MemcachedClient
+
+
+logger = logging.getLogger("mozsvc.storage.mcpipeline")
+
+DEFAULT_PORT = 11211
+
+# Default number of connections to open to each server.
+DEFAULT_CONNECTIONS_PER_SERVER = 2
+
+# Default number of seconds to wait when connecting, if the client has no
+# pool_checkout_timeout to bound the time spent on a request.
+DEFAULT_CONNECT_TIMEOUT = 5
+
+
+class PipelinedMemcachedClient(MemcachedClient):
+    """Memcached client that multiplexes requests over shared connections.
+
+    This class provides the same API and options as MemcachedClient, but
+    uses a PipelinedConnectionPool for each server rather than a pool of
+    umemcache connections.  The "pool_size" argument gives the number of
+    connections to open to each server, and "pool_timeout" the age after
+    which they are replaced.  If "pool_checkout_timeout" is given, requests
+    that do not receive a reply within that many seconds will fail with
+    BackendTimeoutError.  If "pool_prefill" is given then connections are
+    opened up-front.  The "pool_metrics" and "pool_reap_interval" options
+    have no effect, since requests never wait for a free connection and
+    each connection's reader notices disconnects as soon as they happen.
+    """
+
+    def _create_pool(self, server, maxsize, timeout, checkout_timeout=None,
+                     prefill=0, **kwds):
+        return PipelinedConnectionPool(server, maxsize, timeout,
+                                       checkout_timeout, prefill)
+
+    def _send_pipelined_commands(self, mc, commands):
+        return mc.send_commands(commands)
+
+
+class PipelinedConnectionPool(object):
+    """Set of shared, pipelined connections to a single memcached server.
+
+    This class provides the same reserve() and get_stats() interface as
+    MCClientPool, but reserve() does not give exclusive use of a connection.
+    Connections are instead handed out in round-robin order, and any number
+    of requests can be in flight on each one.  Connections older than
+    "timeout" seconds are retired once their in-flight requests complete,
+    and replaced with new ones.
+    """
+
+    def __init__(self, server, maxsize=None, timeout=60,
+                 reply_timeout=None, prefill=0):
+        self.server = server
+        self.maxsize = maxsize or DEFAULT_CONNECTIONS_PER_SERVER
+        self.timeout = timeout
+        self.reply_timeout = reply_timeout
+        self.num_checkouts = 0
+        self.num_created = 0
+        self.num_recycled = 0
+        self.num_dropped = 0
+        self._connections = [None] * self.maxsize
+        # Maps slot numbers to an Event that is set once the connection
+        # being made for that slot is ready.
+        self._connecting = {}
+        self._next_slot = 0
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        for i in xrange(min(prefill, self.maxsize)):
+            try:
+                self._connections[i] = self._create_connection()
+            except EnvironmentError, err:
+                logger.warn("Failed to prefill connection to %s: %s",
+                            server, err)
+                break
+
+    @contextlib.contextmanager
+    def reserve(self):
+        """Context-manager to obtain a shared connection from the pool.
+
+        There is nothing to give back to the pool when the request is done,
+        since other requests may be using the connection at the same time.
+        """
+        yield self._get_connection()
+
+    def get_stats(self):
+        """Get a dict of statistics about the usage of this pool."""
+        connections = [c for c in self._connections if c is not None]
+        return {
+            "size": len([c for c in connections if c.is_connected()]),
+            "checkouts": self.num_checkouts,
+            "created": self.num_created,
+            "recycled": self.num_recycled,
+            "dropped": self.num_dropped,
+            "pending": sum(len(c._pending) for c in connections),
+        }
+
+    def close(self):
+        """Close all connections in the pool."""
+        with self._lock:
+            for i, connection in enumerate(self._connections):
+                if connection is not None:
+                    connection.disconnect()
+                    self._connections[i] = None
+
+    def _get_connection(self):
+        with self._lock:
+            self.num_checkouts += 1
+            slot = self._next_slot
+            self._next_slot = (slot + 1) % self.maxsize
+            connection = self._connections[slot]
+            if connection is not None:
+                if not connection.is_connected():
+                    self.num_dropped += 1
+                    connection = None
+                elif connection.created + self.timeout <= monotonic():
+                    connection.retire()
+                    self.num_recycled += 1
+                    connection = None
+            if connection is not None:
+                return connection
+            # Don't keep a broken slot around if connecting fails; the next
+            # request to use it will simply try again.
+            self._connections[slot] = None
+            connected = self._connecting.get(slot)
+            is_connecting = connected is None
+            if is_connecting:
+                connected = self._connecting[slot] = threading.Event()
+        # Connect without holding the lock, so that a slow or unreachable
+        # server doesn't hold up requests that could use other slots.
+        # Other requests for this slot wait for the same connection.
+        if not is_connecting:
+            connected.wait()
+            connection = self._connections[slot]
+            if connection is None:
+                raise EnvironmentError("failed to connect to %s"
+                                       % (self.server,))
+            return connection
+        try:
+            connection = self._create_connection()
+            self._connections[slot] = connection
+        finally:
+            with self._lock:
+                del self._connecting[slot]
+            connected.set()
+        return connection
+
+    def _create_connection(self):
+        connect_timeout = self.reply_timeout
+        if connect_timeout is None:
+            connect_timeout = DEFAULT_CONNECT_TIMEOUT
+        connection = PipelinedConnection(self.server, self.reply_timeout,
+                                         connect_timeout)
+        with self._stats_lock:
+            self.num_created += 1
+        return connection
+
+
+class _PendingReply(object):
+    """An in-flight request, waiting for its reply from the server."""
+
+    __slots__ = ("parse_reply", "event", "result", "error", "abandoned")
+
+    def __init__(self, parse_reply):
+        self.parse_reply = parse_reply
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        # Set once the request has timed out, and nobody is waiting for it.
+        self.abandoned = False
+
+
+class PipelinedConnection(object):
+    """A single memcached connection that supports pipelined requests.
+
+    This class provides the subset of the umemcache.Client API that is used
+    by MemcachedClient, with methods returning results in the same format.
+    Any number of threads or greenlets may use it concurrently.  Each request
+    writes its command and then waits for the background reader to parse
+    its reply; since memcached answers requests in order, the reader matches
+    replies with requests by keeping a queue of the pending requests.
+
+    If "timeout" is given, a request that waits longer than that many
+    seconds for its reply raises BackendTimeoutError.  The connection is
+    then retired, since the requests queued behind the slow one would be
+    just as slow; it is closed as soon as every request still pending on
+    it has either received its reply or timed out as well.  Connecting to
+    the server is limited to "connect_timeout" seconds.
+
+    Socket errors cause the connection to be closed, and are raised from
+    every pending request.  An error reply to a single request is raised
+    from that request as a ValueError, and the connection stays open.
+    """
+
+    def __init__(self, server, timeout=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        host, _, port = server.rpartition(":")
+        if not host:
+            host, port = port, DEFAULT_PORT
+        self.server = server
+        self.timeout = timeout
+        self.created = monotonic()
+        self.sock = socket.create_connection((host, int(port)),
+                                             connect_timeout)
+        # The reader blocks until replies arrive; reply timeouts are
+        # handled by the waiting requests instead.
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rfile = self.sock.makefile("rb")
+        self._pending = collections.deque()
+        self._send_lock = threading.Lock()
+        self._error = None
+        self._retiring = False
+        reader = threading.Thread(target=self._read_replies)
+        reader.daemon = True
+        reader.start()
+
+    def is_connected(self):
+        return self._error is None and not self._retiring
+
+    def disconnect(self):
+        self._close(RuntimeError("connection closed"))
+
+    def retire(self):
+        """Close the connection once all pending requests are complete."""
+        with self._send_lock:
+            self._retiring = True
+            if self._is_idle():
+                self._close(RuntimeError("connection retired"))
+
+    def get(self, key):
+        return self._request("get %s\r\n" % (key,), _parse_get).get(key)
+
+    def gets(self, key):
+        return self._request("gets %s\r\n" % (key,), _parse_get).get(key)
+
+    def get_multi(self, keys):
+        if not keys:
+            return {}
+        return self._request("get %s\r\n" % (" ".join(keys),), _parse_get)
+
+    def set(self, key, data, expiration=0, flags=0):
+        return self._store("set", key, data, expiration, flags)
+
+    def add(self, key, data, expiration=0, flags=0):
+        return self._store("add", key, data, expiration, flags)
+
+    def replace(self, key, data, expiration=0, flags=0):
+        return self._store("replace", key, data, expiration, flags)
+
+    def cas(self, key, data, casid, expiration=0, flags=0):
+        command = "cas %s %d %d %d %d\r\n%s\r\n" % (
+            key, flags, expiration, len(data), casid, data,
+        )
+        return self._request(command, _parse_line)
+
+    def delete(self, key):
+        return self._request("delete %s\r\n" % (key,), _parse_line)
+
+    def version(self):
+        return self._request("version\r\n", _parse_line).split(" ", 1)[-1]
+
+    def send_commands(self, commands):
+        """Send raw single-line-reply commands, and return their replies.
+
+        All the commands are written before waiting for any of the replies.
+        """
+        pending = self._send(commands, _parse_line)
+        return [self._wait(reply) for reply in pending]
+
+    def _store(self, command, key, data, expiration, flags):
+        command = "%s %s %d %d %d\r\n%s\r\n" % (
+            command, key, flags, expiration, len(data), data,
+        )
+        return self._request(command, _parse_line)
+
+    def _request(self, command, parse_reply):
+        return self._wait(self._send((command,), parse_reply)[0])
+
+    def _send(self, commands, parse_reply):
+        """Write commands to the socket, queueing a reply for each one.
+
+        The send lock ensures that the order of replies in the queue matches
+        the order of commands written to the socket.
+        """
+        pending = [_PendingReply(parse_reply) for _ in commands]
+        with self._send_lock:
+            if self._error is not None:
+                raise self._error
+            self._pending.extend(pending)
+            try:
+                self.sock.sendall("".join(commands))
+            except EnvironmentError, err:
+                self._close(err)
+                raise
+        return pending
+
+    def _wait(self, reply):
+        if not reply.event.wait(self.timeout):
+            reply.abandoned = True
+            self.retire()
+            raise BackendTimeoutError("timed out waiting for memcached reply",
+                                      server=self.server)
+        if reply.error is not None:
+            raise reply.error
+        return reply.result
+
+    def _read_replies(self):
+        """Loop run by the background reader to dispatch incoming replies."""
+        try:
+            while True:
+                line = self._rfile.readline()
+                if not line.endswith("\r\n"):
+                    raise EnvironmentError("memcached closed the connection")
+                try:
+                    reply = self._pending.popleft()
+                except IndexError:
+                    raise RuntimeError("unexpected reply from memcached")
+                try:
+                    reply.result = reply.parse_reply(line[:-2], self._rfile)
+                except ValueError, err:
+                    # The reply was an error message; only this request
+                    # fails, and the connection remains in sync.  This
+                    # mustn't be a RuntimeError, or MemcachedClient would
+                    # disconnect and count it as a failure of the server.
+                    reply.error = ValueError("memcached error: %s" % (err,))
+                except Exception, err:
+                    # The connection broke partway through the reply.  This
+                    # request is no longer pending, so fail it here before
+                    # closing the connection fails all the others.
+                    reply.error = err
+                    reply.event.set()
+                    raise
+                reply.event.set()
+                if self._retiring:
+                    with self._send_lock:
+                        if self._is_idle():
+                            self._close(RuntimeError("connection retired"))
+                            return
+        except Exception, err:
+            self._close(err)
+
+    def _is_idle(self):
+        """Check whether no request is waiting for a reply.
+
+        This is called with the send lock held, but the reader may still
+        pop replies off the queue, so it looks at a copy.
+        """
+        for reply in list(self._pending):
+            if not reply.abandoned:
+                return False
+        return True
+
+    def _close(self, error):
+        """Close the socket and fail any pending requests with the error."""
+        if self._error is None:
+            self._error = error
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except EnvironmentError:
+                pass
+            self.sock.close()
+        while self._pending:
+            try:
+                reply = self._pending.popleft()
+            except IndexError:
+                break
+            reply.error = self._error
+            reply.event.set()
+
+
+def _parse_line(line, rfile):
+    """Parse a single-line reply, returning it unchanged.
+
+    Error replies are also returned unchanged, since callers only check
+    for the specific reply that indicates success.
+    """
+    return line
+
+
+def _parse_get(line, rfile):
+    """Parse the reply to a "get" or "gets" command.
+
+    This returns a dict mapping keys to (data, flags) tuples for "get",
+    or (data, flags, casid) tuples for "gets".  An error reply raises
+    ValueError, but any other unexpected data raises RuntimeError since
+    we can no longer tell where the reply ends.
+    """
+    items = {}
+    while line != "END":
+        parts = line.split()
+        if not parts or parts[0] != "VALUE":
+            if items:
+                raise RuntimeError("unexpected reply from memcached")
+            raise ValueError(line)
+        key, flags, size = parts[1], int(parts[2]), int(parts[3])
+        data = rfile.read(size + 2)
+        if len(data) != size + 2:
+            raise EnvironmentError("memcached closed the connection")
+        if len(parts) > 4:
+            items[key] = (data[:-2], flags, int(parts[4]))
+        else:
+            items[key] = (data[:-2], flags)
+        line = rfile.readline()
+        if not line.endswith("\r\n"):
+            raise EnvironmentError("memcached closed the connection")
+        line = line[:-2]
+    return items
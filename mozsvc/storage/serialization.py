@@ -0,0 +1,169 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Value serialization and compression for memcached clients.
+
+This module provides a small registry of serializers and compressors for
+values stored in memcached.  Each one is identified by some bits in the
+memcached "flags" word, so that a stored value can always be decoded with
+the codecs that were used to encode it, even if the client configuration
+has since been changed.
+
+The low byte of the flags identifies the serializer:
+
+    * 0: JSON, which is also what was used for all values stored before
+         flags were taken into account.
+    * 1: raw bytes, stored and returned as-is.
+    * 2: msgpack, if the "msgpack" package (>=0.5.2) is installed.
+
+Higher bits identify the compressor, if any:
+
+    * 0x100: zlib
+    * 0x200: lz4, if the "lz4" package is installed.
+
+Additional codecs can be added via register_serializer() and
+register_compressor().
+"""
+
+import zlib
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+
+SERIALIZER_MASK = 0xFF
+
+FLAG_JSON = 0
+FLAG_RAW = 1
+FLAG_MSGPACK = 2
+
+FLAG_ZLIB = 1 << 8
+FLAG_LZ4 = 1 << 9
+
+# Values smaller than this many bytes are never compressed.
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+# Maps names to (flags, dumps, loads) for each serializer.
+_SERIALIZERS = {}
+_SERIALIZERS_BY_FLAG = {}
+
+# Maps names to (flags, compress, decompress) for each compressor.
+_COMPRESSORS = {}
+_COMPRESSORS_BY_FLAG = {}
+
+
+def register_serializer(name, flag, dumps, loads):
+    """Register a serializer under the given name and flag bits.
+
+    The flag must fit within SERIALIZER_MASK.  The "dumps" function must
+    return a bytestring, and "loads" must convert it back into a value.
+    """
+    if flag & ~SERIALIZER_MASK:
+        raise ValueError("serializer flag out of range: %r" % (flag,))
+    if flag in _SERIALIZERS_BY_FLAG:
+        raise ValueError("serializer flag already in use: %r" % (flag,))
+    _SERIALIZERS[name] = _SERIALIZERS_BY_FLAG[flag] = (flag, dumps, loads)
+
+
+def register_compressor(name, flag, compress, decompress):
+    """Register a compressor under the given name and flag bit.
+
+    The flag must be a single bit outside of SERIALIZER_MASK.
+    """
+    if flag & SERIALIZER_MASK or flag & (flag - 1):
+        raise ValueError("compressor flag must be a single high bit")
+    if flag in _COMPRESSORS_BY_FLAG:
+        raise ValueError("compressor flag already in use: %r" % (flag,))
+    _COMPRESSORS[name] = _COMPRESSORS_BY_FLAG[flag] = (flag, compress,
+                                                       decompress)
+
+
+def _dump_raw(value):
+    if not isinstance(value, str):
+        raise ValueError("raw serializer requires bytestring values")
+    return value
+
+
+def _load_raw(data):
+    return data
+
+
+register_serializer("json", FLAG_JSON, json.dumps, json.loads)
+register_serializer("raw", FLAG_RAW, _dump_raw, _load_raw)
+if msgpack is not None:
+    register_serializer("msgpack", FLAG_MSGPACK,
+                        lambda value: msgpack.packb(value, use_bin_type=True),
+                        lambda data: msgpack.unpackb(data, raw=False))
+
+register_compressor("zlib", FLAG_ZLIB, zlib.compress, zlib.decompress)
+if lz4_block is not None:
+    register_compressor("lz4", FLAG_LZ4, lz4_block.compress,
+                        lz4_block.decompress)
+
+
+class ValueCodec(object):
+    """Encoder/decoder for values stored in memcached.
+
+    Instances of this class encode values using a fixed serializer and
+    optional compressor, chosen by name from the registry.  Values whose
+    serialized form is at least "compress_threshold" bytes are compressed,
+    as long as that actually makes them smaller.
+
+    Decoding always uses the codecs identified by the stored flags, so
+    values written with a different configuration can still be read.
+    """
+
+    def __init__(self, serializer="json", compressor=None,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+        try:
+            self._serializer = _SERIALIZERS[serializer]
+        except KeyError:
+            raise ValueError("unknown serializer: %r" % (serializer,))
+        if compressor is None:
+            self._compressor = None
+        else:
+            try:
+                self._compressor = _COMPRESSORS[compressor]
+            except KeyError:
+                raise ValueError("unknown compressor: %r" % (compressor,))
+        self.compress_threshold = compress_threshold
+
+    def encode(self, value):
+        """Encode a value, returning the data and flags to store."""
+        flags, dumps, _ = self._serializer
+        data = dumps(value)
+        if self._compressor is not None:
+            if len(data) >= self.compress_threshold:
+                compress_flag, compress, _ = self._compressor
+                compressed_data = compress(data)
+                if len(compressed_data) < len(data):
+                    data = compressed_data
+                    flags |= compress_flag
+        return data, flags
+
+    def decode(self, data, flags):
+        """Decode stored data back into a value, according to its flags."""
+        compress_flags = flags & ~SERIALIZER_MASK
+        if compress_flags:
+            try:
+                _, _, decompress = _COMPRESSORS_BY_FLAG[compress_flags]
+            except KeyError:
+                raise ValueError("unknown compression flags: %r" % (flags,))
+            data = decompress(data)
+        try:
+            _, _, loads = _SERIALIZERS_BY_FLAG[flags & SERIALIZER_MASK]
+        except KeyError:
+            raise ValueError("unknown serialization flags: %r" % (flags,))
+        return loads(data)
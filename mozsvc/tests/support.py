@@ -4,8 +4,11 @@
 
 import os
 import sys
+import time
 import unittest2
 import urlparse
+import threading
+import SocketServer
 
 from pyramid.request import Request
 from pyramid.interfaces import IRequestFactory
@@ -128,3 +131,183 @@ class FunctionalTestCase(TestCase):
             "REMOTE_ADDR": "127.0.0.1",
             "SCRIPT_NAME": host_url.path,
         })
+
+
+class StubMemcachedServer(SocketServer.ThreadingMixIn,
+                          SocketServer.TCPServer):
+    """In-process stand-in for a memcached server, for use in tests.
+
+    This class implements enough of the memcached text protocol to exercise
+    the client code, storing items in a simple dict.  It listens on a random
+    local port; use the "address" attribute to connect to it.  Call start()
+    to begin serving requests in a background thread, and stop() to shut it
+    down and close any open client connections.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0),
+                                        StubMemcachedHandler)
+        self.address = "%s:%d" % self.server_address
+        self.items = {}
+        self.lock = threading.Lock()
+        self.next_casid = 1
+        self.num_connections = 0
+        self.num_commands = 0
+        self._handlers = []
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  kwargs={"poll_interval": 0.01})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        """Forcibly close all currently-open client connections."""
+        for handler in self._handlers:
+            handler.close()
+
+    def get_item(self, key):
+        """Get the (data, flags, expiry, casid) tuple for a live item."""
+        item = self.items.get(key)
+        if item is not None and item[2] and item[2] <= time.time():
+            del self.items[key]
+            item = None
+        return item
+
+    def put_item(self, key, data, flags, expiry):
+        expiry = int(expiry)
+        if expiry < 0:
+            self.items.pop(key, None)
+            return
+        if expiry:
+            expiry += time.time()
+        self.items[key] = (data, int(flags), expiry, self.next_casid)
+        self.next_casid += 1
+
+
+class StubMemcachedHandler(SocketServer.StreamRequestHandler):
+    """Connection handler for StubMemcachedServer."""
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.server.num_connections += 1
+        self.server._handlers.append(self)
+
+    def close(self):
+        try:
+            self.connection.shutdown(2)
+        except EnvironmentError:
+            pass
+
+    def handle(self):
+        while True:
+            try:
+                line = self.rfile.readline()
+            except EnvironmentError:
+                return
+            if not line:
+                return
+            args = line.split()
+            self.server.num_commands += 1
+            handler = getattr(self, "do_" + (args or ["-"])[0], None)
+            if handler is None:
+                reply = "ERROR"
+            else:
+                noreply = (args[-1] == "noreply")
+                if noreply:
+                    args = args[:-1]
+                with self.server.lock:
+                    reply = handler(*args[1:])
+                if noreply:
+                    continue
+            try:
+                self.wfile.write(reply + "\r\n")
+                self.wfile.flush()
+            except EnvironmentError:
+                return
+
+    def do_get(self, *keys, **kwds):
+        lines = []
+        for key in keys:
+            item = self.server.get_item(key)
+            if item is not None:
+                header = "VALUE %s %d %d" % (key, item[1], len(item[0]))
+                if kwds.get("with_casid"):
+                    header += " %d" % (item[3],)
+                lines.extend((header, item[0]))
+        lines.append("END")
+        return "\r\n".join(lines)
+
+    def do_gets(self, *keys):
+        return self.do_get(with_casid=True, *keys)
+
+    def _read_data(self, size):
+        return self.rfile.read(int(size) + 2)[:-2]
+
+    def do_set(self, key, flags, expiry, size):
+        self.server.put_item(key, self._read_data(size), flags, expiry)
+        return "STORED"
+
+    def do_add(self, key, flags, expiry, size):
+        data = self._read_data(size)
+        if self.server.get_item(key) is not None:
+            return "NOT_STORED"
+        self.server.put_item(key, data, flags, expiry)
+        return "STORED"
+
+    def do_replace(self, key, flags, expiry, size):
+        data = self._read_data(size)
+        if self.server.get_item(key) is None:
+            return "NOT_STORED"
+        self.server.put_item(key, data, flags, expiry)
+        return "STORED"
+
+    def do_cas(self, key, flags, expiry, size, casid):
+        data = self._read_data(size)
+        item = self.server.get_item(key)
+        if item is None:
+            return "NOT_FOUND"
+        if item[3] != int(casid):
+            return "EXISTS"
+        self.server.put_item(key, data, flags, expiry)
+        return "STORED"
+
+    def do_delete(self, key):
+        if self.server.get_item(key) is None:
+            return "NOT_FOUND"
+        del self.server.items[key]
+        return "DELETED"
+
+    def do_incr(self, key, delta, sign=1):
+        item = self.server.get_item(key)
+        if item is None:
+            return "NOT_FOUND"
+        if not item[0].isdigit():
+            return "CLIENT_ERROR cannot increment or decrement " \
+                   "non-numeric value"
+        value = max(int(item[0]) + sign * int(delta), 0) % (2 ** 64)
+        self.server.items[key] = (str(value), item[1], item[2],
+                                  self.server.next_casid)
+        self.server.next_casid += 1
+        return str(value)
+
+    def do_decr(self, key, delta):
+        return self.do_incr(key, delta, sign=-1)
+
+    def do_touch(self, key, expiry):
+        item = self.server.get_item(key)
+        if item is None:
+            return "NOT_FOUND"
+        self.server.put_item(key, item[0], item[1], expiry)
+        return "TOUCHED"
+
+    def do_version(self):
+        return "VERSION 0.0.0-stub"
@@ -1,12 +1,21 @@
 
 import os
+import sys
 import json
+import time
+import random
+import shutil
 import logging
+import logging.handlers
+import tempfile
 import unittest2
+from StringIO import StringIO
+from datetime import datetime
 
 from testfixtures import LogCapture
 
-from mozsvc.util import JsonLogFormatter
+from mozsvc.util import (JsonLogFormatter, FastJsonLogFormatter,
+                         AsyncLogHandler)
 
 
 class TestJsonLogFormatter(unittest2.TestCase):
@@ -54,3 +63,172 @@ class TestJsonLogFormatter(unittest2.TestCase):
         tblines = details["traceback"].strip().split("\n")
         self.assertEquals(tblines[-1], details["error"])
         self.assertEquals(tblines[-2], "<type 'exceptions.ValueError'>")
+
+
+class TestFastJsonLogFormatter(TestJsonLogFormatter):
+
+    def setUp(self):
+        super(TestFastJsonLogFormatter, self).setUp()
+        self.formatter = FastJsonLogFormatter()
+
+    def test_output_matches_slow_formatter(self):
+        slow_formatter = JsonLogFormatter()
+        logger = logging.getLogger("mozsvc.test.test_logging")
+        logger.info("no extras")
+        logger.info("{\"a\": \"json blob\"}")
+        logger.info("with extras", extra={"code": 200, "ids": [1, 2],
+                                          "ratio": 1.0 / 3, "big": 2 ** 70})
+        logger.info("custom pid", extra={"pid": 42})
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            logger.exception("with an error")
+        self.assertEquals(len(self.handler.records), 5)
+        for record in self.handler.records:
+            self.assertEquals(json.loads(self.formatter.format(record)),
+                              json.loads(slow_formatter.format(record)))
+
+    def test_timestamps_match_isoformat(self):
+        for created in (0, 1.5, 1792222714.686102, 1792222714.9999996,
+                        1792222715.0000004, 1792222715.123456):
+            expected = datetime.utcfromtimestamp(created).isoformat() + "Z"
+            self.assertEquals(self.formatter._format_time(created), expected)
+        rand = random.Random(42)
+        for _ in xrange(1000):
+            created = rand.uniform(0, 2000000000)
+            expected = datetime.utcfromtimestamp(created).isoformat() + "Z"
+            self.assertEquals(self.formatter._format_time(created), expected)
+
+
+class CountingStringIO(StringIO):
+
+    num_writes = 0
+
+    def write(self, data):
+        self.num_writes += 1
+        StringIO.write(self, data)
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestAsyncLogHandler(unittest2.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger("mozsvc.test.test_async_logging")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.handlers = []
+        self.logger.propagate = True
+
+    def test_records_are_written_to_streams_in_batches(self):
+        stream = CountingStringIO()
+        target = logging.StreamHandler(stream)
+        target.setFormatter(JsonLogFormatter())
+        handler = AsyncLogHandler(target, poll_interval=0.2)
+        self.logger.addHandler(handler)
+        for i in xrange(5):
+            self.logger.info("message %d", i)
+        # Nothing is written by the logging thread itself.
+        self.assertEquals(stream.getvalue(), "")
+        handler.close()
+        lines = stream.getvalue().splitlines()
+        self.assertEquals([json.loads(line)["message"] for line in lines],
+                          ["message %d" % (i,) for i in xrange(5)])
+        self.assertEquals(stream.num_writes, 1)
+        self.assertEquals(handler.num_dropped, 0)
+
+    def test_records_are_written_by_the_background_thread(self):
+        target = ListHandler()
+        handler = AsyncLogHandler(target, poll_interval=0.01)
+        self.addCleanup(handler.close)
+        self.logger.addHandler(handler)
+        self.logger.info("hello")
+        for _ in xrange(100):
+            if target.records:
+                break
+            time.sleep(0.01)
+        self.assertEquals([r.getMessage() for r in target.records],
+                          ["hello"])
+
+    def test_oldest_records_are_dropped_when_queue_is_full(self):
+        target = ListHandler()
+        handler = AsyncLogHandler(target, max_queue_size=3, batch_size=2,
+                                  poll_interval=0.2)
+        self.logger.addHandler(handler)
+        for i in xrange(5):
+            self.logger.info("message %d", i)
+        self.assertEquals(handler.num_dropped, 2)
+        handler.close()
+        self.assertEquals([r.getMessage() for r in target.records],
+                          ["message 2", "message 3", "message 4"])
+
+    def test_records_are_rendered_before_they_are_queued(self):
+        target = ListHandler()
+        handler = AsyncLogHandler(target, poll_interval=0.2)
+        self.logger.addHandler(handler)
+        items = ["one"]
+        self.logger.info("items: %s", items)
+        items.append("two")
+        try:
+            raise ValueError("oops")
+        except ValueError:
+            self.logger.exception("failed")
+            exc_info = sys.exc_info()
+        handler.close()
+        self.assertEquals(len(target.records), 2)
+        record = target.records[0]
+        self.assertEquals(record.getMessage(), "items: ['one']")
+        self.assertEquals(record.args, None)
+        # The exception is rendered for both plain and JSON formatters.
+        record = target.records[1]
+        self.assertEquals(record.exc_info, None)
+        self.assertTrue("ValueError: oops" in record.exc_text)
+        formatted = logging.Formatter().format(record)
+        self.assertTrue("ValueError: oops" in formatted)
+        details = json.loads(JsonLogFormatter().format(record))
+        self.assertEquals(details["error"], repr(exc_info[1]))
+        self.assertTrue("ValueError" in details["traceback"])
+
+    def test_unicode_records_are_encoded_one_at_a_time(self):
+        stream = CountingStringIO()
+        target = logging.StreamHandler(stream)
+        handler = AsyncLogHandler(target, poll_interval=0.2)
+        self.logger.addHandler(handler)
+        self.logger.info("plain \xc3\xa9")
+        self.logger.info(u"unicode \xe9")
+        self.logger.info("mixed %s", u"\xe9")
+        handler.close()
+        self.assertEquals(stream.getvalue().splitlines(),
+                          ["plain \xc3\xa9", "unicode \xc3\xa9",
+                           "mixed \xc3\xa9"])
+        self.assertEquals(stream.num_writes, 1)
+
+    def test_rotating_file_handlers_still_rotate(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, "test.log")
+        target = logging.handlers.RotatingFileHandler(path, maxBytes=100,
+                                                      backupCount=10)
+        handler = AsyncLogHandler(target, poll_interval=0.2)
+        self.logger.addHandler(handler)
+        for i in xrange(20):
+            self.logger.info("message %02d", i)
+        handler.close()
+        self.assertTrue(len(os.listdir(tempdir)) > 1)
+        lines = []
+        for filename in sorted(os.listdir(tempdir), reverse=True):
+            with open(os.path.join(tempdir, filename)) as f:
+                data = f.read()
+            self.assertTrue(len(data) <= 100)
+            lines.extend(data.splitlines())
+        self.assertEquals(lines, ["message %02d" % (i,) for i in xrange(20)])
@@ -0,0 +1,711 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import threading
+import unittest2
+
+import pyramid.testing
+from pyramid.request import Request
+from testfixtures import LogCapture
+
+from mozsvc.exceptions import BackendError, BackendTimeoutError
+from mozsvc.metrics import initialize_request_metrics
+from mozsvc.tests.support import StubMemcachedServer
+
+try:
+    from mozsvc.storage.mcclient import (MemcachedClient, MCClientPool,
+                                         ConsistentHashRing,
+                                         CounterAccumulator, CircuitBreaker)
+    # We'll test for a live memcached server when we actually run the tests.
+    MEMCACHED = None
+except ImportError:
+    MEMCACHED = False
+
+
+class TestConsistentHashRing(unittest2.TestCase):
+
+    def setUp(self):
+        if MEMCACHED is False:
+            raise unittest2.SkipTest("no umemcache")
+
+    def test_keys_map_consistently_to_nodes(self):
+        ring = ConsistentHashRing(["one", "two", "three"])
+        ring2 = ConsistentHashRing(["three", "one", "two"])
+        for i in xrange(100):
+            key = "key%d" % (i,)
+            self.assertEquals(ring.get_node(key), ring.get_node(key))
+            self.assertEquals(ring.get_node(key), ring2.get_node(key))
+
+    def test_keys_are_spread_across_all_nodes(self):
+        nodes = ["10.0.0.%d:11211" % (i,) for i in xrange(4)]
+        ring = ConsistentHashRing(nodes)
+        counts = dict((node, 0) for node in nodes)
+        for i in xrange(10000):
+            counts[ring.get_node("key%d" % (i,))] += 1
+        for count in counts.itervalues():
+            self.assertTrue(1500 < count < 3500, counts)
+
+    def test_adding_a_node_remaps_only_a_few_keys(self):
+        nodes = ["10.0.0.%d:11211" % (i,) for i in xrange(4)]
+        ring = ConsistentHashRing(nodes)
+        keys = ["key%d" % (i,) for i in xrange(10000)]
+        before = dict((key, ring.get_node(key)) for key in keys)
+        ring.add_node("10.0.0.99:11211")
+        moved = [key for key in keys if ring.get_node(key) != before[key]]
+        # Roughly one fifth of the keys should move, all to the new node.
+        self.assertTrue(1000 < len(moved) < 3000, len(moved))
+        for key in moved:
+            self.assertEquals(ring.get_node(key), "10.0.0.99:11211")
+        # Removing it again restores the original mapping.
+        ring.remove_node("10.0.0.99:11211")
+        for key in keys:
+            self.assertEquals(ring.get_node(key), before[key])
+
+    def test_empty_ring_raises_error(self):
+        ring = ConsistentHashRing()
+        self.assertRaises(ValueError, ring.get_node, "key")
+        ring.add_node("one")
+        self.assertRaises(ValueError, ring.add_node, "one")
+        self.assertEquals(ring.get_node("key"), "one")
+
+    def test_replica_nodes_are_distinct_and_start_with_primary(self):
+        nodes = ["10.0.0.%d:11211" % (i,) for i in xrange(4)]
+        ring = ConsistentHashRing(nodes)
+        for i in xrange(100):
+            key = "key%d" % (i,)
+            replicas = ring.get_nodes(key, 3)
+            self.assertEquals(len(set(replicas)), 3)
+            self.assertEquals(replicas[0], ring.get_node(key))
+            self.assertEquals(ring.get_nodes(key, 2), replicas[:2])
+            self.assertEquals(sorted(ring.get_nodes(key, 10)), sorted(nodes))
+
+
+class TestCircuitBreaker(unittest2.TestCase):
+
+    def setUp(self):
+        if MEMCACHED is False:
+            raise unittest2.SkipTest("no umemcache")
+        self.now = 1000
+        self.breaker = CircuitBreaker(threshold=3, timeout=10,
+                                      get_time=lambda: self.now)
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = self.breaker
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+    def test_half_open_allows_a_single_probe(self):
+        breaker = self.breaker
+        for _ in xrange(3):
+            breaker.record_failure()
+        self.now += 10
+        self.assertEquals(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        # A failed probe re-opens the breaker for another timeout period.
+        breaker.record_failure()
+        self.assertEquals(breaker.state, CircuitBreaker.OPEN)
+        self.now += 10
+        self.assertTrue(breaker.allow_request())
+        # An abandoned probe is eventually replaced by another one.
+        self.now += 10
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        self.assertEquals(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow_request())
+        self.assertTrue(breaker.allow_request())
+
+
+class TestMemcachedClient(unittest2.TestCase):
+
+    def setUp(self):
+        global MEMCACHED
+        if MEMCACHED is None:
+            try:
+                MemcachedClient().get("")
+            except (ImportError, BackendError):
+                MEMCACHED = False
+            else:
+                MEMCACHED = True
+        if not MEMCACHED:
+            raise unittest2.SkipTest("no memcache")
+        self.clients = []
+        self.keys_to_delete = set()
+
+    def tearDown(self):
+        for client in self.clients:
+            for key in self.keys_to_delete:
+                client.delete(key)
+
+    def make_client(self, *args, **kwds):
+        client = MemcachedClient(*args, **kwds)
+        self.clients.append(client)
+        return client
+
+    def test_basic_operation(self):
+        client = self.make_client(key_prefix="mozsvc-test:")
+        self.keys_to_delete.update(("one", "two"))
+        self.assertEquals(client.get("one"), None)
+        self.assertTrue(client.set("one", {"hello": "world"}))
+        self.assertEquals(client.get("one"), {"hello": "world"})
+        self.assertFalse(client.add("one", 1))
+        self.assertTrue(client.add("two", 2))
+        self.assertEquals(client.get_multi(["one", "two", "three"]),
+                          {"one": {"hello": "world"}, "two": 2})
+        self.assertTrue(client.delete("one"))
+        self.assertFalse(client.delete("one"))
+
+    def test_sharding_across_multiple_servers(self):
+        # Use two different names for the same server, so that we can
+        # exercise the sharding logic against a single memcached.
+        servers = ["127.0.0.1:11211", "localhost:11211"]
+        client = self.make_client(servers, key_prefix="mozsvc-test:")
+        self.assertEquals(len(client.pools), 2)
+        keys = ["key%d" % (i,) for i in xrange(20)]
+        self.keys_to_delete.update(keys)
+        pools = set()
+        for i, key in enumerate(keys):
+            self.assertTrue(client.set(key, i))
+            pools.add(client._get_pool(client._encode_key(key)))
+        self.assertEquals(len(pools), 2)
+        items = client.get_multi(keys)
+        self.assertEquals(items, dict((key, i) for i, key in enumerate(keys)))
+
+    def test_servers_can_be_given_as_a_string(self):
+        client = self.make_client("127.0.0.1:11211 localhost:11211")
+        self.assertEquals(client.servers, ["127.0.0.1:11211",
+                                           "localhost:11211"])
+        client = self.make_client(servers="127.0.0.1:11211")
+        self.assertEquals(client.servers, ["127.0.0.1:11211"])
+        self.assertTrue(client.ring is None)
+        self.assertRaises(ValueError, MemcachedClient,
+                          "127.0.0.1:11211", servers="127.0.0.1:11211")
+
+    def test_multi_key_writes(self):
+        client = self.make_client(key_prefix="mozsvc-test:")
+        keys = ["key%d" % (i,) for i in xrange(10)]
+        self.keys_to_delete.update(keys)
+        self.assertTrue(client.set("key0", "existing"))
+        items = dict((key, i) for i, key in enumerate(keys))
+        # add_multi only stores the keys that don't already exist.
+        res = client.add_multi(items)
+        self.assertEquals(res, dict((key, key != "key0") for key in keys))
+        self.assertEquals(client.get("key0"), "existing")
+        self.assertEquals(client.get("key1"), 1)
+        # set_multi stores all of them.
+        res = client.set_multi(items)
+        self.assertEquals(res, dict((key, True) for key in keys))
+        self.assertEquals(client.get_multi(keys), items)
+        # delete_multi reports which keys were actually deleted.
+        res = client.delete_multi(keys[:5] + ["missing"])
+        self.assertEquals(res["missing"], False)
+        self.assertEquals(sum(res.values()), 5)
+        remaining = dict((key, items[key]) for key in keys[5:])
+        self.assertEquals(client.get_multi(keys), remaining)
+        # The connection is still usable for normal requests.
+        self.assertEquals(client.get("key9"), 9)
+
+    def test_multi_key_writes_across_multiple_servers(self):
+        servers = ["127.0.0.1:11211", "localhost:11211"]
+        client = self.make_client(servers, key_prefix="mozsvc-test:")
+        keys = ["key%d" % (i,) for i in xrange(2500)]
+        self.keys_to_delete.update(keys)
+        items = dict((key, i) for i, key in enumerate(keys))
+        self.assertTrue(all(client.set_multi(items).values()))
+        self.assertEquals(client.get_multi(keys), items)
+        self.assertTrue(all(client.delete_multi(keys).values()))
+        self.assertEquals(client.get_multi(keys), {})
+
+    def test_local_cache(self):
+        client = self.make_client(key_prefix="mozsvc-test:",
+                                  local_cache_size=10)
+        other_client = self.make_client(key_prefix="mozsvc-test:")
+        self.keys_to_delete.update(("one", "two"))
+        self.assertTrue(client.set("one", [1]))
+        self.assertEquals(client.get("one"), [1])
+        self.assertEquals(client.local_cache.misses, 1)
+        # Subsequent reads are served from the local cache, so they don't
+        # see changes made by other clients.
+        self.assertTrue(other_client.set("one", [2]))
+        value = client.get("one")
+        self.assertEquals(value, [1])
+        self.assertEquals(client.local_cache.hits, 1)
+        # Each read gets its own copy of the value.
+        value.append(3)
+        self.assertEquals(client.get("one"), [1])
+        self.assertEquals(client.get_multi(["one"]), {"one": [1]})
+        self.assertEquals(client.local_cache.hits, 3)
+        # Writes through the client invalidate the local cache.
+        self.assertTrue(client.set("two", 2))
+        self.assertEquals(client.get_multi(["one", "two"]),
+                          {"one": [1], "two": 2})
+        self.assertTrue(client.delete("one"))
+        self.assertEquals(client.get("one"), None)
+        self.assertTrue(client.add("one", 1))
+        self.assertEquals(client.get("one"), 1)
+        self.assertTrue(client.set_multi({"one": 11, "two": 22})["one"])
+        self.assertEquals(client.get_multi(["one", "two"]),
+                          {"one": 11, "two": 22})
+        self.assertTrue(client.delete_multi(["one"])["one"])
+        self.assertEquals(client.get("one"), None)
+
+    def test_local_cache_expiry(self):
+        client = self.make_client(key_prefix="mozsvc-test:",
+                                  local_cache_size=10)
+        other_client = self.make_client(key_prefix="mozsvc-test:")
+        self.keys_to_delete.add("one")
+        now = [1000]
+        client.local_cache.get_time = lambda: now[0]
+        self.assertTrue(client.set("one", 1))
+        self.assertEquals(client.get("one"), 1)
+        self.assertTrue(other_client.set("one", 2))
+        self.assertEquals(client.get("one"), 1)
+        now[0] += client.local_cache.ttl
+        self.assertEquals(client.get("one"), 2)
+
+    def test_custom_serialization_and_compression(self):
+        client = self.make_client(key_prefix="mozsvc-test:",
+                                  compressor="zlib", compress_threshold=100)
+        raw_client = self.make_client(key_prefix="mozsvc-test:",
+                                      serializer="raw")
+        self.keys_to_delete.update(("one", "two", "three"))
+        self.assertTrue(client.set("one", "x" * 1000))
+        self.assertTrue(raw_client.set("two", "\x00\x01\x02"))
+        self.assertTrue(client.set("three", [1, 2, 3]))
+        # Each client can read values written by the other.
+        self.assertEquals(raw_client.get("one"), "x" * 1000)
+        self.assertEquals(client.get("two"), "\x00\x01\x02")
+        self.assertEquals(raw_client.get_multi(["one", "two", "three"]), {
+            "one": "x" * 1000,
+            "two": "\x00\x01\x02",
+            "three": [1, 2, 3],
+        })
+
+    def test_counters(self):
+        client = self.make_client(key_prefix="mozsvc-test:",
+                                  local_cache_size=10)
+        self.keys_to_delete.update(("one", "two", "three"))
+        self.assertEquals(client.incr("one"), None)
+        self.assertEquals(client.incr("one", 5, initial=0), 5)
+        self.assertEquals(client.incr("one", 2, initial=0), 7)
+        self.assertEquals(client.decr("one", 3), 4)
+        self.assertEquals(client.decr("one", 10), 0)
+        # Counters read back as integers, and aren't stale in local cache.
+        self.assertEquals(client.get("one"), 0)
+        self.assertEquals(client.incr("one"), 1)
+        self.assertEquals(client.get("one"), 1)
+        self.assertEquals(client.incr_multi({"one": 2, "two": -1}),
+                          {"one": 3, "two": None})
+        self.assertEquals(client.incr_multi({"one": 2, "two": -1},
+                                            initial=10),
+                          {"one": 5, "two": 9})
+        # Only numeric values can be incremented.
+        self.assertTrue(client.set("three", "three"))
+        self.assertRaises(ValueError, client.incr, "three")
+        self.assertEquals(client.incr("one"), 6)
+
+    def test_touch(self):
+        client = self.make_client(key_prefix="mozsvc-test:")
+        self.keys_to_delete.add("one")
+        self.assertFalse(client.touch("one", 1))
+        self.assertTrue(client.set("one", 1))
+        self.assertTrue(client.touch("one", -1))
+        self.assertEquals(client.get("one"), None)
+
+    def test_counter_accumulator(self):
+        client = self.make_client(key_prefix="mozsvc-test:")
+        self.keys_to_delete.update(("one", "two"))
+        counters = CounterAccumulator(client)
+        for _ in xrange(10):
+            counters.incr("one")
+        counters.decr("one", 3)
+        counters.incr("two")
+        counters.decr("two")
+        self.assertEquals(counters.get_pending("one"), 7)
+        self.assertEquals(client.get("one"), None)
+        # Only counters with a non-zero change are sent.
+        self.assertEquals(counters.flush(), {"one": 7})
+        self.assertEquals(counters.get_pending("one"), 0)
+        self.assertEquals(client.get("one"), 7)
+        self.assertEquals(client.get("two"), None)
+        self.assertEquals(counters.flush(), {})
+        # Updates are kept if they can't be sent.
+        counters.incr("one", 2)
+        counters.client = MemcachedClient("127.0.0.1:1",
+                                          key_prefix="mozsvc-test:")
+        with LogCapture():
+            self.assertRaises(BackendError, counters.flush)
+        counters.client = client
+        self.assertEquals(counters.get_pending("one"), 2)
+        # They can be flushed in the background.
+        counters.start(0.01)
+        try:
+            for _ in xrange(100):
+                if client.get("one") == 9:
+                    break
+                time.sleep(0.01)
+            self.assertEquals(client.get("one"), 9)
+            self.assertRaises(RuntimeError, counters.start, 0.01)
+            counters.incr("one")
+        finally:
+            counters.stop()
+        self.assertEquals(client.get("one"), 10)
+
+    def test_get_or_compute(self):
+        client = self.make_client(key_prefix="mozsvc-test:")
+        self.keys_to_delete.update(("one", "one:lease"))
+        calls = []
+
+        def compute():
+            calls.append(None)
+            return len(calls)
+
+        self.assertEquals(client.get_or_compute("one", compute, ttl=10), 1)
+        self.assertEquals(client.get_or_compute("one", compute, ttl=10), 1)
+        self.assertEquals(len(calls), 1)
+        # The lease is released once the value has been stored.
+        self.assertEquals(client.get("one:lease"), None)
+        # Once the value goes stale it is recomputed.
+        value, expires, delta = client.get("one")
+        self.assertTrue(client.set("one", [value, time.time() - 1, delta]))
+        self.assertEquals(client.get_or_compute("one", compute, ttl=10), 2)
+        # The lease is released even if the computation fails.
+        self.assertTrue(client.delete("one"))
+        self.assertRaises(ZeroDivisionError, client.get_or_compute,
+                          "one", lambda: 1 / 0)
+        self.assertEquals(client.get("one:lease"), None)
+
+    def test_get_or_compute_while_lease_is_held(self):
+        client = self.make_client(key_prefix="mozsvc-test:")
+        self.keys_to_delete.update(("one", "one:lease"))
+        self.assertTrue(client.add("one:lease", True))
+        # With a stale copy available, it is served without recomputing.
+        self.assertTrue(client.set("one", ["old", time.time() - 1, 0]))
+        self.assertEquals(client.get_or_compute("one", lambda: "new"), "old")
+        # Without one, we wait for the lease holder to store a value...
+        self.assertTrue(client.delete("one"))
+        timer = threading.Timer(0.1, client.set, ("one", ["new", None, 0]))
+        timer.start()
+        try:
+            self.assertEquals(client.get_or_compute("one", lambda: "oops"),
+                              "new")
+        finally:
+            timer.join()
+        # ...and eventually give up and compute it without storing it.
+        self.assertTrue(client.delete("one"))
+        self.assertEquals(client.get_or_compute("one", lambda: "mine",
+                                                wait_time=0.1), "mine")
+        self.assertEquals(client.get("one"), None)
+
+    def test_get_or_compute_early_refresh(self):
+        client = self.make_client(key_prefix="mozsvc-test:")
+        self.keys_to_delete.update(("one", "one:lease"))
+        # A value that is about to expire and took a long time to compute
+        # will almost certainly be refreshed early, unless beta is zero.
+        entry = ["old", time.time() + 1, 1000000]
+        self.assertTrue(client.set("one", entry))
+        self.assertEquals(client.get_or_compute("one", lambda: "new",
+                                                ttl=10, beta=0), "old")
+        self.assertEquals(client.get_or_compute("one", lambda: "new",
+                                                ttl=10), "new")
+
+    def test_pool_stats(self):
+        client = self.make_client(pool_size=2, pool_timeout=60)
+        pool = client.pool
+        with pool.reserve() as mc1:
+            with pool.reserve() as mc2:
+                self.assertTrue(mc1 is not mc2)
+        self.assertEquals(client.get("mozsvc-test:missing"), None)
+        stats = client.get_pool_stats()["127.0.0.1:11211"]
+        self.assertEquals(stats["size"], 2)
+        self.assertEquals(stats["checkouts"], 3)
+        self.assertEquals(stats["created"], 2)
+        self.assertEquals(stats["recycled"], 0)
+        self.assertEquals(stats["dropped"], 0)
+        self.assertEquals(sum(stats["wait_time_histogram"].values()), 3)
+        self.assertTrue(stats["max_wait_time"] <= stats["total_wait_time"])
+        # Expired connections are counted as recycled, both when checked
+        # out and when checked back in.
+        pool.timeout = -1
+        self.assertEquals(client.get("mozsvc-test:missing"), None)
+        stats = pool.get_stats()
+        self.assertEquals(stats["recycled"], 3)
+        self.assertEquals(stats["created"], 3)
+        pool.timeout = 60
+        # Connections broken by errors are counted as dropped, and their
+        # slot in the pool gets replaced.
+        with pool.reserve() as mc:
+            mc.disconnect()
+        stats = pool.get_stats()
+        self.assertEquals(stats["dropped"], 1)
+        self.assertEquals(stats["size"], 0)
+        self.assertEquals(pool.clients.qsize(), 2)
+
+    def test_pool_wait_time_can_be_added_to_request_metrics(self):
+        client = self.make_client(pool_metrics=True)
+        request = Request.blank("/")
+        initialize_request_metrics(request)
+        with pyramid.testing.testConfig(request=request):
+            client.get("mozsvc-test:missing")
+            client.get("mozsvc-test:missing")
+        self.assertTrue(request.metrics["mcclient.pool_wait"] > 0)
+        stats = client.pool.get_stats()
+        self.assertTrue(request.metrics["mcclient.pool_wait"] <=
+                        stats["total_wait_time"])
+
+    def test_pool_checkout_timeout(self):
+        client = self.make_client(pool_size=1, pool_checkout_timeout=0.01)
+        with client.pool.reserve():
+            with self.assertRaises(BackendTimeoutError):
+                with client.pool.reserve():
+                    pass
+            self.assertRaises(BackendTimeoutError,
+                              client.get, "mozsvc-test:missing")
+        # Once the connection is returned, it can be used again.
+        self.assertEquals(client.get("mozsvc-test:missing"), None)
+        stats = client.pool.get_stats()
+        self.assertEquals(stats["created"], 1)
+        self.assertEquals(stats["size"], 1)
+        self.assertTrue(stats["max_wait_time"] >= 0.01)
+
+    def test_pool_prefill(self):
+        client = self.make_client(pool_size=3, pool_prefill=2)
+        stats = client.pool.get_stats()
+        self.assertEquals(stats["created"], 2)
+        self.assertEquals(stats["size"], 2)
+        self.assertEquals(client.pool.clients.qsize(), 3)
+        with client.pool.reserve() as mc:
+            self.assertTrue(mc is not None)
+            self.assertEquals(client.pool.get_stats()["created"], 2)
+        # Prefill failures are not fatal, and don't leak empty slots.
+        with LogCapture() as logs:
+            pool = MCClientPool("127.0.0.1:1", maxsize=3, prefill=2)
+        self.assertEquals(len(logs.records), 1)
+        stats = pool.get_stats()
+        self.assertEquals(stats["created"], 0)
+        self.assertEquals(stats["size"], 0)
+        self.assertEquals(pool.clients.qsize(), 3)
+        with self.assertRaises(EnvironmentError):
+            with pool.reserve():
+                pass
+        self.assertEquals(pool.clients.qsize(), 3)
+
+    def test_pool_reaper_replaces_stale_and_dead_connections(self):
+        pool = MCClientPool("127.0.0.1:11211", maxsize=3, prefill=2)
+        self.assertEquals(pool.get_stats()["created"], 2)
+        # Connections that will soon be stale are replaced.
+        pool.reap_connections(lookahead=pool.timeout)
+        stats = pool.get_stats()
+        self.assertEquals(stats["recycled"], 2)
+        self.assertEquals(stats["created"], 4)
+        self.assertEquals(stats["size"], 2)
+        self.assertEquals(pool.clients.qsize(), 3)
+        # Connections that have died are replaced.
+        ts, mc = pool.clients.queue[0]
+        mc.disconnect()
+        pool.reap_connections()
+        stats = pool.get_stats()
+        self.assertEquals(stats["dropped"], 1)
+        self.assertEquals(stats["created"], 5)
+        self.assertEquals(stats["size"], 2)
+        self.assertEquals(pool.clients.qsize(), 3)
+        for ts, mc in list(pool.clients.queue):
+            if mc is not None:
+                self.assertTrue(mc.is_connected())
+
+    def test_pool_reaper_tops_up_to_prefill_size(self):
+        pool = MCClientPool("127.0.0.1:11211", maxsize=3, prefill=2)
+        with pool.reserve() as mc1:
+            with pool.reserve() as mc2:
+                mc1.disconnect()
+                mc2.disconnect()
+        self.assertEquals(pool.get_stats()["size"], 0)
+        pool.reap_connections()
+        self.assertEquals(pool.get_stats()["size"], 2)
+        self.assertEquals(pool.clients.qsize(), 3)
+        # Without a maxsize, only the prefill size is maintained.
+        pool = MCClientPool("127.0.0.1:11211", prefill=1)
+        with pool.reserve() as mc1:
+            with pool.reserve() as mc2:
+                pass
+        self.assertEquals(pool.get_stats()["size"], 2)
+        pool.reap_connections(lookahead=pool.timeout)
+        self.assertEquals(pool.get_stats()["size"], 1)
+        self.assertEquals(pool.get_stats()["recycled"], 2)
+
+    def test_pool_reaper_does_not_hold_slots_while_connecting(self):
+        pool = MCClientPool("127.0.0.1:11211", maxsize=2, prefill=2,
+                            checkout_timeout=1)
+        with pool.reserve() as mc1:
+            with pool.reserve() as mc2:
+                mc1.disconnect()
+                mc2.disconnect()
+        connecting = threading.Event()
+        release = threading.Event()
+        create_client = pool._create_client
+        reaper_thread = []
+
+        def slow_create_client():
+            if threading.current_thread() in reaper_thread:
+                connecting.set()
+                release.wait(5)
+            return create_client()
+
+        pool._create_client = slow_create_client
+        reaper = threading.Thread(target=pool.reap_connections)
+        reaper_thread.append(reaper)
+        reaper.start()
+        try:
+            self.assertTrue(connecting.wait(5))
+            # Both slots are still available to requests.
+            with pool.reserve() as mc1:
+                with pool.reserve() as mc2:
+                    self.assertTrue(mc1.is_connected())
+                    self.assertTrue(mc2.is_connected())
+        finally:
+            release.set()
+            reaper.join()
+        # The reaper's spare connection had no free slot to go into.
+        self.assertEquals(pool.get_stats()["size"], 2)
+        self.assertEquals(pool.get_stats()["created"], 5)
+        for ts, mc in list(pool.clients.queue):
+            self.assertTrue(mc is not None and mc.is_connected())
+
+    def test_pool_reaper_runs_in_background(self):
+        client = self.make_client(pool_size=2, pool_prefill=1)
+        pool = client.pool
+        ts, mc = pool.clients.queue[0]
+        mc.disconnect()
+        pool.start_reaper(0.01)
+        try:
+            for _ in xrange(100):
+                if pool.get_stats()["dropped"]:
+                    break
+                time.sleep(0.01)
+            self.assertEquals(pool.get_stats()["dropped"], 1)
+            self.assertRaises(RuntimeError, pool.start_reaper, 1)
+        finally:
+            pool.stop_reaper()
+        self.assertEquals(client.get("mozsvc-test:missing"), None)
+
+    def test_reaper_can_be_started_from_client_config(self):
+        client = self.make_client(pool_reap_interval=10)
+        try:
+            self.assertTrue(client.pool._reaper is not None)
+        finally:
+            client.pool.stop_reaper()
+
+
+class TestMemcachedClientFailures(unittest2.TestCase):
+
+    def setUp(self):
+        if MEMCACHED is False:
+            raise unittest2.SkipTest("no umemcache")
+        self.server = StubMemcachedServer()
+        self.server.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            for pool in client.pools.itervalues():
+                pool.stop_reaper()
+        self.server.stop()
+
+    def make_client(self, **kwds):
+        kwds.setdefault("server", self.server.address)
+        client = MemcachedClient(**kwds)
+        self.clients.append(client)
+        return client
+
+    def test_circuit_breaker_fails_fast_when_server_is_down(self):
+        client = self.make_client(breaker_threshold=3, breaker_timeout=30,
+                                  error_log_interval=60)
+        breaker = client.breakers[self.server.address]
+        self.assertTrue(client.set("one", 1))
+        self.server.stop()
+        with LogCapture() as logs:
+            for _ in xrange(3):
+                self.assertRaises(BackendError, client.get, "one")
+            self.assertEquals(breaker.state, breaker.OPEN)
+            # Only the first traceback is logged.
+            self.assertEquals(len(logs.records), 1)
+            # Further requests fail without trying to connect, or logging.
+            num_created = client.pool.get_stats()["created"]
+            try:
+                client.get("one")
+            except BackendError, err:
+                self.assertTrue(0 < err.retry_after <= 30)
+                self.assertEquals(err.server, self.server.address)
+            else:  # pragma: nocover
+                self.fail("BackendError not raised")
+            self.assertEquals(client.pool.get_stats()["created"], num_created)
+            self.assertEquals(len(logs.records), 1)
+            # The next logged error reports how many were suppressed.
+            breaker.record_success()
+            client.error_log_interval = 0
+            self.assertRaises(BackendError, client.get, "one")
+            self.assertEquals(len(logs.records), 2)
+            self.assertTrue("2 similar errors suppressed"
+                            in logs.records[1].getMessage())
+
+    def test_circuit_breaker_can_be_disabled(self):
+        client = self.make_client(breaker_threshold=0)
+        self.assertEquals(client.breakers, {})
+        self.server.stop()
+        with LogCapture():
+            for _ in xrange(10):
+                self.assertRaises(BackendError, client.get, "one")
+
+    def test_replicated_mode_fails_over_to_healthy_servers(self):
+        server2 = StubMemcachedServer()
+        server2.start()
+        try:
+            servers = [self.server.address, server2.address]
+            client = self.make_client(server=servers, num_replicas=2,
+                                      breaker_threshold=2, breaker_timeout=60)
+            keys = ["key%d" % (i,) for i in xrange(20)]
+            items = dict((key, i) for i, key in enumerate(keys))
+            self.assertTrue(all(client.set_multi(items).values()))
+            self.assertTrue(client.set("one", 1))
+            self.assertEquals(client.incr("count", initial=0), 1)
+            value, casid = client.gets("one")
+            self.assertTrue(client.cas("one", 2, casid))
+            # Every write went to both servers.
+            for server in (self.server, server2):
+                self.assertEquals(len(server.items), 22)
+                self.assertEquals(server.items["one"][0], "2")
+            # Reads keep working when one of the servers dies, and the
+            # dead server is skipped once its breaker has opened.
+            server2.stop()
+            breaker = client.breakers[server2.address]
+            with LogCapture() as logs:
+                self.assertEquals(client.get_multi(keys), items)
+                for key in keys:
+                    self.assertEquals(client.get(key), items[key])
+                self.assertEquals(breaker.state, breaker.OPEN)
+                self.assertEquals(len(logs.records), 1)
+                self.assertTrue(client.set("two", 2))
+                self.assertEquals(client.get("two"), 2)
+                self.assertTrue(client.delete("one"))
+                self.assertEquals(client.incr("count"), 2)
+                self.assertEquals(client.get_multi(keys), items)
+            self.assertEquals(len(logs.records), 1)
+            # With both servers down, requests fail.
+            self.server.stop()
+            with LogCapture():
+                self.assertRaises(BackendError, client.get, "two")
+                self.assertRaises(BackendError, client.set, "two", 2)
+                self.assertRaises(BackendError, client.get_multi, keys)
+                self.assertRaises(BackendError, client.delete_multi, keys)
+        finally:
+            server2.stop()
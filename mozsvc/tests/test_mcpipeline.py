@@ -0,0 +1,366 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import socket
+import threading
+import unittest2
+
+from testfixtures import LogCapture
+
+from mozsvc.exceptions import BackendError, BackendTimeoutError
+from mozsvc.storage.mcpipeline import (PipelinedMemcachedClient,
+                                       PipelinedConnection, _parse_get)
+from mozsvc.tests.support import StubMemcachedServer
+
+
+class TestPipelinedMemcachedClient(unittest2.TestCase):
+
+    def setUp(self):
+        self.server = StubMemcachedServer()
+        self.server.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            for pool in client.pools.itervalues():
+                pool.close()
+        self.server.stop()
+
+    def make_client(self, **kwds):
+        kwds.setdefault("server", self.server.address)
+        client = PipelinedMemcachedClient(**kwds)
+        self.clients.append(client)
+        return client
+
+    def test_basic_operation(self):
+        client = self.make_client(key_prefix="test:")
+        self.assertEquals(client.get("one"), None)
+        self.assertTrue(client.set("one", {"hello": "world"}))
+        self.assertEquals(client.get("one"), {"hello": "world"})
+        self.assertEquals(self.server.items["test:one"][0],
+                          '{"hello": "world"}')
+        self.assertFalse(client.add("one", 1))
+        self.assertTrue(client.add("two", 2))
+        self.assertFalse(client.replace("three", 3))
+        self.assertTrue(client.replace("two", 22))
+        self.assertEquals(client.get_multi(["one", "two", "three"]),
+                          {"one": {"hello": "world"}, "two": 22})
+        self.assertEquals(client.get_multi([]), {})
+        self.assertTrue(client.delete("one"))
+        self.assertFalse(client.delete("one"))
+
+    def test_gets_and_cas(self):
+        client = self.make_client()
+        self.assertEquals(client.gets("one"), (None, None))
+        self.assertTrue(client.cas("one", 1, None))
+        value, casid = client.gets("one")
+        self.assertEquals(value, 1)
+        self.assertTrue(client.cas("one", 2, casid))
+        self.assertFalse(client.cas("one", 3, casid))
+        self.assertEquals(client.get("one"), 2)
+
+    def test_multi_key_writes(self):
+        client = self.make_client()
+        items = dict(("key%d" % (i,), i) for i in xrange(50))
+        self.assertTrue(all(client.set_multi(items).values()))
+        self.assertFalse(any(client.add_multi(items).values()))
+        self.assertEquals(client.get_multi(items.keys()), items)
+        self.assertTrue(all(client.delete_multi(items.keys()).values()))
+        self.assertEquals(client.get_multi(items.keys()), {})
+
+    def test_counters(self):
+        client = self.make_client()
+        self.assertEquals(client.incr("one", initial=0), 1)
+        self.assertEquals(client.incr_multi({"one": 5, "two": 1}),
+                          {"one": 6, "two": None})
+        self.assertEquals(client.decr("one", 10), 0)
+        self.assertEquals(client.get("one"), 0)
+        self.assertTrue(client.touch("one", 100))
+        self.assertTrue(self.server.items["one"][2] > time.time())
+        self.assertFalse(client.touch("two", 100))
+
+    def test_replicated_mode_fails_over_to_healthy_servers(self):
+        server2 = StubMemcachedServer()
+        server2.start()
+        try:
+            servers = [self.server.address, server2.address]
+            client = self.make_client(server=servers, num_replicas=2,
+                                      breaker_threshold=2, breaker_timeout=60)
+            keys = ["key%d" % (i,) for i in xrange(20)]
+            items = dict((key, i) for i, key in enumerate(keys))
+            self.assertTrue(all(client.set_multi(items).values()))
+            self.assertTrue(client.set("one", 1))
+            self.assertEquals(client.incr("count", initial=0), 1)
+            value, casid = client.gets("one")
+            self.assertTrue(client.cas("one", 2, casid))
+            # Every write went to both servers.
+            for server in (self.server, server2):
+                self.assertEquals(len(server.items), 22)
+                self.assertEquals(server.items["one"][0], "2")
+            # Reads keep working when one of the servers dies, and the
+            # dead server is skipped once its breaker has opened.
+            server2.stop()
+            breaker = client.breakers[server2.address]
+            with LogCapture() as logs:
+                self.assertEquals(client.get_multi(keys), items)
+                for key in keys:
+                    self.assertEquals(client.get(key), items[key])
+                self.assertEquals(breaker.state, breaker.OPEN)
+                self.assertEquals(len(logs.records), 1)
+                self.assertTrue(client.set("two", 2))
+                self.assertEquals(client.get("two"), 2)
+                self.assertTrue(client.delete("one"))
+                self.assertEquals(client.incr("count"), 2)
+                self.assertEquals(client.get_multi(keys), items)
+            self.assertEquals(len(logs.records), 1)
+            # With both servers down, requests fail.
+            self.server.stop()
+            with LogCapture():
+                self.assertRaises(BackendError, client.get, "two")
+                self.assertRaises(BackendError, client.set, "two", 2)
+                self.assertRaises(BackendError, client.get_multi, keys)
+                self.assertRaises(BackendError, client.delete_multi, keys)
+        finally:
+            server2.stop()
+
+    def test_concurrent_requests_share_connections(self):
+        client = self.make_client(pool_size=2)
+        errors = []
+
+        def worker(n):
+            try:
+                for i in xrange(20):
+                    key = "key%d-%d" % (n, i)
+                    self.assertTrue(client.set(key, [n, i]))
+                    self.assertEquals(client.get(key), [n, i])
+            except Exception, err:  # pragma: nocover
+                errors.append(err)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        self.assertEquals(self.server.num_connections, 2)
+        self.assertEquals(client.pool.get_stats()["pending"], 0)
+
+    def test_replies_are_matched_to_pipelined_requests(self):
+        connection = PipelinedConnection(self.server.address)
+        try:
+            replies = connection.send_commands([
+                "set one 0 0 1\r\n1\r\n",
+                "add one 0 0 1\r\n2\r\n",
+                "delete two\r\n",
+                "delete one\r\n",
+            ])
+            self.assertEquals(replies, ["STORED", "NOT_STORED",
+                                        "NOT_FOUND", "DELETED"])
+            self.assertEquals(connection.version(), "0.0.0-stub")
+        finally:
+            connection.disconnect()
+
+    def test_error_replies_only_fail_their_own_request(self):
+        client = self.make_client(pool_size=1, breaker_threshold=1)
+        breaker = client.breakers[self.server.address]
+        self.assertTrue(client.set("one", 1))
+        with self.assertRaises(ValueError):
+            with client._connect(pool=client.pool) as mc:
+                # Pipeline a request after the bad one, on the same
+                # connection, before waiting for the bad one's reply.
+                bad, = mc._send(["bogus\r\n"], _parse_get)
+                self.assertEquals(client.get("one"), 1)
+                mc._wait(bad)
+        self.assertTrue(mc.is_connected())
+        self.assertEquals(breaker.state, breaker.CLOSED)
+        self.assertEquals(client.get("one"), 1)
+        self.assertEquals(client.pool.get_stats()["created"], 1)
+
+    def test_connecting_does_not_block_other_slots(self):
+        client = self.make_client(pool_size=2)
+        self.assertTrue(client.set("one", 1))
+        pool = client.pool
+        # Make the next new connection hang until we release it.
+        connecting = threading.Event()
+        release = threading.Event()
+        create_connection = pool._create_connection
+
+        def slow_create_connection():
+            connecting.set()
+            release.wait(5)
+            return create_connection()
+
+        pool._create_connection = slow_create_connection
+        pool._connections[1] = None
+        pool._next_slot = 1
+        thread = threading.Thread(target=client.get, args=("one",))
+        thread.start()
+        try:
+            self.assertTrue(connecting.wait(5))
+            # Requests using the other slot don't wait for the connect.
+            start = time.time()
+            self.assertEquals(client.get("one"), 1)
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            release.set()
+            thread.join()
+        self.assertTrue(pool._connections[1].is_connected())
+
+    def test_connections_are_replaced_when_stale_or_dropped(self):
+        client = self.make_client(pool_size=1, pool_timeout=60)
+        self.assertTrue(client.set("one", 1))
+        self.server.drop_connections()
+        # Once the reader notices that the connection has been dropped,
+        # it will be replaced by a new one.
+        for _ in xrange(100):
+            if not client.pool._connections[0].is_connected():
+                break
+            time.sleep(0.01)
+        self.assertEquals(client.get("one"), 1)
+        self.assertEquals(client.pool.get_stats()["dropped"], 1)
+        client.pool.timeout = 0
+        self.assertEquals(client.get("one"), 1)
+        stats = client.pool.get_stats()
+        self.assertEquals(stats["recycled"], 1)
+        self.assertEquals(stats["created"], 3)
+
+    def test_errors_are_reported_as_backend_errors(self):
+        client = self.make_client()
+        self.assertTrue(client.set("one", 1))
+        self.server.stop()
+        with LogCapture() as logs:
+            self.assertRaises(BackendError, client.get, "one")
+        self.assertEquals(len(logs.records), 1)
+
+    def test_circuit_breaker_fails_fast_when_server_is_down(self):
+        client = self.make_client(breaker_threshold=3, breaker_timeout=30,
+                                  error_log_interval=60)
+        breaker = client.breakers[self.server.address]
+        self.assertTrue(client.set("one", 1))
+        self.server.stop()
+        with LogCapture() as logs:
+            for _ in xrange(3):
+                self.assertRaises(BackendError, client.get, "one")
+            self.assertEquals(breaker.state, breaker.OPEN)
+            # Only the first traceback is logged.
+            self.assertEquals(len(logs.records), 1)
+            # Further requests fail without trying to connect, or logging.
+            num_created = client.pool.get_stats()["created"]
+            try:
+                client.get("one")
+            except BackendError, err:
+                self.assertTrue(0 < err.retry_after <= 30)
+                self.assertEquals(err.server, self.server.address)
+            else:  # pragma: nocover
+                self.fail("BackendError not raised")
+            self.assertEquals(client.pool.get_stats()["created"], num_created)
+            self.assertEquals(len(logs.records), 1)
+            # The next logged error reports how many were suppressed.
+            breaker.record_success()
+            client.error_log_interval = 0
+            self.assertRaises(BackendError, client.get, "one")
+            self.assertEquals(len(logs.records), 2)
+            self.assertTrue("2 similar errors suppressed"
+                            in logs.records[1].getMessage())
+
+    def test_circuit_breaker_can_be_disabled(self):
+        client = self.make_client(breaker_threshold=0)
+        self.assertEquals(client.breakers, {})
+        self.server.stop()
+        with LogCapture():
+            for _ in xrange(10):
+                self.assertRaises(BackendError, client.get, "one")
+
+    def test_reply_timeout(self):
+        client = self.make_client(pool_size=1, pool_checkout_timeout=0.01)
+        self.assertTrue(client.set("one", 1))
+        self.server.lock.acquire()
+        try:
+            self.assertRaises(BackendTimeoutError, client.get, "one")
+        finally:
+            self.server.lock.release()
+        # The connection is closed, since nothing else was waiting on it,
+        # and later requests use a fresh one.
+        self.assertFalse(client.pool._connections[0].is_connected())
+        self.assertTrue(client.set("one", 2))
+        self.assertEquals(client.get("one"), 2)
+
+    def test_reply_timeouts_trip_the_circuit_breaker(self):
+        client = self.make_client(pool_checkout_timeout=0.01,
+                                  breaker_threshold=2, breaker_timeout=30)
+        breaker = client.breakers[self.server.address]
+        self.assertTrue(client.set("one", 1))
+        self.server.lock.acquire()
+        try:
+            for _ in xrange(2):
+                self.assertRaises(BackendTimeoutError, client.get, "one")
+            self.assertEquals(breaker.state, breaker.OPEN)
+            # Further requests fail straight away, without waiting.
+            num_created = client.pool.get_stats()["created"]
+            try:
+                client.get("one")
+            except BackendTimeoutError:  # pragma: nocover
+                self.fail("request was sent to a hung server")
+            except BackendError, err:
+                self.assertTrue(0 < err.retry_after <= 30)
+            self.assertEquals(client.pool.get_stats()["created"], num_created)
+        finally:
+            self.server.lock.release()
+
+    def test_timed_out_connections_wait_for_other_pending_requests(self):
+        connection = PipelinedConnection(self.server.address, timeout=0.05)
+        self.addCleanup(connection.disconnect)
+        self.server.lock.acquire()
+        try:
+            slow = connection._send(["get one\r\n"], _parse_get)[0]
+            time.sleep(0.03)
+            fast = connection._send(["get two\r\n"], _parse_get)[0]
+            self.assertRaises(BackendTimeoutError, connection._wait, slow)
+            # Retired, but still open for the request that is still waiting.
+            self.assertFalse(connection.is_connected())
+            self.assertEquals(connection._error, None)
+        finally:
+            self.server.lock.release()
+        self.assertEquals(connection._wait(fast), {})
+        self.assertTrue(connection._error is not None)
+
+    def test_disconnect_partway_through_a_reply(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+
+        def serve_truncated_reply():
+            sock, _ = listener.accept()
+            sock.makefile("rb").readline()
+            sock.sendall("VALUE one 0 10\r\nabc")
+            sock.close()
+
+        thread = threading.Thread(target=serve_truncated_reply)
+        thread.daemon = True
+        thread.start()
+        client = self.make_client(server="127.0.0.1:%d"
+                                  % listener.getsockname()[1])
+        errors = []
+
+        def get():
+            try:
+                client.get("one")
+            except BackendError, err:
+                errors.append(err)
+
+        with LogCapture():
+            getter = threading.Thread(target=get)
+            getter.daemon = True
+            getter.start()
+            getter.join(5)
+        self.assertFalse(getter.is_alive())
+        self.assertEquals(len(errors), 1)
+
+    def test_prefill(self):
+        client = self.make_client(pool_size=3, pool_prefill=3)
+        self.assertEquals(client.pool.get_stats()["size"], 3)
+        self.assertEquals(self.server.num_connections, 3)
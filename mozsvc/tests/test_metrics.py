@@ -1,5 +1,6 @@
 
 import time
+import socket
 import unittest2
 
 from pyramid.request import Request, Response
@@ -9,7 +10,9 @@ from webtest import TestApp
 from testfixtures import LogCapture
 import pyramid.testing
 
-from mozsvc.metrics import metrics_timer, initialize_request_metrics
+from mozsvc.metrics import (metrics_timer, initialize_request_metrics,
+                            Histogram, StatsdEmitter, RequestLogSampler,
+                            AGGREGATOR_KEY, LOG_SAMPLER_KEY)
 
 from cornice import Service
 from cornice.pyramidhook import register_service_views
@@ -152,3 +155,170 @@ class TestMetrics(unittest2.TestCase):
             app.get("/impl_forbidden", status=403)
             r = self.logs.records[-1]
             self.assertEquals(r.code, 403)
+
+    def test_histogram(self):
+        h = Histogram()
+        self.assertEquals(h.get_percentile(50), None)
+        for i in xrange(1, 1001):
+            h.add(i / 1000.0)
+        h.add(0)
+        summary = h.get_summary()
+        self.assertEquals(summary["count"], 1001)
+        self.assertAlmostEquals(summary["sum"], 500.5)
+        self.assertEquals((summary["min"], summary["max"]), (0, 1))
+        self.assertAlmostEquals(summary["p50"], 0.5, delta=0.01)
+        self.assertAlmostEquals(summary["p90"], 0.9, delta=0.01)
+        self.assertAlmostEquals(summary["p99"], 0.99, delta=0.01)
+        self.assertEquals(h.get_percentile(0), 0)
+        self.assertEquals(h.get_percentile(100), 1)
+
+    def test_aggregated_metrics(self):
+        stub_service = Service(name="stub", path="/{what}")
+
+        @stub_service.get()
+        @metrics_timer("view_time")
+        def stub_view(request):
+            request.metrics["hits"] = 2
+            if request.matchdict["what"] == "notfound":
+                raise HTTPNotFound
+            return {}
+
+        with pyramid.testing.testConfig(settings={
+            "metrics.flush_interval": "60",
+            "metrics.log_requests": "false",
+        }) as config:
+            config.include("cornice")
+            config.include("mozsvc")
+            register_service_views(config, stub_service)
+            aggregator = config.registry[AGGREGATOR_KEY]
+            app = TestApp(config.make_wsgi_app())
+            app.get("/ok")
+            app.get("/ok")
+            app.get("/notfound", status=404)
+            # Nothing is logged per-request.
+            self.assertEquals(len(self.logs.records), 0)
+            aggregator.stop()
+
+        records = sorted(self.logs.records, key=lambda r: r.code)
+        self.assertEquals(len(records), 2)
+        self.assertEquals([r.name for r in records],
+                          ["mozsvc.metrics.summary"] * 2)
+        self.assertEquals([(r.route, r.method, r.code) for r in records],
+                          [("stub", "GET", 200), ("stub", "GET", 404)])
+        self.assertEquals([r.count for r in records], [2, 1])
+        self.assertEquals([r.hits for r in records], [4, 2])
+        ok = records[0]
+        self.assertEquals(ok.request_time["count"], 2)
+        self.assertTrue(0 < ok.view_time["max"] <= ok.request_time["max"])
+        # Flushing resets the aggregated metrics.
+        self.assertEquals(aggregator.get_summaries(), [])
+
+    def test_statsd_emitter(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(listener.close)
+        listener.bind(("127.0.0.1", 0))
+        listener.settimeout(1)
+        port = listener.getsockname()[1]
+
+        stub_service = Service(name="stub", path="/stub")
+
+        @stub_service.get()
+        @metrics_timer("view:time")
+        def stub_view(request):
+            return {}
+
+        with pyramid.testing.testConfig(settings={
+            "metrics.statsd_host": "127.0.0.1:%d" % (port,),
+            "metrics.statsd_prefix": "myapp",
+            "metrics.statsd_dogstatsd": "true",
+        }) as config:
+            config.include("cornice")
+            config.include("mozsvc")
+            register_service_views(config, stub_service)
+            app = TestApp(config.make_wsgi_app())
+            app.get("/stub")
+            app.get("/stub")
+            emitter = config.registry["mozsvc.metrics.statsd"]
+            emitter.flush()
+
+        # Both requests are batched into a single datagram.
+        lines = listener.recv(65536).split("\n")
+        self.assertEquals(emitter.num_sent, 1)
+        self.assertEquals(len(lines), 6)
+        tags = "|#route:stub,method:GET,code:200"
+        self.assertEquals(lines[0], "myapp.code.200:1|c" + tags)
+        timers = sorted(line.split(":")[0] for line in lines[:3])
+        self.assertEquals(timers, ["myapp.code.200", "myapp.request_time",
+                                   "myapp.view_time"])
+        for line in lines[1:3]:
+            self.assertTrue(line.endswith("|ms" + tags))
+
+    def test_statsd_emitter_splits_and_drops_packets(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(listener.close)
+        listener.bind(("127.0.0.1", 0))
+        listener.settimeout(1)
+        port = listener.getsockname()[1]
+        emitter = StatsdEmitter("127.0.0.1", port, max_packet_size=20,
+                                flush_interval=60)
+        emitter.add_lines(["a:1|c", "bb:2|c", "ccc:3|c", "dddd:4|c"])
+        self.assertEquals(listener.recv(65536), "a:1|c\nbb:2|c\nccc:3|c")
+        emitter.flush()
+        self.assertEquals(listener.recv(65536), "dddd:4|c")
+        self.assertEquals((emitter.num_sent, emitter.num_dropped), (2, 0))
+        # Oversized datagrams are dropped rather than raising an error.
+        emitter.add_lines(["x" * 100000])
+        emitter.flush()
+        self.assertEquals((emitter.num_sent, emitter.num_dropped), (2, 1))
+        emitter.close()
+
+    def test_sampled_request_logging(self):
+        stub_service = Service(name="stub", path="/{what}")
+
+        @stub_service.get()
+        def stub_view(request):
+            what = request.matchdict["what"]
+            if what == "error":
+                return Response(status=503)
+            if what == "slow":
+                time.sleep(0.02)
+            return Response(status=200)
+
+        with pyramid.testing.testConfig(settings={
+            "metrics.log_sample_rate": "0.5",
+            "metrics.log_route_sample_rates": "heartbeat:0 other:1",
+            "metrics.log_slow_threshold": "0.01",
+        }) as config:
+            config.include("cornice")
+            config.include("mozsvc")
+            register_service_views(config, stub_service)
+            sampler = config.registry[LOG_SAMPLER_KEY]
+            self.assertEquals(sampler.route_sample_rates,
+                              {"heartbeat": 0, "other": 1})
+            rolls = iter([0.7, 0.2])
+            sampler.random = lambda: next(rolls)
+            app = TestApp(config.make_wsgi_app())
+            # Heartbeats are never logged.
+            app.get("/__heartbeat__")
+            self.assertEquals(len(self.logs.records), 0)
+            # Other requests are logged at half the rate, with double weight.
+            app.get("/ok")
+            self.assertEquals(len(self.logs.records), 0)
+            app.get("/ok")
+            self.assertEquals(len(self.logs.records), 1)
+            self.assertEquals(self.logs.records[-1].sample_weight, 2)
+            # Errors and slow requests are always logged.
+            app.get("/error", status=503)
+            self.assertEquals(len(self.logs.records), 2)
+            self.assertEquals(self.logs.records[-1].sample_weight, 1)
+            app.get("/slow")
+            self.assertEquals(len(self.logs.records), 3)
+            self.assertEquals(self.logs.records[-1].sample_weight, 1)
+
+    def test_request_log_sampler_defaults(self):
+        request = Request.blank("/")
+        initialize_request_metrics(request)
+        request.metrics.update({"code": 200, "request_time": 0.1})
+        self.assertEquals(RequestLogSampler().get_sample_weight(request), 1)
+        sampler = RequestLogSampler(0.25, random=lambda: 0.1)
+        self.assertEquals(sampler.get_sample_weight(request), 4)
@@ -7,7 +7,8 @@ import os
 import time
 import itertools
 
-from mozsvc.secrets import Secrets, FixedSecrets, DerivedSecrets
+from mozsvc.secrets import (Secrets, ReloadingSecrets, FixedSecrets,
+                            DerivedSecrets)
 
 
 class TestSecrets(unittest2.TestCase):
@@ -72,6 +73,38 @@ class TestSecrets(unittest2.TestCase):
         keys.sort()
         self.assertEqual(keys, ['phx123', 'phx23456'])
 
+    def test_reloading_secrets(self):
+        path = self.tempfile()
+        with open(path, 'wb') as f:
+            f.write('phx123,0001:secret11\nphx234,0001:secret21\n')
+        secrets = ReloadingSecrets(path, check_interval=0.01)
+        self.addCleanup(secrets.close)
+        self.assertEquals(secrets.get('phx123'), ['secret11'])
+        self.assertEquals(secrets.get('phx345'), [])
+        self.assertFalse(secrets.check_for_changes())
+        # Atomically replace the file with one containing a new secret.
+        newpath = self.tempfile()
+        with open(newpath, 'wb') as f:
+            f.write('phx123,0001:secret11,0002:secret12\n')
+        os.rename(newpath, path)
+        for _ in xrange(100):
+            if secrets.get('phx123') != ['secret11']:
+                break
+            time.sleep(0.01)
+        self.assertEquals(secrets.get('phx123'), ['secret11', 'secret12'])
+        self.assertEquals(secrets.keys(), ['phx123'])
+        # A broken file is reported, and the old secrets are kept.
+        with open(newpath, 'wb') as f:
+            f.write('phx123,broken\n')
+        os.rename(newpath, path)
+        self.assertRaises(ValueError, secrets.check_for_changes)
+        self.assertEquals(secrets.get('phx123'), ['secret11', 'secret12'])
+        # Saving writes out the secrets that are currently loaded.
+        secrets.save(newpath)
+        saved = Secrets(newpath)
+        self.assertEquals(saved.keys(), ['phx123'])
+        self.assertEquals(saved.get('phx123'), ['secret11', 'secret12'])
+
     def test_fixed_secrets(self):
         secrets = FixedSecrets(['one', 'two'])
         self.assertEquals(secrets.get('phx123'), ['one', 'two'])
@@ -92,3 +125,23 @@ class TestSecrets(unittest2.TestCase):
             self.assertEquals(len(derived), len(master_secrets))
             for d, m in zip(derived, master_secrets):
                 self.assertEquals(len(d), len(m))
+
+    def test_derived_secrets_are_memoized(self):
+        secrets = DerivedSecrets(['abcdef', '1234567890'], cache_size=2)
+        derived1 = secrets.get('phx123')
+        # Callers can't mess with the memoized list.
+        derived1.append('oops')
+        self.assertEquals(len(secrets.get('phx123')), 2)
+        self.assertEquals(secrets._cache.hits, 1)
+        # The memo is bounded.
+        secrets.get('phx234')
+        secrets.get('phx345')
+        self.assertEquals(len(secrets._cache), 2)
+        # Changing the master secrets resets the memo.
+        secrets.master_secrets = 'abcdef fedcba'
+        self.assertEquals(secrets.master_secrets, ['abcdef', 'fedcba'])
+        derived2 = secrets.get('phx123')
+        self.assertEquals(derived2[0], derived1[0])
+        self.assertNotEquals(derived2[1], derived1[1])
+        secrets2 = DerivedSecrets('abcdef fedcba')
+        self.assertEquals(derived2, secrets2.get('phx123'))
@@ -0,0 +1,85 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import zlib
+import unittest2
+
+from mozsvc.storage import serialization
+from mozsvc.storage.serialization import (ValueCodec, register_serializer,
+                                          register_compressor, FLAG_JSON,
+                                          FLAG_RAW, FLAG_MSGPACK, FLAG_ZLIB,
+                                          FLAG_LZ4)
+
+
+class TestValueCodec(unittest2.TestCase):
+
+    def test_json_is_the_default(self):
+        codec = ValueCodec()
+        data, flags = codec.encode({"hello": "world"})
+        self.assertEquals(flags, FLAG_JSON)
+        self.assertEquals(data, '{"hello": "world"}')
+        self.assertEquals(codec.decode(data, flags), {"hello": "world"})
+
+    def test_raw_serializer(self):
+        codec = ValueCodec("raw")
+        self.assertEquals(codec.encode("\x00\xff"), ("\x00\xff", FLAG_RAW))
+        self.assertEquals(codec.decode("\x00\xff", FLAG_RAW), "\x00\xff")
+        self.assertRaises(ValueError, codec.encode, {"not": "bytes"})
+
+    def test_msgpack_serializer(self):
+        if serialization.msgpack is None:
+            raise unittest2.SkipTest("no msgpack")
+        codec = ValueCodec("msgpack")
+        value = {u"hello": [u"world", 42, None, 1.5]}
+        data, flags = codec.encode(value)
+        self.assertEquals(flags, FLAG_MSGPACK)
+        self.assertEquals(codec.decode(data, flags), value)
+
+    def test_compression_above_threshold(self):
+        codec = ValueCodec(compressor="zlib", compress_threshold=100)
+        data, flags = codec.encode("x" * 50)
+        self.assertEquals(flags, FLAG_JSON)
+        data, flags = codec.encode("x" * 500)
+        self.assertEquals(flags, FLAG_JSON | FLAG_ZLIB)
+        self.assertTrue(len(data) < 100)
+        self.assertEquals(zlib.decompress(data), '"%s"' % ("x" * 500,))
+        self.assertEquals(codec.decode(data, flags), "x" * 500)
+
+    def test_incompressible_data_is_stored_uncompressed(self):
+        codec = ValueCodec("raw", "zlib", compress_threshold=0)
+        data = zlib.compress("x" * 500)
+        self.assertEquals(codec.encode(data), (data, FLAG_RAW))
+
+    def test_lz4_compressor(self):
+        if serialization.lz4_block is None:
+            raise unittest2.SkipTest("no lz4")
+        codec = ValueCodec(compressor="lz4", compress_threshold=0)
+        data, flags = codec.encode(["y"] * 500)
+        self.assertEquals(flags, FLAG_JSON | FLAG_LZ4)
+        self.assertEquals(codec.decode(data, flags), ["y"] * 500)
+
+    def test_decoding_uses_the_stored_flags(self):
+        json_data, json_flags = ValueCodec().encode([1, 2, 3])
+        zlib_data, zlib_flags = ValueCodec("raw", "zlib", 0).encode("z" * 99)
+        codec = ValueCodec("raw")
+        self.assertEquals(codec.decode(json_data, json_flags), [1, 2, 3])
+        self.assertEquals(codec.decode(zlib_data, zlib_flags), "z" * 99)
+        self.assertRaises(ValueError, codec.decode, json_data, 0x7F)
+        self.assertRaises(ValueError, codec.decode, json_data, 1 << 20)
+
+    def test_unknown_codec_names(self):
+        self.assertRaises(ValueError, ValueCodec, "pickle")
+        self.assertRaises(ValueError, ValueCodec, "json", "bzip2")
+
+    def test_registering_codecs(self):
+        self.assertRaises(ValueError, register_serializer,
+                          "json2", FLAG_JSON, None, None)
+        self.assertRaises(ValueError, register_serializer,
+                          "big", 0x100, None, None)
+        self.assertRaises(ValueError, register_compressor,
+                          "zlib2", FLAG_ZLIB, None, None)
+        self.assertRaises(ValueError, register_compressor,
+                          "low", 0x01, None, None)
+        self.assertRaises(ValueError, register_compressor,
+                          "double", 0x3000, None, None)
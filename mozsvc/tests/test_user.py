@@ -6,6 +6,7 @@
 # ***** END LICENSE BLOCK *****
 
 import time
+import threading
 import unittest2
 import tempfile
 
@@ -18,16 +19,19 @@ from pyramid.httpexceptions import HTTPUnauthorized
 
 import tokenlib
 import hawkauthlib
+from testfixtures import LogCapture
 
 from mozsvc.exceptions import BackendError
-from mozsvc.tests.support import TestCase
-from mozsvc.secrets import DerivedSecrets
+from mozsvc.tests.support import TestCase, StubMemcachedServer
+from mozsvc.secrets import DerivedSecrets, FixedSecrets
 from mozsvc.user.permissivenoncecache import PermissiveNonceCache
+from mozsvc.user.localnoncecache import LocalNonceCache
 from mozsvc.user import TokenServerAuthenticationPolicy
 
 try:
     from mozsvc.storage.mcclient import MemcachedClient
     from mozsvc.user.noncecache import MemcachedNonceCache
+    from mozsvc.user.bloomnoncecache import BloomNonceCache
     # We'll test for a live memcached server when we actually run the tests.
     MEMCACHED = None
 except (ImportError, BackendError):
@@ -149,6 +153,146 @@ class UserTestCase(TestCase):
         # And that the rejection gets raised when accessing request.user
         self.assertRaises(HTTPUnauthorized, getattr, req, "user")
 
+    def test_that_parsed_tokens_are_cached(self):
+        req = self.make_request()
+        tokenid, key = self.policy.encode_hawk_id(req, 42)
+        orig_parse_token = tokenlib.parse_token
+        parsed_tokens = []
+
+        def parse_token(token, **kwds):
+            parsed_tokens.append(token)
+            return orig_parse_token(token, **kwds)
+
+        tokenlib.parse_token = parse_token
+        try:
+            for i in xrange(3):
+                req = self.make_request()
+                req.metrics = {}
+                self.assertEquals(self.policy.decode_hawk_id(req, tokenid),
+                                  (42, key))
+                self.assertEquals(req.metrics["auth.token_cache_hit"],
+                                  int(i > 0))
+            self.assertEquals(parsed_tokens, [tokenid])
+            stats = self.policy.token_cache.get_stats()
+            self.assertEquals((stats["hits"], stats["misses"]), (2, 1))
+            # The cache is keyed by node, and invalid tokens aren't cached.
+            req = self.make_request(environ={"HTTP_HOST": "host2.com"})
+            self.assertRaises(ValueError, self.policy.decode_hawk_id,
+                              req, tokenid)
+            self.assertRaises(ValueError, self.policy.decode_hawk_id,
+                              req, tokenid)
+            self.assertEquals(len(parsed_tokens), 3)
+            # Cached entries don't outlive the token itself.
+            now = time.time()
+            expiring_tokenid = tokenlib.make_token({
+                "uid": 7, "node": req.host_url, "expires": now + 1,
+            })
+            self.policy.decode_hawk_id(req, expiring_tokenid)
+            self.policy.decode_hawk_id(req, expiring_tokenid)
+            self.assertEquals(len(parsed_tokens), 4)
+            self.policy.token_cache.get_time = lambda: now + 2
+            self.policy.decode_hawk_id(req, expiring_tokenid)
+            self.assertEquals(len(parsed_tokens), 5)
+        finally:
+            tokenlib.parse_token = orig_parse_token
+
+    def test_that_token_cache_can_be_configured(self):
+        config2 = pyramid.testing.setUp()
+        config2.add_settings({
+            "hawkauth.token_cache_size": "0",
+        })
+        config2.include("mozsvc.user")
+        policy2 = config2.registry.queryUtility(IAuthenticationPolicy)
+        self.assertEquals(policy2.token_cache, None)
+
+    def test_that_last_successful_secret_is_tried_first(self):
+        policy = TokenServerAuthenticationPolicy(
+            secrets=FixedSecrets(["secret1", "secret2", "secret3"]),
+            token_cache_size=0)
+        req = self.make_request()
+        node_name = req.host_url
+        tokens = {}
+        for secret in ("secret1", "secret2", "secret3"):
+            tokens[secret] = tokenlib.make_token({"uid": 42,
+                                                  "node": node_name},
+                                                 secret=secret)
+        orig_parse_token = tokenlib.parse_token
+        tried_secrets = []
+
+        def parse_token(token, secret=None, **kwds):
+            tried_secrets.append(secret)
+            return orig_parse_token(token, secret=secret, **kwds)
+
+        tokenlib.parse_token = parse_token
+        try:
+            # Secrets are tried from newest to oldest by default.
+            policy.decode_hawk_id(req, tokens["secret1"])
+            self.assertEquals(tried_secrets,
+                              ["secret3", "secret2", "secret1"])
+            self.assertEquals(policy.num_failed_secret_attempts, 2)
+            # The secret that last worked is then tried first.
+            del tried_secrets[:]
+            policy.decode_hawk_id(req, tokens["secret1"])
+            self.assertEquals(tried_secrets, ["secret1"])
+            del tried_secrets[:]
+            policy.decode_hawk_id(req, tokens["secret2"])
+            self.assertEquals(tried_secrets,
+                              ["secret1", "secret3", "secret2"])
+            del tried_secrets[:]
+            policy.decode_hawk_id(req, tokens["secret3"])
+            self.assertEquals(tried_secrets,
+                              ["secret2", "secret3"])
+            del tried_secrets[:]
+            policy.decode_hawk_id(req, tokens["secret3"])
+            self.assertEquals(tried_secrets, ["secret3"])
+            # Usage is counted by the age of the successful secret.
+            self.assertEquals(dict(policy.secret_usage), {0: 2, 1: 1, 2: 2})
+            self.assertEquals(policy.num_failed_secret_attempts, 5)
+        finally:
+            tokenlib.parse_token = orig_parse_token
+
+    def test_that_last_successful_secrets_cant_grow_without_limit(self):
+        policy = TokenServerAuthenticationPolicy(
+            secrets=FixedSecrets(["secret1"]), token_cache_size=0)
+        max_size = policy._node_name_cache_size
+        for i in xrange(max_size * 2):
+            req = self.make_request(environ={"HTTP_HOST": "bogus%d.com" % i})
+            token = tokenlib.make_token({"uid": 42, "node": req.host_url},
+                                        secret="secret1")
+            self.assertEquals(policy.decode_hawk_id(req, token)[0], 42)
+            self.assertTrue(len(policy._last_good_secrets) <= max_size)
+
+    def test_that_node_names_are_cached(self):
+        req = self.make_request(environ={
+            "HTTP_HOST": "host1.com:443",
+            "wsgi.url_scheme": "https",
+            "SCRIPT_NAME": "/app",
+        })
+        self.assertEquals(self.policy._get_node_name(req),
+                          "https://host1.com/app")
+        cache = self.policy._node_name_cache
+        self.assertEquals(cache.values(), ["https://host1.com/app"])
+        # A second lookup is served from the cache without recomputing.
+        self.policy._compute_node_name = None
+        try:
+            self.assertEquals(self.policy._get_node_name(req),
+                              "https://host1.com/app")
+        finally:
+            del self.policy._compute_node_name
+        # Each part of the environ that affects the name is in the key.
+        req.environ["wsgi.url_scheme"] = "http"
+        self.assertEquals(self.policy._get_node_name(req),
+                          "http://host1.com:443/app")
+        req.environ["SCRIPT_NAME"] = ""
+        self.assertEquals(self.policy._get_node_name(req),
+                          "http://host1.com:443")
+        # The cache can't be grown without limit by bogus hosts.
+        max_size = self.policy._node_name_cache_size
+        for i in xrange(max_size * 2):
+            req.environ["HTTP_HOST"] = "bogus%d.com" % (i,)
+            self.policy._get_node_name(req)
+            self.assertTrue(len(cache) <= max_size)
+
     def test_that_req_user_can_be_replaced(self):
         req = self.make_request()
         tokenid, key = self.policy.encode_hawk_id(req, 42)
@@ -307,7 +451,7 @@ class TestMemcachedNonceCache(unittest2.TestCase):
         if MEMCACHED is None:
             try:
                 MemcachedClient().get("")
-            except BackendError:
+            except (ImportError, BackendError):
                 MEMCACHED = False
             else:
                 MEMCACHED = True
@@ -353,6 +497,62 @@ class TestMemcachedNonceCache(unittest2.TestCase):
         self.assertFalse(nc.check_nonce(now() + window + 1, "abc"))
 
 
+class TestBatchedMemcachedNonceCache(unittest2.TestCase):
+
+    def setUp(self):
+        if MEMCACHED is False:
+            raise unittest2.SkipTest("no umemcache")
+        self.server = StubMemcachedServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_concurrent_nonces_are_written_in_one_batch(self):
+        nc = MemcachedNonceCache(window=5, cache_server=self.server.address,
+                                 batch_interval=0.05)
+        ts = int(time.time())
+        nonces = ["nonce%d" % (i % 10,) for i in xrange(20)]
+        results = [None] * len(nonces)
+
+        def check(i):
+            results[i] = nc.check_nonce(ts, nonces[i])
+
+        threads = [threading.Thread(target=check, args=(i,))
+                   for i in xrange(len(nonces))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Each nonce was fresh for exactly one of the requests.
+        self.assertEquals(results.count(True), 10)
+        for i in xrange(10):
+            self.assertEquals(results[i] + results[i + 10], 1)
+        self.assertEquals(len(self.server.items), 10)
+        self.assertTrue(nc.mcclient.pool.get_stats()["checkouts"] < 10)
+        # Subsequent batches see the nonces from earlier ones.
+        self.assertFalse(nc.check_nonce(ts, "nonce0"))
+        self.assertTrue(nc.check_nonce(ts, "nonce10"))
+
+    def test_value_errors_reject_the_whole_batch(self):
+        nc = MemcachedNonceCache(window=5, cache_server=self.server.address,
+                                 batch_interval=0.01)
+
+        def add_multi(*args, **kwds):
+            raise ValueError("bad key")
+
+        nc.mcclient.add_multi = add_multi
+        self.assertFalse(nc.check_nonce(int(time.time()), "abc"))
+
+    def test_errors_are_raised_from_every_request(self):
+        nc = MemcachedNonceCache(window=5, cache_server=self.server.address,
+                                 batch_interval=0.01)
+        self.server.stop()
+        with LogCapture():
+            self.assertRaises(BackendError, nc.check_nonce,
+                              int(time.time()), "abc")
+
+
 class TestPermissiveNonceCache(unittest2.TestCase):
 
     def test_permissiveness(self):
@@ -361,3 +561,187 @@ class TestPermissiveNonceCache(unittest2.TestCase):
         self.assertTrue(nc.check_nonce(1234, "abcd"))
         self.assertTrue(nc.check_nonce(1234, "abcd"))
         self.assertTrue(nc.check_nonce(987654321987654321, "hijk"))
+
+
+class TestLocalNonceCache(unittest2.TestCase):
+
+    def test_operation(self):
+        now = [1000]
+        window = 5
+        nc = LocalNonceCache(window=window, get_time=lambda: now[0])
+        self.assertEquals(len(nc), 0)
+        self.assertTrue(nc.check_nonce(1000, "abc"))
+        # After that check, the (ts, nonce) pair should be stale.
+        # Changing either the ts or the nonce will make it fresh.
+        self.assertFalse(nc.check_nonce(1000, "abc"))
+        self.assertTrue(nc.check_nonce(1000, "xyz"))
+        self.assertTrue(nc.check_nonce(1001.5, "abc"))
+        self.assertTrue(nc.check_nonce(1004, "abc"))
+        self.assertEquals(len(nc), 4)
+        # Timestamps outside the configured window are rejected.
+        self.assertFalse(nc.check_nonce(now[0] - window - 1, "abc"))
+        self.assertFalse(nc.check_nonce(now[0] + window + 1, "abc"))
+        # Nonces are dropped once their timestamp leaves the window.
+        now[0] = 1005
+        self.assertEquals(len(nc), 4)
+        now[0] = 1006
+        self.assertEquals(len(nc), 2)
+        self.assertFalse(nc.check_nonce(1001.5, "abc"))
+        now[0] = 1007
+        self.assertEquals(len(nc), 1)
+        now[0] = 2000
+        self.assertEquals(len(nc), 0)
+        self.assertTrue(nc.check_nonce(2000, "abc"))
+        self.assertEquals(len(nc), 1)
+
+    def test_larger_buckets(self):
+        now = [1000]
+        nc = LocalNonceCache(window=10, get_time=lambda: now[0],
+                             bucket_size=5)
+        for i in xrange(10):
+            self.assertTrue(nc.check_nonce(1000 + i, "abc"))
+        self.assertEquals(len(nc), 10)
+        # Buckets are only dropped once all their timestamps are stale.
+        now[0] = 1014
+        self.assertEquals(len(nc), 10)
+        now[0] = 1015
+        self.assertEquals(len(nc), 5)
+        now[0] = 1020
+        self.assertEquals(len(nc), 0)
+
+
+class TestBloomNonceCache(unittest2.TestCase):
+
+    def setUp(self):
+        if MEMCACHED is False:
+            raise unittest2.SkipTest("no umemcache")
+        self.server = StubMemcachedServer()
+        self.server.start()
+        self.now = 1000
+        self.caches = []
+
+    def tearDown(self):
+        for nc in self.caches:
+            nc.close()
+        self.server.stop()
+
+    def make_cache(self, **kwds):
+        kwds.setdefault("window", 5)
+        kwds.setdefault("flush_interval", 60)
+        nc = BloomNonceCache(get_time=lambda: self.now,
+                             cache_server=self.server.address,
+                             cache_key_prefix="", **kwds)
+        self.caches.append(nc)
+        return nc
+
+    def test_async_mode(self):
+        nc = self.make_cache()
+        other_nc = self.make_cache()
+        self.assertTrue(nc.check_nonce(1000, "abc"))
+        self.assertTrue(nc.check_nonce(1000, "xyz"))
+        self.assertTrue(nc.check_nonce(1001, "abc"))
+        # Fresh nonces are accepted without talking to memcached.
+        self.assertEquals(self.server.num_commands, 0)
+        # Duplicates are detected, even before being written to memcached.
+        self.assertFalse(nc.check_nonce(1000, "abc"))
+        self.assertEquals(self.server.num_commands, 0)
+        nc.flush()
+        self.assertEquals(len(self.server.items), 3)
+        self.assertFalse(nc.check_nonce(1000, "abc"))
+        self.assertEquals(nc.num_checks, 5)
+        self.assertEquals(nc.num_memcached_checks, 1)
+        # Replays to another process are only detected after the fact.
+        self.assertTrue(other_nc.check_nonce(1000, "abc"))
+        with LogCapture() as logs:
+            other_nc.flush()
+        self.assertEquals(other_nc.num_late_duplicates, 1)
+        self.assertEquals(len(logs.records), 1)
+        # But that process will then reject any further replays.
+        self.assertFalse(other_nc.check_nonce(1000, "abc"))
+        # Timestamps outside the configured window are rejected.
+        self.assertFalse(nc.check_nonce(994, "abc"))
+        self.assertFalse(nc.check_nonce(1006, "abc"))
+
+    def test_replays_during_a_flush_are_rejected(self):
+        nc = self.make_cache()
+        self.assertTrue(nc.check_nonce(1000, "abc"))
+        add_multi = nc.mcclient.add_multi
+        replays = []
+
+        def replay_then_add_multi(*args, **kwds):
+            replays.append(nc.check_nonce(1000, "abc"))
+            return add_multi(*args, **kwds)
+
+        nc.mcclient.add_multi = replay_then_add_multi
+        with LogCapture() as logs:
+            nc.flush()
+        self.assertEquals(replays, [False])
+        self.assertEquals(nc.num_late_duplicates, 0)
+        self.assertEquals(len(logs.records), 0)
+        self.assertEquals(nc.num_memcached_checks, 0)
+        # Once written, duplicates are checked against memcached again.
+        self.assertFalse(nc.check_nonce(1000, "abc"))
+        self.assertEquals(nc.num_memcached_checks, 1)
+
+    def test_nonces_are_kept_if_they_cannot_be_flushed(self):
+        nc = self.make_cache()
+        self.assertTrue(nc.check_nonce(1000, "abc"))
+        add_multi = nc.mcclient.add_multi
+
+        def failing_add_multi(*args, **kwds):
+            raise BackendError("oops")
+
+        nc.mcclient.add_multi = failing_add_multi
+        self.assertRaises(BackendError, nc.flush)
+        # Replays are still rejected without asking memcached.
+        self.assertFalse(nc.check_nonce(1000, "abc"))
+        self.assertEquals(nc.num_memcached_checks, 0)
+        # And the nonce is written by the next successful flush.
+        nc.mcclient.add_multi = add_multi
+        nc.flush()
+        self.assertEquals(len(self.server.items), 1)
+        # Nonces are dropped once they fall outside the window.
+        self.assertTrue(nc.check_nonce(1001, "xyz"))
+        nc.mcclient.add_multi = failing_add_multi
+        self.now = 1006
+        self.assertRaises(BackendError, nc.flush)
+        self.assertEquals(nc._pending, {})
+
+    def test_nonces_are_flushed_in_the_background(self):
+        nc = self.make_cache(flush_interval=0.01)
+        self.assertTrue(nc.check_nonce(1000, "abc"))
+        for _ in xrange(100):
+            if self.server.items:
+                break
+            time.sleep(0.01)
+        self.assertEquals(len(self.server.items), 1)
+
+    def test_false_positives_are_confirmed_with_memcached(self):
+        nc = self.make_cache(filter_capacity=1, filter_error_rate=0.5)
+        num_fresh = 0
+        for i in xrange(100):
+            if nc.check_nonce(1000, "nonce%d" % (i,)):
+                num_fresh += 1
+        self.assertEquals(num_fresh, 100)
+        self.assertTrue(nc.num_memcached_checks > 0)
+
+    def test_local_mode(self):
+        nc = self.make_cache(mode="local")
+        self.assertTrue(nc.check_nonce(1000, "abc"))
+        self.assertFalse(nc.check_nonce(1000, "abc"))
+        self.assertTrue(nc.check_nonce(1000, "xyz"))
+        nc.flush()
+        self.assertEquals(self.server.num_commands, 0)
+        self.assertRaises(ValueError, self.make_cache, mode="unknown")
+
+    def test_nonces_are_forgotten_after_the_window(self):
+        nc = self.make_cache(mode="local")
+        digest = nc._get_digest(1004, "abc")
+        self.assertTrue(nc.check_nonce(1004, "abc"))
+        self.now = 1008
+        self.assertFalse(nc.check_nonce(1004, "abc"))
+        # Each nonce is remembered for at least two windows.
+        self.now = 1015
+        self.assertTrue(digest in nc.filter)
+        self.now = 1020
+        self.assertFalse(digest in nc.filter)
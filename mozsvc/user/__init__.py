@@ -10,6 +10,9 @@ Utilities for authentication via Mozilla's TokenServer auth system.
 
 """
 
+import threading
+import collections
+
 from zope.interface import implements
 
 from pyramid.request import Request
@@ -23,7 +26,8 @@ import tokenlib
 
 import mozsvc
 import mozsvc.secrets
-from mozsvc.util import resolve_name
+from mozsvc.util import resolve_name, LRUCache
+from mozsvc.metrics import annotate_request
 from mozsvc.user.permissivenoncecache import PermissiveNonceCache
 
 import logging
@@ -32,6 +36,16 @@ logger = logging.getLogger("mozsvc.user")
 
 ENVIRON_KEY_IDENTITY = "mozsvc.user.identity"
 
+# Default maximum number of parsed tokens to cache, and the maximum number
+# of seconds for which to cache each one.  The ttl bounds how long a token
+# remains usable after its signing secret has been removed.
+DEFAULT_TOKEN_CACHE_SIZE = 1000
+DEFAULT_TOKEN_CACHE_TTL = 60
+
+# Maximum number of distinct request hosts for which to cache the node name,
+# and to remember the secret that last worked.
+DEFAULT_NODE_NAME_CACHE_SIZE = 100
+
 
 class RequestWithUser(Request):
     """Request object that exposes the current user as "request.user".
@@ -84,11 +98,27 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
     single fixed secret (via the argument 'secret') or a file mapping
     node hostnames to secrets (via the argument 'secrets_file').  The
     two arguments are mutually exclusive.
+
+    Successfully-parsed tokens are cached, so that repeat requests using the
+    same token can skip the cryptographic checks.  At most "token_cache_size"
+    tokens are kept, each for at most "token_cache_ttl" seconds and never
+    past the token's own expiry time; set token_cache_size to zero to disable
+    the cache.  Each request's metrics record whether the cache was hit, as
+    "auth.token_cache_hit", and the overall hit and miss counts are available
+    via the "token_cache" attribute.
+
+    When parsing a token, the secret that most recently worked for that node
+    is tried first, followed by the rest from newest to oldest.  The
+    "secret_usage" attribute counts successful parses by the age of the
+    secret used (0 for the newest, 1 for the one before, and so on), so it
+    shows when old secrets have stopped being used.  The attribute
+    "num_failed_secret_attempts" counts parses wasted on the wrong secret.
     """
 
     implements(IAuthenticationPolicy)
 
-    def __init__(self, secrets=None, **kwds):
+    def __init__(self, secrets=None, token_cache_size=DEFAULT_TOKEN_CACHE_SIZE,
+                 token_cache_ttl=DEFAULT_TOKEN_CACHE_TTL, **kwds):
         if not secrets:
             # Using secret=None will cause tokenlib to use a randomly-generated
             # secret.  This is useful for getting started without having to
@@ -105,6 +135,20 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
         elif isinstance(secrets, dict):
             secrets = resolve_name(secrets.pop("backend"))(**secrets)
         self.secrets = secrets
+        if token_cache_size:
+            self.token_cache = LRUCache(token_cache_size)
+        else:
+            self.token_cache = None
+        self.token_cache_ttl = token_cache_ttl
+        # Bounded, since the Host header is controlled by the client.
+        self._node_name_cache = {}
+        self._node_name_cache_size = DEFAULT_NODE_NAME_CACHE_SIZE
+        # Maps node names to the secret that most recently worked for them.
+        # Bounded like the node name cache, and for the same reason.
+        self._last_good_secrets = {}
+        self.secret_usage = collections.defaultdict(int)
+        self.num_failed_secret_attempts = 0
+        self._secret_stats_lock = threading.Lock()
         if kwds.get("nonce_cache") is None:
             kwds["nonce_cache"] = PermissiveNonceCache()
         super(TokenServerAuthenticationPolicy, self).__init__(**kwds)
@@ -114,6 +158,10 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
         """Parse settings for an instance of this class."""
         supercls = super(TokenServerAuthenticationPolicy, cls)
         kwds = supercls._parse_settings(settings)
+        if "token_cache_size" in settings:
+            kwds["token_cache_size"] = int(settings.pop("token_cache_size"))
+        if "token_cache_ttl" in settings:
+            kwds["token_cache_ttl"] = float(settings.pop("token_cache_ttl"))
         # collect leftover settings into a config for a Secrets object,
         # wtih some b/w compat for old-style secret-handling settings.
         secrets_prefix = "secrets."
@@ -158,12 +206,23 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
 
         If the id is invalid then ValueError will be raised.
         """
+        node_name = self._get_node_name(request)
+        token_cache = self.token_cache
+        if token_cache is not None:
+            cache_key = (tokenid, node_name)
+            res = token_cache.get(cache_key)
+            annotate_request(request, "auth.token_cache_hit",
+                             int(res is not None))
+            if res is not None:
+                return res
         # There might be multiple secrets in use, if we're in the
         # process of transitioning from one to another.  Try each
-        # until we find one that works.
-        node_name = self._get_node_name(request)
+        # until we find one that works, starting with the one that
+        # last worked for this node and then from newest to oldest.
         secrets = self._get_token_secrets(node_name)
-        for secret in secrets:
+        num_secrets = len(secrets)
+        for i in self._get_secret_order(node_name, secrets):
+            secret = secrets[i]
             try:
                 data = tokenlib.parse_token(tokenid, secret=secret)
                 userid = data["uid"]
@@ -173,10 +232,24 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
                 key = tokenlib.get_derived_secret(tokenid, secret=secret)
                 break
             except (ValueError, KeyError):
-                pass
+                with self._secret_stats_lock:
+                    self.num_failed_secret_attempts += 1
         else:
             logger.warn("Authentication Failed: invalid hawk id")
             raise ValueError("invalid Hawk id")
+        last_good_secrets = self._last_good_secrets
+        if last_good_secrets.get(node_name) != secret:
+            if len(last_good_secrets) >= self._node_name_cache_size:
+                last_good_secrets.clear()
+            last_good_secrets[node_name] = secret
+        with self._secret_stats_lock:
+            self.secret_usage[num_secrets - 1 - i] += 1
+        if token_cache is not None:
+            # Don't let the cached entry outlive the token itself.
+            ttl = min(data["expires"] - token_cache.get_time(),
+                      self.token_cache_ttl)
+            if ttl > 0:
+                token_cache.set(cache_key, (userid, key), ttl=ttl)
         return userid, key
 
     def encode_hawk_id(self, request, userid):
@@ -198,6 +271,27 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
 
     def _get_node_name(self, request):
         """Get the canonical node name for the given request."""
+        # The node name depends only on these parts of the environ, and
+        # there are usually very few distinct values, so cache it.
+        environ = request.environ
+        cache_key = (environ.get("wsgi.url_scheme"),
+                     environ.get("HTTP_HOST"),
+                     environ.get("SERVER_NAME"),
+                     environ.get("SERVER_PORT"),
+                     environ.get("SCRIPT_NAME"))
+        cache = self._node_name_cache
+        try:
+            return cache[cache_key]
+        except KeyError:
+            node_name = self._compute_node_name(request)
+            # A plain dict is much cheaper than an LRUCache, and if it fills
+            # up then someone is sending bogus hosts, so just start again.
+            if len(cache) >= self._node_name_cache_size:
+                cache.clear()
+            cache[cache_key] = node_name
+            return node_name
+
+    def _compute_node_name(self, request):
         # Secrets are looked up by hostname.
         # We need to normalize some port information for this work right.
         node_name = request.host_url
@@ -207,6 +301,20 @@ class TokenServerAuthenticationPolicy(HawkAuthenticationPolicy):
             node_name = node_name[:-4]
         return node_name + request.script_name
 
+    def _get_secret_order(self, node_name, secrets):
+        """Get the order in which to try the given secrets, as indices."""
+        order = range(len(secrets) - 1, -1, -1)
+        last_good_secret = self._last_good_secrets.get(node_name)
+        if last_good_secret is not None and last_good_secret != secrets[-1]:
+            try:
+                i = secrets.index(last_good_secret)
+            except ValueError:
+                pass
+            else:
+                order.remove(i)
+                order.insert(0, i)
+        return order
+
     def _get_token_secrets(self, node_name):
         """Get the list of possible secrets for signing tokens."""
         if self.secrets is None:
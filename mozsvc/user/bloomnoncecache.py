@@ -0,0 +1,277 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Class for storing hawkauth nonces in a local Bloom filter backed by memcached.
+
+"""
+
+import math
+import struct
+import logging
+import threading
+import collections
+
+from mozsvc.exceptions import BackendError
+from mozsvc.user.noncecache import MemcachedNonceCache
+
+
+logger = logging.getLogger("mozsvc.user")
+
+# Number of nonces that each generation of the filter is sized to hold,
+# and the false-positive rate that it should have when holding that many.
+DEFAULT_FILTER_CAPACITY = 100000
+DEFAULT_FILTER_ERROR_RATE = 0.001
+
+# Number of seconds between writes of newly-seen nonces to memcached.
+DEFAULT_FLUSH_INTERVAL = 0.05
+
+MODE_ASYNC = "async"
+MODE_LOCAL = "local"
+
+
+class BloomNonceCache(MemcachedNonceCache):
+    """Object for managing a cache of used nonces in a local Bloom filter.
+
+    This class puts a time-windowed Bloom filter in front of the memcached
+    storage of MemcachedNonceCache.  Each nonce is checked against the filter
+    first.  If this process has definitely never seen the nonce then it is
+    accepted straight away; only possible duplicates need to be confirmed
+    by a synchronous memcached "add", which also weeds out false positives.
+
+    The "mode" argument controls how other processes find out about nonces
+    seen by this one:
+
+        * "async": newly-seen nonces are written to memcached in batches
+          by a background thread, every "flush_interval" seconds.  Since
+          each process only consults memcached for nonces that its own
+          filter has seen, a nonce replayed to a different process will
+          be accepted there, and only detected when that process writes
+          it to memcached.  Such late detections are logged and counted
+          in the "num_late_duplicates" attribute.
+        * "local": nonces are never written to memcached, and possible
+          duplicates are rejected without consulting it.  This only gives
+          replay protection within a single process, and will reject a few
+          fresh nonces due to false positives in the filter.
+
+    The "num_checks" and "num_memcached_checks" attributes count how many
+    nonces were checked, and how many of those needed a synchronous
+    round-trip to memcached.
+    """
+
+    def __init__(self, window=None, get_time=None, mode=MODE_ASYNC,
+                 filter_capacity=DEFAULT_FILTER_CAPACITY,
+                 filter_error_rate=DEFAULT_FILTER_ERROR_RATE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, **kwds):
+        if mode not in (MODE_ASYNC, MODE_LOCAL):
+            raise ValueError("unknown nonce cache mode: %r" % (mode,))
+        super(BloomNonceCache, self).__init__(window, get_time, **kwds)
+        self.mode = mode
+        # A nonce must be remembered until its timestamp leaves the window,
+        # which can be up to twice the window size after it is first seen.
+        # Three generations of one window each cover at least that long.
+        self.filter = RotatingBloomFilter(self.window, 3, filter_capacity,
+                                          filter_error_rate, self.get_time)
+        self.num_checks = 0
+        self.num_memcached_checks = 0
+        self.num_late_duplicates = 0
+        # These map the keys of nonces not yet written to memcached, and
+        # of those being written by flush(), to the time they expire.
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._flusher_stopped = threading.Event()
+        if mode == MODE_ASYNC:
+            self._flusher = threading.Thread(target=self._run_flusher,
+                                             args=(flush_interval,))
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def check_nonce(self, timestamp, nonce):
+        """Check if the given timestamp+nonce is fresh.
+
+        This method checks that the given timestamp is within the configured
+        time window, and that the given nonce has not previously been seen
+        with that timestamp.  It returns True if the nonce is fresh and False
+        if it is stale.
+        """
+        now = self.get_time()
+        # Check if the timestamp is within the configured window.
+        ts_min = now - self.window
+        ts_max = now + self.window
+        if not ts_min < timestamp < ts_max:
+            return False
+        digest = self._get_digest(timestamp, nonce)
+        key = self._get_key(digest)
+        with self._lock:
+            self.num_checks += 1
+            if not self.filter.add(digest):
+                # Definitely not seen by this process before.
+                if self.mode == MODE_ASYNC:
+                    self._pending[key] = timestamp + self.window
+                return True
+            if self.mode == MODE_LOCAL:
+                return False
+            # If we haven't written it to memcached yet, it's definitely
+            # a duplicate of a nonce that we've seen.
+            if key in self._pending or key in self._flushing:
+                return False
+            self.num_memcached_checks += 1
+        # It's a possible duplicate, or a false positive from the filter.
+        # Memcached has the final say, just like in MemcachedNonceCache.
+        try:
+            if not self.mcclient.add(key, 1, time=self.window):
+                return False
+        except ValueError:
+            return False
+        return True
+
+    def flush(self):
+        """Write any pending nonces to memcached.
+
+        If the write fails then the nonces are kept to be written next time,
+        until they expire.  They are already in the filter, so this process
+        would otherwise ask memcached about replays and accept them.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # Keep them visible to check_nonce() until they are written,
+            # so that a replay in the meantime is rejected outright.
+            self._flushing = pending
+        if pending:
+            items = dict((key, 1) for key in pending)
+            try:
+                results = self.mcclient.add_multi(items, time=self.window)
+            except Exception:
+                now = self.get_time()
+                with self._lock:
+                    self._flushing = {}
+                    for key, expiry in pending.iteritems():
+                        if expiry > now:
+                            self._pending.setdefault(key, expiry)
+                raise
+            with self._lock:
+                self._flushing = {}
+            num_late_duplicates = results.values().count(False)
+            if num_late_duplicates:
+                with self._lock:
+                    self.num_late_duplicates += num_late_duplicates
+                logger.warn("Accepted %d nonces already seen by other "
+                            "processes", num_late_duplicates)
+
+    def close(self):
+        """Stop the background flusher, if any, and flush pending nonces."""
+        if self._flusher is not None:
+            self._flusher_stopped.set()
+            self._flusher.join()
+            self._flusher = None
+            self.flush()
+
+    def _run_flusher(self, interval):
+        while not self._flusher_stopped.wait(interval):
+            try:
+                self.flush()
+            except BackendError:
+                # The nonces will be retried next time, and the error is
+                # already logged.
+                pass
+            except Exception:
+                logger.exception("Error while flushing nonces")
+
+
+class BloomFilter(object):
+    """Simple Bloom filter over bytestring digests.
+
+    The filter is sized to give the requested false-positive rate when it
+    holds "capacity" items.  Items must be uniformly-distributed digests at
+    least 16 bytes long, such as the output of sha1; the bit positions are
+    derived directly from them by double hashing.
+    """
+
+    def __init__(self, capacity, error_rate):
+        num_bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.num_bits = int(math.ceil(num_bits))
+        num_hashes = self.num_bits * math.log(2) / capacity
+        self.num_hashes = max(int(round(num_hashes)), 1)
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def __contains__(self, digest):
+        bits = self._bits
+        for pos in self._get_positions(digest):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, digest):
+        """Add a digest to the filter.
+
+        This returns True if the digest was possibly already present, and
+        False if it definitely was not.
+        """
+        bits = self._bits
+        present = True
+        for pos in self._get_positions(digest):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                present = False
+        return present
+
+    def _get_positions(self, digest):
+        h1, h2 = struct.unpack("<QQ", digest[:16])
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in xrange(self.num_hashes)]
+
+
+class RotatingBloomFilter(object):
+    """Bloom filter that forgets items after a while.
+
+    This keeps a separate BloomFilter for each "period" seconds of time,
+    and drops the oldest once there are more than "num_generations" of them.
+    Items are added to the newest generation, and are remembered for at
+    least (num_generations - 1) * period seconds.  It is not thread-safe.
+    """
+
+    def __init__(self, period, num_generations, capacity, error_rate,
+                 get_time):
+        self.period = period
+        self.num_generations = num_generations
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.get_time = get_time
+        # Deque of (generation number, BloomFilter) pairs, oldest first.
+        self._generations = collections.deque()
+
+    def __contains__(self, digest):
+        self._rotate()
+        for _, bloom in self._generations:
+            if digest in bloom:
+                return True
+        return False
+
+    def add(self, digest):
+        """Add a digest to the filter.
+
+        This returns True if the digest was possibly already present in any
+        generation, and False if it definitely was not.
+        """
+        self._rotate()
+        generations = self._generations
+        if generations[-1][1].add(digest):
+            return True
+        for i in xrange(len(generations) - 1):
+            if digest in generations[i][1]:
+                return True
+        return False
+
+    def _rotate(self):
+        current = int(self.get_time() // self.period)
+        generations = self._generations
+        if not generations or generations[-1][0] != current:
+            generations.append((current, BloomFilter(self.capacity,
+                                                     self.error_rate)))
+            oldest = current - self.num_generations + 1
+            while generations[0][0] < oldest:
+                generations.popleft()
@@ -0,0 +1,115 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Class for storing hawkauth nonces in local process memory.
+
+"""
+
+import time
+import math
+import threading
+
+
+DEFAULT_TIMESTAMP_WINDOW = 60
+
+# Width in seconds of the timestamp buckets into which nonces are grouped.
+DEFAULT_BUCKET_SIZE = 1
+
+
+class LocalNonceCache(object):
+    """Object for managing a cache of used nonce values in local memory.
+
+    This class implements the same timestamp/nonce checking interface as
+    MemcachedNonceCache, but keeps the nonces in an in-process data structure
+    so that checking them costs no network round-trip.  It is only suitable
+    for single-process deployments, since nonces are not shared between
+    processes.
+
+    Nonces are grouped into buckets according to their timestamp.  Once the
+    window has moved past a bucket, any nonce with a timestamp in it would be
+    rejected by the window check anyway, so the whole bucket is dropped at
+    once.  All access is protected by a lock that is never held while
+    blocking, so it is safe to use from threads or greenlets.
+    """
+
+    def __init__(self, window=None, get_time=None,
+                 bucket_size=DEFAULT_BUCKET_SIZE):
+        if window is None:
+            window = DEFAULT_TIMESTAMP_WINDOW
+        self.window = window
+        self.get_time = get_time or time.time
+        self.bucket_size = bucket_size
+        # Maps bucket numbers to sets of (timestamp, nonce) pairs.
+        self._buckets = {}
+        self._oldest_bucket = None
+        self._num_nonces = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            self._purge_expired_buckets(self.get_time())
+            return self._num_nonces
+
+    def check_nonce(self, timestamp, nonce):
+        """Check if the given timestamp+nonce is fresh.
+
+        This method checks that the given timestamp is within the configured
+        time window, and that the given nonce has not previously been seen
+        with that timestamp.  It returns True if the nonce is fresh and False
+        if it is stale.
+
+        Fresh nonces are stored so that subsequent checks of the same nonce
+        will return False.
+        """
+        now = self.get_time()
+        # Check if the timestamp is within the configured window.
+        ts_min = now - self.window
+        ts_max = now + self.window
+        if not ts_min < timestamp < ts_max:
+            return False
+        bucket_num = self._get_bucket_num(timestamp)
+        item = (timestamp, nonce)
+        with self._lock:
+            self._purge_expired_buckets(now)
+            bucket = self._buckets.get(bucket_num)
+            if bucket is None:
+                bucket = self._buckets[bucket_num] = set()
+                if self._oldest_bucket is None or \
+                        bucket_num < self._oldest_bucket:
+                    self._oldest_bucket = bucket_num
+            elif item in bucket:
+                return False
+            bucket.add(item)
+            self._num_nonces += 1
+        return True
+
+    def _get_bucket_num(self, timestamp):
+        return int(math.floor(timestamp / self.bucket_size))
+
+    def _purge_expired_buckets(self, now):
+        """Drop all buckets whose timestamps are entirely outside the window.
+
+        This must be called with the lock held.  Bucket numbers are visited
+        in order from the oldest, so each expired bucket costs O(1) to drop
+        and the scan stops at the first bucket still inside the window.
+        """
+        if self._oldest_bucket is None:
+            return
+        # Bucket N holds timestamps in [N * size, (N + 1) * size), all of
+        # which are stale once (N + 1) * size <= now - window.
+        max_expired = self._get_bucket_num(now - self.window) - 1
+        bucket_num = self._oldest_bucket
+        while bucket_num <= max_expired and self._buckets:
+            bucket = self._buckets.pop(bucket_num, None)
+            if bucket is not None:
+                self._num_nonces -= len(bucket)
+            bucket_num += 1
+        if self._buckets:
+            # Skip over any gap of empty buckets to the next live one.
+            while bucket_num not in self._buckets:
+                bucket_num += 1
+            self._oldest_bucket = bucket_num
+        else:
+            self._oldest_bucket = None
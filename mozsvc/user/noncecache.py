@@ -9,6 +9,7 @@ Class for storing hawkauth nonces in memcached.
 
 import time
 import math
+import threading
 from hashlib import sha1
 from base64 import urlsafe_b64encode
 
@@ -27,11 +28,18 @@ class MemcachedNonceCache(object):
     It stores the nonces in memcached so that they can be shared between
     different webserver processes.  Each timestamp+nonce combo is stored
     under a key sha1(<timestamp>:<nonce>).
+
+    If "batch_interval" is given, nonces checked by concurrent requests are
+    collected for that many seconds and then written to memcached with a
+    single pipelined add_multi, rather than one add per request.  Each
+    request still waits for its own result, so the replay protection is
+    unchanged; a short interval such as 0.002 can greatly increase the
+    throughput of busy gevent-based servers.
     """
 
     def __init__(self, window=None, get_time=None, cache_server=None,
                  cache_key_prefix="noncecache:", cache_pool_size=None,
-                 cache_pool_timeout=60, **kwds):
+                 cache_pool_timeout=60, batch_interval=None, **kwds):
         # Memcached ttls are in integer seconds, so round up to the nearest.
         if window is None:
             window = DEFAULT_TIMESTAMP_WINDOW
@@ -41,6 +49,9 @@ class MemcachedNonceCache(object):
         self.get_time = get_time or time.time
         self.mcclient = MemcachedClient(cache_server, cache_key_prefix,
                                         cache_pool_size, cache_pool_timeout)
+        self.batch_interval = batch_interval
+        self._batch = None
+        self._batch_lock = threading.Lock()
 
     def __len__(self):
         raise NotImplementedError
@@ -65,7 +76,9 @@ class MemcachedNonceCache(object):
         # Check if it's in memcached, adding it if not.
         # Fortunately memcached 'add' has precisely the right semantics
         # of "create if not exists"
-        key = urlsafe_b64encode(sha1("%d:%s" % (timestamp, nonce)).digest())
+        key = self._get_key(self._get_digest(timestamp, nonce))
+        if self.batch_interval:
+            return self._add_batched(key)
         try:
             if not self.mcclient.add(key, 1, time=self.window):
                 return False
@@ -73,3 +86,60 @@ class MemcachedNonceCache(object):
             return False
         # Successfully added, the nonce must be fresh.
         return True
+
+    def _get_digest(self, timestamp, nonce):
+        """Get the sha1 digest identifying a timestamp+nonce combo."""
+        return sha1("%d:%s" % (timestamp, nonce)).digest()
+
+    def _get_key(self, digest):
+        """Get the memcached key under which to store a nonce digest."""
+        return urlsafe_b64encode(digest)
+
+    def _add_batched(self, key):
+        """Add a key to memcached as part of a batch of concurrent requests.
+
+        The first request to arrive starts a new batch, waits for the batch
+        interval while other requests join it, and then writes the whole
+        batch to memcached.  The other requests wait for it to finish.  If
+        memcached rejects the batch with ValueError then every nonce in it
+        is treated as stale.
+        """
+        with self._batch_lock:
+            batch = self._batch
+            is_leader = batch is None
+            if is_leader:
+                batch = self._batch = _NonceBatch()
+            elif key in batch.keys:
+                # Somebody else is adding the same nonce right now.
+                return False
+            batch.keys.add(key)
+        if not is_leader:
+            batch.done.wait()
+        else:
+            time.sleep(self.batch_interval)
+            with self._batch_lock:
+                self._batch = None
+            try:
+                items = dict((k, 1) for k in batch.keys)
+                batch.results = self.mcclient.add_multi(items,
+                                                        time=self.window)
+            except ValueError:
+                # Reject them all, as check_nonce() does for a single key.
+                batch.results = dict.fromkeys(batch.keys, False)
+            except Exception, err:
+                batch.error = err
+            finally:
+                batch.done.set()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[key]
+
+
+class _NonceBatch(object):
+    """A batch of nonce keys to be added to memcached together."""
+
+    def __init__(self):
+        self.keys = set()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
@@ -5,18 +5,41 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 # ***** END LICENSE BLOCK *****
 
+import copy
 import json
 import time
 import socket
 import urllib
 import logging
 import urlparse
+import threading
 import traceback
 from datetime import datetime
+from collections import OrderedDict, deque
 from decimal import Decimal, InvalidOperation
 
 from pyramid.util import DottedNameResolver
 
+# Shared encoder for FastJsonLogFormatter, to skip json.dumps() option checks.
+_json_encode = json.JSONEncoder().encode
+
+# Use a monotonic clock for measuring intervals, where one is available.
+# Python 2 has none built in, but the "monotonic" backport provides one.
+# As a last resort, fall back to the (non-monotonic) wall-clock time.
+try:
+    from time import monotonic
+except ImportError:
+    try:
+        from monotonic import monotonic
+    except (ImportError, RuntimeError):
+        monotonic = time.time
+
+# Defaults for AsyncLogHandler.  The queue bounds memory use if the log
+# destination can't keep up, and the writer thread checks it this often.
+DEFAULT_LOG_QUEUE_SIZE = 10000
+DEFAULT_LOG_BATCH_SIZE = 100
+DEFAULT_LOG_POLL_INTERVAL = 0.05
+
 
 def round_time(value=None, precision=2):
     """Transforms a timestamp into a two digits Decimal.
@@ -103,6 +126,109 @@ def dnslookup(url):
     return urlparse.urlunparse(parts)
 
 
+class LRUCache(object):
+    """Bounded in-memory cache with LRU eviction and optional expiry.
+
+    This class implements a simple dict-like cache that holds at most
+    "max_items" entries, and optionally at most "max_bytes" worth of data
+    as measured by the sizes passed in to set().  The least-recently-used
+    entries are evicted to make room for new ones.  Entries expire after
+    "ttl" seconds if given, or after a per-entry ttl passed in to set().
+
+    Counts of cache hits and misses are kept in the "hits" and "misses"
+    attributes.  All operations are protected by a lock, so instances can
+    be safely shared between threads or greenlets.
+    """
+
+    def __init__(self, max_items=1000, max_bytes=None, ttl=None,
+                 get_time=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.get_time = get_time or time.time
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        # Maps keys to (value, size, expiry_time) tuples, kept in order
+        # from least- to most-recently used.
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Get the value cached under the given key, or the default."""
+        with self._lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            value, size, expiry_time = item
+            if expiry_time is not None and expiry_time <= self.get_time():
+                self.size -= size
+                self.misses += 1
+                return default
+            self._items[key] = item
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=0, ttl=None):
+        """Cache a value under the given key.
+
+        The optional "size" argument gives the size of the value in bytes,
+        for enforcing the "max_bytes" limit.  The optional "ttl" argument
+        overrides the default expiry time for this entry.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            expiry_time = None
+        else:
+            expiry_time = self.get_time() + ttl
+        with self._lock:
+            self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._items[key] = (value, size, expiry_time)
+            self.size += size
+            while len(self._items) > self.max_items:
+                self._remove_oldest()
+            if self.max_bytes is not None:
+                while self.size > self.max_bytes:
+                    self._remove_oldest()
+
+    def delete(self, key):
+        """Remove any value cached under the given key."""
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """Remove all values from the cache."""
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def get_stats(self):
+        """Get a dict of statistics about the cache usage."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "items": len(self._items),
+            "bytes": self.size,
+        }
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+    def _remove_oldest(self):
+        key, item = self._items.popitem(last=False)
+        self.size -= item[1]
+
+
 class JsonLogFormatter(logging.Formatter):
     """Log formatter that outputs machine-readable json.
 
@@ -151,6 +277,257 @@ class JsonLogFormatter(logging.Formatter):
         return json.dumps(details)
 
 
+class FastJsonLogFormatter(JsonLogFormatter):
+    """Faster version of JsonLogFormatter, producing equivalent output.
+
+    This formatter avoids most of the per-record overhead of its parent.
+    The JSON for the fixed "v", "hostname" and "pid" fields is serialized
+    once per process, the date and time are formatted once per second and
+    only the microseconds are filled in for each record.  The keys may come
+    out in a different order, but the decoded JSON is the same.
+    """
+
+    STATIC_KEYS = frozenset(("v", "hostname", "pid"))
+
+    def __init__(self, *args, **kwds):
+        super(FastJsonLogFormatter, self).__init__(*args, **kwds)
+        # These are (key, value) pairs, so they can be swapped atomically
+        # when the formatter is shared between threads.
+        self._static_fragment = (None, None)
+        self._time_prefix = (None, None)
+
+    def format(self, record):
+        details = {
+            "op": record.name,
+            "name": record.name,
+            "time": self._format_time(record.created),
+        }
+        # Include any custom attributes set on the record.
+        # These would usually be collected metrics data.
+        record_dict = record.__dict__
+        for key in record_dict.viewkeys() - self.DEFAULT_LOGRECORD_ATTRS:
+            details[key] = record_dict[key]
+        # Custom values for the static fields are rare, so just let
+        # the slow path deal with them.
+        if not self.STATIC_KEYS.isdisjoint(details):
+            return super(FastJsonLogFormatter, self).format(record)
+        # Only include the 'message' key if it has useful content
+        # and is not already a JSON blob.
+        message = record.getMessage()
+        if message:
+            if not message.startswith("{") and not message.endswith("}"):
+                details["message"] = message
+        # If there is an error, format it for nice output.
+        if record.exc_info is not None:
+            details["error"] = repr(record.exc_info[1])
+            details["traceback"] = safer_format_traceback(*record.exc_info)
+        # Splice the static fields onto the front of the JSON object.
+        pid, fragment = self._static_fragment
+        if record.process != pid:
+            static = self.DEFAULT_DETAILS.copy()
+            static["pid"] = pid = record.process
+            fragment = json.dumps(static)[:-1] + ", "
+            self._static_fragment = (pid, fragment)
+        return fragment + _json_encode(details)[1:]
+
+    def _format_time(self, created):
+        """Format a timestamp in the same way as datetime.isoformat()."""
+        # This mirrors the rounding done by datetime.utcfromtimestamp().
+        second = int(created)
+        microsecond = int((created - second) * 1000000 + 0.5)
+        if microsecond == 1000000:
+            second += 1
+            microsecond = 0
+        cached_second, prefix = self._time_prefix
+        if second != cached_second:
+            prefix = datetime.utcfromtimestamp(second).isoformat()
+            self._time_prefix = (second, prefix)
+        if not microsecond:
+            return prefix + "Z"
+        return "%s.%06dZ" % (prefix, microsecond)
+
+
+def _get_original(module_name, name):
+    """Get an object from the stdlib, bypassing any gevent monkey-patching."""
+    try:
+        from gevent.monkey import get_original
+    except ImportError:
+        return getattr(__import__(module_name), name)
+    return get_original(module_name, name)
+
+
+# Used by AsyncLogHandler to render exceptions before records are queued.
+_formatter = logging.Formatter()
+
+
+class AsyncLogHandler(logging.Handler):
+    """Log handler that does the formatting and writing in the background.
+
+    This handler puts log records on an in-memory queue and returns straight
+    away.  A background thread takes records off the queue in batches of up
+    to "batch_size" and passes them to the "target" handler.  If the target
+    is a plain StreamHandler or FileHandler the whole batch is formatted and
+    written to the stream at once, with a single flush.  Other handlers,
+    including the rotating file handlers, are given one record at a time.
+
+    Each record's message and exception are rendered to strings before it
+    is queued, so that the values it refers to can safely change or go away
+    before it is written.
+
+    The queue holds at most "max_queue_size" records.  When it is full the
+    oldest record is dropped to make room, and counted in "num_dropped".
+
+    The background thread is always a real OS thread, even if gevent has
+    monkey-patched the threading module, and it polls the queue every
+    "poll_interval" seconds rather than waiting on a gevent primitive.
+    So emitting a record never blocks the event loop on log I/O.
+    """
+
+    def __init__(self, target, max_queue_size=DEFAULT_LOG_QUEUE_SIZE,
+                 batch_size=DEFAULT_LOG_BATCH_SIZE,
+                 poll_interval=DEFAULT_LOG_POLL_INTERVAL):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.num_dropped = 0
+        self._queue = deque(maxlen=max_queue_size)
+        self._sleep = _get_original("time", "sleep")
+        self._write_lock = _get_original("thread", "allocate_lock")()
+        self._stopped = False
+        self._stopped_lock = _get_original("thread", "allocate_lock")()
+        self._stopped_lock.acquire()
+        start_new_thread = _get_original("thread", "start_new_thread")
+        start_new_thread(self._run_writer, ())
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        queue = self._queue
+        # A full deque silently drops its oldest item on append.
+        if len(queue) == queue.maxlen:
+            self.num_dropped += 1
+        queue.append(record)
+
+    def prepare(self, record):
+        """Return a copy of the record that is safe to write later.
+
+        As with logging.handlers.QueueHandler, the message is merged with
+        its arguments and any exception is formatted into "exc_text", so
+        that the copy holds no references to the caller's objects.  The
+        exception is also stored in the "error" and "traceback" fields that
+        JsonLogFormatter would have produced from it.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _formatter.formatException(record.exc_info)
+            record.error = repr(record.exc_info[1])
+            record.traceback = safer_format_traceback(*record.exc_info)
+            record.exc_info = None
+        return record
+
+    def flush(self):
+        """Write all queued records in the calling thread."""
+        while self._write_batch():
+            pass
+
+    def close(self):
+        """Stop the background thread, write queued records, and close."""
+        if not self._stopped:
+            self._stopped = True
+            self._stopped_lock.acquire()
+            self.flush()
+            self.target.close()
+        logging.Handler.close(self)
+
+    def _run_writer(self):
+        try:
+            while not self._stopped:
+                self._sleep(self.poll_interval)
+                while self._write_batch():
+                    pass
+        finally:
+            self._stopped_lock.release()
+
+    def _write_batch(self):
+        """Write a batch of queued records, returning False if none."""
+        with self._write_lock:
+            queue = self._queue
+            records = []
+            try:
+                while len(records) < self.batch_size:
+                    records.append(queue.popleft())
+            except IndexError:
+                pass
+            if not records:
+                return False
+            target = self.target
+            if self._can_write_to_stream(target):
+                self._write_to_stream(target, records)
+            else:
+                for record in records:
+                    target.handle(record)
+                target.flush()
+            return True
+
+    def _can_write_to_stream(self, target):
+        """Check whether records can be written straight to target.stream.
+
+        Subclasses may do extra work in emit(), such as rolling over to a
+        new file, so only the exact stdlib classes are written to directly.
+        A FileHandler with an encoding writes through a codecs stream that
+        expects unicode rather than the encoded lines written here.
+        """
+        if type(target) is logging.StreamHandler:
+            return True
+        if type(target) is logging.FileHandler:
+            return target.encoding is None
+        return False
+
+    def _write_to_stream(self, target, records):
+        target.acquire()
+        try:
+            if target.stream is None:
+                # A delay-opening FileHandler, opened on first use.
+                try:
+                    target.stream = target._open()
+                except Exception:
+                    target.handleError(records[-1])
+                    return
+            stream = target.stream
+            encoding = getattr(stream, "encoding", None) or "UTF-8"
+            lines = []
+            for record in records:
+                if record.levelno < target.level or not target.filter(record):
+                    continue
+                try:
+                    line = target.format(record) + "\n"
+                    # Encode each line separately, as StreamHandler.emit()
+                    # would, so that joining them can't fail.
+                    if isinstance(line, unicode):
+                        try:
+                            line = line.encode(encoding)
+                        except UnicodeError:
+                            line = line.encode("UTF-8")
+                    lines.append(line)
+                except Exception:
+                    target.handleError(record)
+            if lines:
+                try:
+                    stream.write("".join(lines))
+                    target.flush()
+                except Exception:
+                    target.handleError(records[-1])
+        finally:
+            target.release()
+
+
 def safer_format_traceback(exc_typ, exc_val, exc_tb):
     """Format an exception traceback into safer string.
 
@@ -21,7 +21,9 @@ tests_require = requires + [
             'gunicorn', 'gevent', 'testfixtures']
 
 extras_require = {
-    'memcache': ['umemcache>=1.3'],
+    'memcache': ['umemcache>=1.3', 'monotonic'],
+    'msgpack': ['msgpack>=0.5.2'],
+    'lz4': ['lz4'],
 }
 
 